@@ -0,0 +1,64 @@
+"""comments archive
+
+Revision ID: 3fa81b6c0e27
+Revises: e7a4c9d2b610
+Create Date: 2026-10-17 15:36:52.804117
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlalchemy_utils
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '3fa81b6c0e27'
+down_revision = 'e7a4c9d2b610'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('comments_archive',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('path', sqlalchemy_utils.types.ltree.LtreeType(), nullable=False),
+    sa.Column('level', sa.Integer(), nullable=False),
+    sa.Column('item_id', sa.String(), nullable=False),
+    sa.Column('data_type', sa.String(), nullable=False),
+    sa.Column('comment_text', sa.String(length=3000), nullable=False),
+    sa.Column('is_deleted', sa.Boolean(), nullable=True),
+    sa.Column('date_created', sa.DateTime(), nullable=True),
+    sa.Column('date_modified', sa.DateTime(), nullable=True),
+    sa.Column('user_id', sa.Integer(), nullable=True),
+    sa.Column('service_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('scope', sa.String(), nullable=True),
+    sa.ForeignKeyConstraint(['service_id'], ['services.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('service_id', 'id', name='comments_archive_pkey')
+    )
+    op.create_index('ix_comments_archive_item_path', 'comments_archive',
+                    ['service_id', 'data_type', 'item_id', 'scope', 'path'], unique=False)
+    op.create_index('ix_comments_archive_item_date_created', 'comments_archive',
+                    ['service_id', 'data_type', 'item_id', 'scope', 'date_created', 'id'], unique=False)
+    op.add_column('item_versions', sa.Column('is_archived', sa.Boolean(), server_default=sa.false(), nullable=False))
+    op.create_index('ix_item_versions_date_modified', 'item_versions', ['date_modified'], unique=False,
+                    postgresql_where=sa.text('NOT is_archived'))
+    # комментарий из import_map может быть перенесен в архив, поэтому внешний ключ на comments удаляется
+    op.drop_constraint('import_map_comment_fkey', 'import_map', type_='foreignkey')
+
+
+def downgrade():
+    # архивные комментарии возвращаются в основную таблицу
+    op.execute("""
+        INSERT INTO comments (id, path, level, item_id, data_type, comment_text, is_deleted,
+                              date_created, date_modified, user_id, service_id, scope)
+        SELECT id, path, level, item_id, data_type, comment_text, is_deleted,
+               date_created, date_modified, user_id, service_id, scope
+          FROM comments_archive
+    """)
+    op.create_foreign_key('import_map_comment_fkey', 'import_map', 'comments',
+                          ['service_id', 'comment_id'], ['service_id', 'id'], deferrable=True, initially='DEFERRED')
+    op.drop_index('ix_item_versions_date_modified', table_name='item_versions')
+    op.drop_column('item_versions', 'is_archived')
+    op.drop_index('ix_comments_archive_item_date_created', table_name='comments_archive')
+    op.drop_index('ix_comments_archive_item_path', table_name='comments_archive')
+    op.drop_table('comments_archive')
@@ -0,0 +1,40 @@
+"""item versions
+
+Revision ID: 49d739e787f5
+Revises: 730aaa60df29
+Create Date: 2026-10-17 11:02:15.184620
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '49d739e787f5'
+down_revision = '730aaa60df29'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('item_versions',
+    sa.Column('service_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('data_type', sa.String(), nullable=False),
+    sa.Column('item_id', sa.String(), nullable=False),
+    sa.Column('version', sa.BigInteger(), nullable=False),
+    sa.Column('comments_count', sa.Integer(), nullable=False),
+    sa.Column('date_modified', sa.DateTime(), server_default=sa.text('now()'), nullable=True),
+    sa.ForeignKeyConstraint(['service_id'], ['services.id'], ),
+    sa.PrimaryKeyConstraint('service_id', 'data_type', 'item_id')
+    )
+    # заполняем версии для уже существующих комментариев
+    op.execute("""
+        INSERT INTO item_versions (service_id, data_type, item_id, version, comments_count, date_modified)
+        SELECT service_id, data_type, item_id, 1, count(*), max(date_modified)
+          FROM comments
+         GROUP BY service_id, data_type, item_id
+    """)
+
+
+def downgrade():
+    op.drop_table('item_versions')
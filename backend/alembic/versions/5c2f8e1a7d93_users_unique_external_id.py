@@ -0,0 +1,40 @@
+"""users unique external id
+
+Revision ID: 5c2f8e1a7d93
+Revises: b1e06c3f52a4
+Create Date: 2026-10-17 14:02:37.918245
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c2f8e1a7d93'
+down_revision = 'b1e06c3f52a4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # дубликаты пользователей, созданные одновременными первыми комментариями, сливаются в пользователя
+    # с наименьшим id: комментарии переносятся на него, остальные записи удаляются
+    op.execute("""
+        CREATE TEMPORARY TABLE users_duplicates ON COMMIT DROP AS
+        SELECT id, min(id) OVER (PARTITION BY service_id, external_id) AS keep_id
+          FROM users
+         WHERE external_id IS NOT NULL
+    """)
+    op.execute("DELETE FROM users_duplicates WHERE id = keep_id")
+    op.execute("""
+        UPDATE comments
+           SET user_id = users_duplicates.keep_id
+          FROM users_duplicates
+         WHERE comments.user_id = users_duplicates.id
+    """)
+    op.execute("DELETE FROM users USING users_duplicates WHERE users.id = users_duplicates.id")
+    op.create_index('ix_users_service_id_external_id', 'users', ['service_id', 'external_id'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_users_service_id_external_id', table_name='users')
@@ -0,0 +1,33 @@
+"""comments item indexes
+
+Revision ID: 730aaa60df29
+Revises: 8365d0798098
+Create Date: 2026-10-17 10:12:40.512031
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '730aaa60df29'
+down_revision = '8365d0798098'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # индексы строятся без блокировки записи в таблицу комментариев
+    with op.get_context().autocommit_block():
+        op.create_index('ix_comments_item_path', 'comments',
+                        ['service_id', 'data_type', 'item_id', 'scope', 'path'],
+                        unique=False, postgresql_concurrently=True)
+        op.create_index('ix_comments_item_date_created', 'comments',
+                        ['service_id', 'data_type', 'item_id', 'scope', 'date_created', 'id'],
+                        unique=False, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.drop_index('ix_comments_item_date_created', table_name='comments', postgresql_concurrently=True)
+        op.drop_index('ix_comments_item_path', table_name='comments', postgresql_concurrently=True)
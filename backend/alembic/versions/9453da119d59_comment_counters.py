@@ -0,0 +1,44 @@
+"""comment counters
+
+Revision ID: 9453da119d59
+Revises: 49d739e787f5
+Create Date: 2026-10-17 12:20:41.307514
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = '9453da119d59'
+down_revision = '49d739e787f5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('comment_counters',
+    sa.Column('service_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('data_type', sa.String(), nullable=False),
+    sa.Column('item_id', sa.String(), nullable=False),
+    sa.Column('scope', sa.String(), nullable=False),
+    sa.Column('total', sa.Integer(), nullable=False),
+    sa.Column('active', sa.Integer(), nullable=False),
+    sa.Column('top_level', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['service_id'], ['services.id'], ),
+    sa.PrimaryKeyConstraint('service_id', 'data_type', 'item_id', 'scope')
+    )
+    # заполняем счетчики для уже существующих комментариев
+    op.execute("""
+        INSERT INTO comment_counters (service_id, data_type, item_id, scope, total, active, top_level)
+        SELECT service_id, data_type, item_id, scope,
+               count(*),
+               count(*) FILTER (WHERE is_deleted IS NOT TRUE),
+               count(*) FILTER (WHERE level = 1)
+          FROM comments
+         GROUP BY service_id, data_type, item_id, scope
+    """)
+
+
+def downgrade():
+    op.drop_table('comment_counters')
@@ -0,0 +1,37 @@
+"""comments search vector
+
+Revision ID: a4d2f7c91e35
+Revises: 3fa81b6c0e27
+Create Date: 2026-10-17 16:48:12.530861
+
+"""
+import os
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = 'a4d2f7c91e35'
+down_revision = '3fa81b6c0e27'
+branch_labels = None
+depends_on = None
+
+# конфигурация поиска фиксируется в выражении колонки, для смены языка колонку нужно пересоздать
+SEARCH_LANGUAGE = os.getenv("COMMENTS_SEARCH_LANGUAGE", "russian")
+SEARCH_VECTOR_SQL = f"to_tsvector('{SEARCH_LANGUAGE}'::regconfig, comment_text)"
+
+
+def upgrade():
+    # добавление вычисляемой колонки перезаписывает все секции таблицы комментариев
+    for table in ('comments', 'comments_archive'):
+        op.add_column(table, sa.Column('search_vector', postgresql.TSVECTOR(),
+                                       sa.Computed(SEARCH_VECTOR_SQL, persisted=True), nullable=True))
+        op.create_index(f'ix_{table}_search_vector', table, ['search_vector'], unique=False,
+                        postgresql_using='gin')
+
+
+def downgrade():
+    for table in ('comments', 'comments_archive'):
+        op.drop_index(f'ix_{table}_search_vector', table_name=table)
+        op.drop_column(table, 'search_vector')
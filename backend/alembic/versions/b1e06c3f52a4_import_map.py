@@ -0,0 +1,31 @@
+"""import map
+
+Revision ID: b1e06c3f52a4
+Revises: 9453da119d59
+Create Date: 2026-10-17 13:05:12.640831
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = 'b1e06c3f52a4'
+down_revision = '9453da119d59'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('import_map',
+    sa.Column('service_id', postgresql.UUID(as_uuid=True), nullable=False),
+    sa.Column('source_id', sa.String(), nullable=False),
+    sa.Column('comment_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['comment_id'], ['comments.id'], ),
+    sa.ForeignKeyConstraint(['service_id'], ['services.id'], ),
+    sa.PrimaryKeyConstraint('service_id', 'source_id')
+    )
+
+
+def downgrade():
+    op.drop_table('import_map')
@@ -0,0 +1,25 @@
+"""comments item date modified index
+
+Revision ID: c81e5a3f9d24
+Revises: a4d2f7c91e35
+Create Date: 2026-10-17 17:42:05.118240
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c81e5a3f9d24'
+down_revision = 'a4d2f7c91e35'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_comments_item_date_modified', 'comments',
+                    ['service_id', 'data_type', 'item_id', 'scope', 'date_modified', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_comments_item_date_modified', table_name='comments')
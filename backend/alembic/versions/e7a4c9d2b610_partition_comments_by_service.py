@@ -0,0 +1,73 @@
+"""partition comments by service
+
+Revision ID: e7a4c9d2b610
+Revises: 5c2f8e1a7d93
+Create Date: 2026-10-17 14:48:09.271563
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e7a4c9d2b610'
+down_revision = '5c2f8e1a7d93'
+branch_labels = None
+depends_on = None
+
+
+# индексы таблицы комментариев, создаются на секционированной таблице и наследуются секциями
+def create_comments_indexes():
+    op.create_index('ix_comments_path', 'comments', ['path'], unique=False, postgresql_using='gist')
+    op.create_index('ix_comments_item_path', 'comments',
+                    ['service_id', 'data_type', 'item_id', 'scope', 'path'], unique=False)
+    op.create_index('ix_comments_item_date_created', 'comments',
+                    ['service_id', 'data_type', 'item_id', 'scope', 'date_created', 'id'], unique=False)
+
+
+def upgrade():
+    # Таблица комментариев секционируется списком по service_id (требуется PostgreSQL 12+).
+    # Все сервисы попадают в секцию по умолчанию comments_default, крупные сервисы выносятся в отдельные секции
+    # командой python -m app.cli attach-partition. Данные копируются, поэтому миграцию нужно выполнять
+    # при остановленной записи комментариев.
+
+    # последовательность id принадлежит старой таблице и удалилась бы вместе с ней
+    op.execute("ALTER SEQUENCE comments_id_seq OWNED BY NONE")
+    # внешние ключи на comments.id невозможны: уникальный ключ секционированной таблицы включает service_id.
+    # Ссылка import_map заменяется составной, ссылка устаревшей таблицы attachments удаляется
+    op.execute("ALTER TABLE import_map DROP CONSTRAINT IF EXISTS import_map_comment_id_fkey")
+    op.execute("ALTER TABLE attachments DROP CONSTRAINT IF EXISTS attachments_comment_id_fkey")
+
+    op.execute("CREATE TABLE comments_partitioned (LIKE comments INCLUDING DEFAULTS) PARTITION BY LIST (service_id)")
+    op.execute("ALTER TABLE comments_partitioned ALTER COLUMN service_id SET NOT NULL")
+    op.execute("CREATE TABLE comments_default PARTITION OF comments_partitioned DEFAULT")
+    op.execute("INSERT INTO comments_partitioned SELECT * FROM comments")
+    op.drop_table('comments')
+    op.rename_table('comments_partitioned', 'comments')
+
+    op.create_primary_key('comments_pkey', 'comments', ['service_id', 'id'])
+    op.create_foreign_key('comments_service_id_fkey', 'comments', 'services', ['service_id'], ['id'])
+    op.create_foreign_key('comments_user_id_fkey', 'comments', 'users', ['user_id'], ['id'])
+    create_comments_indexes()
+    # отложенная проверка нужна при переносе комментариев сервиса в отдельную секцию (crud.attach_service_partition):
+    # строки удаляются из секции по умолчанию раньше, чем появляются в новой секции
+    op.create_foreign_key('import_map_comment_fkey', 'import_map', 'comments',
+                          ['service_id', 'comment_id'], ['service_id', 'id'], deferrable=True, initially='DEFERRED')
+
+
+def downgrade():
+    op.drop_constraint('import_map_comment_fkey', 'import_map', type_='foreignkey')
+    op.execute("CREATE TABLE comments_plain (LIKE comments INCLUDING DEFAULTS)")
+    op.execute("INSERT INTO comments_plain SELECT * FROM comments")
+    # вместе с секционированной таблицей удаляются все ее секции
+    op.drop_table('comments')
+    op.rename_table('comments_plain', 'comments')
+    op.execute("ALTER TABLE comments ALTER COLUMN service_id DROP NOT NULL")
+
+    op.create_primary_key('comments_pkey', 'comments', ['id'])
+    op.create_foreign_key('comments_service_id_fkey', 'comments', 'services', ['service_id'], ['id'])
+    op.create_foreign_key('comments_user_id_fkey', 'comments', 'users', ['user_id'], ['id'])
+    create_comments_indexes()
+    op.execute("ALTER SEQUENCE comments_id_seq OWNED BY comments.id")
+    op.create_foreign_key('import_map_comment_id_fkey', 'import_map', 'comments', ['comment_id'], ['id'])
+    op.create_foreign_key('attachments_comment_id_fkey', 'attachments', 'comments', ['comment_id'], ['id'])
@@ -0,0 +1,156 @@
+"""
+Служебные команды сервиса комментариев.
+
+Запуск из каталога backend:
+
+    python -m app.cli rebuild-counters [--service-id <uuid>]
+    python -m app.cli import-comments --service-id <uuid> [--chunk-size <n>] <file.ndjson | ->
+    python -m app.cli export-comments --service-id <uuid> [--format ndjson|csv] [--data-type <type>]
+                                      [--created-from <date>] [--created-to <date>] [--modified-since <date>]
+                                      [--output <file | ->]
+    python -m app.cli attach-partition --service-id <uuid>
+    python -m app.cli archive-items [--older-than-days <n>] [--batch-size <n>]
+"""
+import argparse
+import asyncio
+import contextlib
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from app.comment import crud, exporter, importer, schemas
+from app.core.config import (COMMENTS_ARCHIVE_AFTER_DAYS, COMMENTS_ARCHIVE_BATCH_SIZE, COMMENTS_IMPORT_CHUNK_SIZE,
+                             COMMENTS_STREAM_BATCH_SIZE)
+from app.db.session import SessionLocal
+
+
+# пересчет счетчиков комментариев
+async def rebuild_counters(args):
+    """Функция пересчета счетчиков комментариев всех страниц или страниц одного сервиса"""
+    async with SessionLocal() as db:
+        count = await crud.rebuild_counters(db=db, service_id=args.service_id)
+    print(f'rebuilt {count} counters')
+
+
+# чтение строк импортируемого файла
+async def read_lines(path: str):
+    """Асинхронный генератор строк файла, '-' - стандартный ввод"""
+    with contextlib.nullcontext(sys.stdin.buffer) if path == '-' else open(path, 'rb') as file:
+        for line in file:
+            yield line
+
+
+# импорт комментариев из файла NDJSON
+async def import_comments(args):
+    """Функция импорта комментариев из файла NDJSON (формат описан в app/comment/importer.py)"""
+    started = time.monotonic()
+
+    def progress(result):
+        elapsed = time.monotonic() - started
+        print(f'imported {result.imported}, skipped {result.skipped}, '
+              f'{(result.imported + result.skipped) / elapsed:.0f} comments/s', file=sys.stderr)
+
+    async with SessionLocal() as db:
+        try:
+            result = await importer.import_comments(db=db,
+                                                    service_id=args.service_id,
+                                                    lines=read_lines(args.file),
+                                                    chunk_size=args.chunk_size,
+                                                    progress=progress)
+        except importer.ImportLineError as err:
+            sys.exit(f'import failed: {err}')
+    print(f'imported {result.imported}, skipped {result.skipped}')
+
+
+# выгрузка комментариев сервиса
+async def export_comments(args):
+    """Функция выгрузки комментариев сервиса в файл или стандартный вывод"""
+    with contextlib.nullcontext(sys.stdout.buffer) if args.output == '-' else open(args.output, 'wb') as file:
+        async with SessionLocal() as db:
+            async for chunk in exporter.export_comments(db=db,
+                                                        service_id=args.service_id,
+                                                        export_format=args.format,
+                                                        batch_size=COMMENTS_STREAM_BATCH_SIZE,
+                                                        data_type=args.data_type,
+                                                        created_from=args.created_from,
+                                                        created_to=args.created_to,
+                                                        modified_since=args.modified_since):
+                file.write(chunk)
+
+
+# выделение комментариев сервиса в отдельную секцию
+async def attach_partition(args):
+    """Функция выделения комментариев сервиса в отдельную секцию таблицы комментариев"""
+    async with SessionLocal() as db:
+        partition = await crud.attach_service_partition(db=db, service_id=args.service_id)
+    print(f'attached partition {partition}')
+
+
+# перенос комментариев неактивных страниц в архив
+async def archive_items(args):
+    """Функция переноса в архив комментариев страниц, не изменявшихся дольше заданного числа дней"""
+    cutoff = datetime.utcnow() - timedelta(days=args.older_than_days)
+    items = comments = 0
+    async with SessionLocal() as db:
+        while True:
+            result = await crud.archive_items(db=db, cutoff=cutoff, batch_size=args.batch_size)
+            if not result.items:
+                break
+            items += result.items
+            comments += result.comments
+            print(f'archived {items} items, {comments} comments', file=sys.stderr)
+    print(f'archived {items} items, {comments} comments')
+
+
+# разбор аргументов командной строки и запуск команды
+def main(argv=None):
+    """Функция разбора аргументов командной строки и запуска выбранной команды"""
+    parser = argparse.ArgumentParser(prog='python -m app.cli', description='Служебные команды сервиса комментариев')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    rebuild = commands.add_parser('rebuild-counters', help='пересчитать счетчики комментариев по таблице комментариев')
+    rebuild.add_argument('--service-id', type=uuid.UUID, default=None,
+                         help='пересчитать только счетчики указанного сервиса')
+    rebuild.set_defaults(handler=rebuild_counters)
+
+    import_ = commands.add_parser('import-comments', help='импортировать комментарии из файла NDJSON')
+    import_.add_argument('--service-id', type=uuid.UUID, required=True, help='сервис, для которого импортируются комментарии')
+    import_.add_argument('--chunk-size', type=int, default=COMMENTS_IMPORT_CHUNK_SIZE,
+                         help='количество комментариев в одной транзакции')
+    import_.add_argument('file', help="файл NDJSON, '-' - стандартный ввод")
+    import_.set_defaults(handler=import_comments)
+
+    export = commands.add_parser('export-comments', help='выгрузить комментарии сервиса в NDJSON или CSV')
+    export.add_argument('--service-id', type=uuid.UUID, required=True, help='сервис, комментарии которого выгружаются')
+    export.add_argument('--format', type=schemas.ExportFormat,
+                        choices=[export_format.value for export_format in schemas.ExportFormat],
+                        default=schemas.ExportFormat.ndjson, help='формат выгрузки')
+    export.add_argument('--data-type', default=None, help='выгружать только комментарии указанного типа данных')
+    export.add_argument('--created-from', type=datetime.fromisoformat, default=None,
+                        help='выгружать комментарии, созданные начиная с даты (ISO 8601)')
+    export.add_argument('--created-to', type=datetime.fromisoformat, default=None,
+                        help='выгружать комментарии, созданные до даты (ISO 8601)')
+    export.add_argument('--modified-since', type=datetime.fromisoformat, default=None,
+                        help='выгружать комментарии, измененные начиная с даты (ISO 8601)')
+    export.add_argument('--output', default='-', help="файл выгрузки, '-' - стандартный вывод")
+    export.set_defaults(handler=export_comments)
+
+    attach = commands.add_parser('attach-partition',
+                                 help='вынести комментарии сервиса в отдельную секцию таблицы комментариев')
+    attach.add_argument('--service-id', type=uuid.UUID, required=True, help='сервис, для которого создается секция')
+    attach.set_defaults(handler=attach_partition)
+
+    archive = commands.add_parser('archive-items', help='перенести комментарии неактивных страниц в архив')
+    archive.add_argument('--older-than-days', type=int, default=COMMENTS_ARCHIVE_AFTER_DAYS,
+                         help='архивировать страницы, комментарии которых не менялись дольше указанного числа дней')
+    archive.add_argument('--batch-size', type=int, default=COMMENTS_ARCHIVE_BATCH_SIZE,
+                         help='количество страниц в одной транзакции')
+    archive.set_defaults(handler=archive_items)
+
+    args = parser.parse_args(argv)
+    asyncio.run(args.handler(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,33 +1,84 @@
+import math
+import time
 import uuid
-from typing import List, Optional
+from datetime import datetime, timedelta
+from typing import List, Optional, Union
 
 from sqlalchemy.exc import SQLAlchemyError, NoResultFound
-from sqlalchemy.orm import Session
-from fastapi import APIRouter, Depends, status, HTTPException, Query, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+from fastapi import APIRouter, Cookie, Depends, status, Header, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
 
 
-from app.db.session import SessionLocal
-from app.comment import schemas, crud
-from app.utils import convertors, signer
+from app.core.config import (COMMENTS_BATCH_MAX_ITEMS, COMMENTS_BRANCH_DEPTH, COMMENTS_CACHE_BACKEND,
+                             COMMENTS_CACHE_REDIS_URL, COMMENTS_CACHE_SIZE, COMMENTS_CACHE_TTL, COMMENTS_CHANGES_OVERLAP,
+                             COMMENTS_EVENTS_CHANNEL, COMMENTS_EVENTS_KEEPALIVE, COMMENTS_EVENTS_QUEUE_SIZE,
+                             COMMENTS_IMPORT_CHUNK_SIZE, COMMENTS_PAGE_LIMIT, COMMENTS_PAGE_MAX_LIMIT,
+                             COMMENTS_ROOTS_MAX_PREVIEW, COMMENTS_ROOTS_PREVIEW, COMMENTS_SINGLEFLIGHT_SIZE,
+                             COMMENTS_SINGLEFLIGHT_TTL, COMMENTS_STREAM_BATCH_SIZE, DB_REPLICA_PIN_SECONDS)
+from app.db.pool import pool_stats
+from app.db.session import ReadSessionLocal, SessionLocal, engine, replica_engines
+from app.comment import schemas, crud, events, exporter, importer
+from app.utils import cache, convertors, signer
+from app.utils.singleflight import SingleFlight
+
+# cookie с временем, до которого чтение клиента выполняется в основной БД
+READ_PRIMARY_COOKIE = 'comments_read_primary_until'
 
 
 async def get_db():
-    db = SessionLocal()
+    async with SessionLocal() as db:
+        yield db
+
+
+# чтение выполняется в репликах, но клиент, недавно изменивший комментарии, читает из основной БД,
+# чтобы увидеть свои изменения, даже если реплики отстают (см. pin_reads_to_primary)
+async def get_read_db(read_primary_until: Optional[str] = Cookie(None, alias=READ_PRIMARY_COOKIE)):
     try:
+        pinned = float(read_primary_until) > time.time()
+    except (TypeError, ValueError):
+        pinned = False
+    async with (SessionLocal() if pinned else ReadSessionLocal()) as db:
         yield db
-    finally:
-        db.close()
+
+
+# закрепление чтения клиента за основной БД на DB_REPLICA_PIN_SECONDS после изменения комментариев
+def pin_reads_to_primary(response: Response):
+    if replica_engines:
+        response.set_cookie(READ_PRIMARY_COOKIE, str(time.time() + DB_REPLICA_PIN_SECONDS),
+                            max_age=math.ceil(DB_REPLICA_PIN_SECONDS), httponly=True)
 
 
 router = APIRouter()
 
+comments_cache = cache.CommentsCache(cache.create_backend(COMMENTS_CACHE_BACKEND,
+                                                          maxsize=COMMENTS_CACHE_SIZE,
+                                                          ttl=COMMENTS_CACHE_TTL,
+                                                          redis_url=COMMENTS_CACHE_REDIS_URL))
+
+# одновременные одинаковые запросы страницы, не найденной в кэше (например, при всплеске переходов
+# на популярную страницу), читают ее из БД и сериализуют один раз, ключ - ключ кэша с версией страницы
+comments_flight = SingleFlight(ttl=COMMENTS_SINGLEFLIGHT_TTL, maxsize=COMMENTS_SINGLEFLIGHT_SIZE)
+
+# подписки на изменения комментариев (одно соединение LISTEN на процесс)
+event_hub = events.EventHub(dsn=events.listener_dsn(),
+                            channel=COMMENTS_EVENTS_CHANNEL,
+                            queue_size=COMMENTS_EVENTS_QUEUE_SIZE,
+                            keepalive=COMMENTS_EVENTS_KEEPALIVE)
+
+
+@router.on_event('shutdown')
+async def close_event_hub():
+    await event_hub.close()
+
 # публикация комментария
 @router.post("/{service_id}/{data_type}/{item_id}/", response_model=schemas.CommentOut, tags=["comments"])
-def create_comment(new_comment: schemas.CommentIn,
-                   service_id: uuid.UUID,
-                   data_type: schemas.DataType,
-                   item_id: str = Query(..., regex="^.*$"),
-                   db: Session = Depends(get_db)):
+async def create_comment(new_comment: schemas.CommentIn,
+                         service_id: uuid.UUID,
+                         data_type: schemas.DataType,
+                         response: Response,
+                         item_id: str = Query(..., regex="^.*$"),
+                         db: AsyncSession = Depends(get_db)):
     """
     Публикация комментария в БД
     ======================
@@ -51,53 +102,207 @@ def create_comment(new_comment: schemas.CommentIn,
     """
 
     # проверяем совпадают ли с присланной, если нет, возвращаем ошибку
-    if signer.check_signs(db=db,
-                          received_signature=new_comment.signature,
-                          service_id=service_id,
-                          data_type=data_type,
-                          item_id=item_id):
-        # проверяем наличие пользователя в БД, если нет, создаем
-        if not crud.check_user(db=db, service_id=service_id, user_id=new_comment.user.dict()['external_id']):
-            user = crud.create_user(db=db, service_id=service_id, user=new_comment.user)
-        else:
-            user = crud.get_user(db=db, service_id=service_id, user_id=new_comment.user.dict()['external_id'])
-        # если указан идентификатор родителя, получаем путь родителя
-        if new_comment.parent_id:
-            parent_path = crud.get_path(db=db, id=new_comment.parent_id)
-        else:
-            parent_path = None
+    if await signer.check_signs(db=db,
+                                received_signature=new_comment.signature,
+                                service_id=service_id,
+                                data_type=data_type,
+                                item_id=item_id):
         #Проверяем наличие scope, если нет, присваиваем по умолчанию all
         if new_comment.scope:
             scope = new_comment.scope
         else:
             scope = schemas.Scope.all
         try:
-            comment_row = crud.create_comment(db=db,
-                                            service_id=service_id,
-                                            data_type=data_type,
-                                            item_id=item_id,
-                                            parent_path=parent_path,
-                                            user=user,
-                                            comment_text=new_comment.comment_text,
-                                            scope=scope)
+            # пользователь сохраняется (или обновляется) и путь родителя вычисляется
+            # в том же запросе, что и вставка комментария
+            comment_row = await crud.create_comment(db=db,
+                                                    service_id=service_id,
+                                                    data_type=data_type,
+                                                    item_id=item_id,
+                                                    parent_id=new_comment.parent_id,
+                                                    user=new_comment.user,
+                                                    comment_text=new_comment.comment_text,
+                                                    scope=scope)
         except NoResultFound as err:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='service not found ')
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='parent comment not found')
         except SQLAlchemyError as err:
             raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(err.__dict__['orig']))
+        user = schemas.User(id=comment_row.user_id,
+                            external_id=comment_row.external_id,
+                            first_name=comment_row.first_name,
+                            last_name=comment_row.last_name,
+                            user_group=comment_row.user_group)
+        pin_reads_to_primary(response)
         return convertors.comment_db_2_out(comment_row, user)
     else:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='incorrect signature')
 
-# получение комментариев
-@router.get("/{service_id}/{data_type}/{item_id}/", response_model=List[schemas.CommentOut], tags=["comments"])
-def get_comments(service_id: uuid.UUID,
-                 data_type: schemas.DataType,
-                 item_id: str,
-                 signature: str,
-                 presentation: Optional[schemas.PresentationList] = schemas.PresentationList.tree,
-                 scope: Optional[schemas.Scope] = schemas.Scope.all,
-                 parent_id: Optional[int] = None,
-                 db: Session = Depends(get_db)):
+# получение комментариев сразу для нескольких страниц
+# (маршрут объявлен до получения комментариев страницы, т.к. совпадает с ним по числу сегментов пути)
+@router.get("/batch/{service_id}/{data_type}/", response_model=schemas.CommentsBatch, tags=["comments"])
+async def get_comments_batch(service_id: uuid.UUID,
+                             data_type: schemas.DataType,
+                             signature: str,
+                             item_id: List[str] = Query(..., max_items=COMMENTS_BATCH_MAX_ITEMS),
+                             presentation: Optional[schemas.PresentationList] = schemas.PresentationList.tree,
+                             scope: Optional[schemas.Scope] = schemas.Scope.all,
+                             limit: int = Query(COMMENTS_PAGE_LIMIT, ge=1, le=COMMENTS_PAGE_MAX_LIMIT),
+                             db: AsyncSession = Depends(get_read_db)):
+    """
+    Запрос комментариев нескольких страниц
+    ======================================
+
+    Отдает последние комментарии сразу для нескольких страниц одного сервиса одним запросом к БД,
+    например для превью комментариев в списке материалов.
+
+    Параметры строки запроса:
+
+    - **service_id**: Идентификатор сервиса, который запрашивает комментарии. При отсутствии сервиса в БД будет получена
+                        ошибка. Сервис должен быть предварительно зарегистрирован в БД.
+    - **data_type**: Определяет тип запрашиваемых данных
+
+    Опции запроса:
+
+    - **item_id**: Идентификаторы страниц, параметр повторяется для каждой страницы
+    - **signature**: Подпись данных на основе токена сервиса, в качестве идентификатора страницы подписываются
+                   идентификаторы всех страниц через запятую в порядке их указания в запросе
+    - **presentation**: Вид отображения (древовидный или плоский), определяет сортировку комментариев внутри страницы.
+                      Вложенный вид и вид roots не поддерживаются и отдаются как древовидный.
+    - **scope**: Область видимости комментариев, если не указана, по умолчанию все.
+    - **limit**: Количество последних комментариев для каждой страницы
+    """
+    if await signer.check_signs(db=db,
+                                received_signature=signature,
+                                service_id=service_id,
+                                data_type=data_type,
+                                item_id=','.join(item_id)):
+        # повторяющиеся идентификаторы отбрасываем с сохранением порядка
+        item_ids = list(dict.fromkeys(item_id))
+        try:
+            # комментарии архивных страниц читаются из архива отдельным запросом
+            archived = await crud.get_archived_items(db=db, service_id=service_id, data_type=data_type,
+                                                     item_ids=item_ids)
+            hot_ids = [item for item in item_ids if item not in archived]
+            archived_ids = [item for item in item_ids if item in archived]
+            comments = []
+            for item_ids_part, is_archived in ((hot_ids, False), (archived_ids, True)):
+                if item_ids_part:
+                    comments += await crud.get_latest_comments_for_items(db=db,
+                                                                         service_id=service_id,
+                                                                         data_type=data_type,
+                                                                         item_ids=item_ids_part,
+                                                                         scope=scope,
+                                                                         presentation=presentation,
+                                                                         limit=limit,
+                                                                         archived=is_archived)
+        except SQLAlchemyError as err:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(err.__dict__['orig']))
+        await db.close()
+        return Response(content=convertors.comments_batch_2_json(item_ids, comments), media_type='application/json')
+    else:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='incorrect signature')
+
+# получение счетчиков комментариев нескольких страниц
+# (маршрут объявлен до получения комментариев страницы по той же причине)
+@router.get("/count/{service_id}/{data_type}/", response_model=schemas.CommentsCountBatch, tags=["comments"])
+async def get_comments_count_batch(service_id: uuid.UUID,
+                                   data_type: schemas.DataType,
+                                   signature: str,
+                                   item_id: List[str] = Query(..., max_items=COMMENTS_BATCH_MAX_ITEMS),
+                                   scope: Optional[schemas.Scope] = schemas.Scope.all,
+                                   db: AsyncSession = Depends(get_read_db)):
+    """
+    Запрос счетчиков комментариев нескольких страниц
+    ================================================
+
+    Отдает количество комментариев сразу для нескольких страниц одного сервиса, например для списка материалов.
+    Счетчики хранятся в отдельной таблице и не требуют подсчета комментариев.
+
+    Параметры строки запроса:
+
+    - **service_id**: Идентификатор сервиса, который запрашивает комментарии. При отсутствии сервиса в БД будет получена
+                        ошибка. Сервис должен быть предварительно зарегистрирован в БД.
+    - **data_type**: Определяет тип запрашиваемых данных
+
+    Опции запроса:
+
+    - **item_id**: Идентификаторы страниц, параметр повторяется для каждой страницы
+    - **signature**: Подпись данных на основе токена сервиса, в качестве идентификатора страницы подписываются
+                   идентификаторы всех страниц через запятую в порядке их указания в запросе
+    - **scope**: Область видимости комментариев, если не указана, по умолчанию все.
+    """
+    if await signer.check_signs(db=db,
+                                received_signature=signature,
+                                service_id=service_id,
+                                data_type=data_type,
+                                item_id=','.join(item_id)):
+        item_ids = list(dict.fromkeys(item_id))
+        counters = await crud.get_counters(db=db, service_id=service_id, data_type=data_type,
+                                           item_ids=item_ids, scope=scope)
+        # страницы без комментариев отдаются с нулевыми счетчиками
+        return schemas.CommentsCountBatch(items={item: schemas.CommentsCount.from_orm(counters[item])
+                                                 if item in counters else schemas.CommentsCount()
+                                                 for item in item_ids})
+    else:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='incorrect signature')
+
+# получение счетчиков комментариев страницы
+@router.get("/count/{service_id}/{data_type}/{item_id}/", response_model=schemas.CommentsCount, tags=["comments"])
+async def get_comments_count(service_id: uuid.UUID,
+                             data_type: schemas.DataType,
+                             item_id: str,
+                             signature: str,
+                             scope: Optional[schemas.Scope] = schemas.Scope.all,
+                             db: AsyncSession = Depends(get_read_db)):
+    """
+    Запрос счетчиков комментариев страницы
+    ======================================
+
+    Параметры строки запроса:
+
+    - **service_id**: Идентификатор сервиса, который запрашивает комментарии. При отсутствии сервиса в БД будет получена
+                        ошибка. Сервис должен быть предварительно зарегистрирован в БД.
+    - **data_type**: Определяет тип запрашиваемых данных
+    - **item_id**: Идентификатор страницы, для которой запрашиваются комментарии
+
+    Опции запроса:
+
+    - **signature**: Подпись данных на основе токена сервиса
+    - **scope**: Область видимости комментариев, если не указана, по умолчанию все.
+    """
+    if await signer.check_signs(db=db,
+                                received_signature=signature,
+                                service_id=service_id,
+                                data_type=data_type,
+                                item_id=item_id):
+        counters = await crud.get_counters(db=db, service_id=service_id, data_type=data_type,
+                                           item_ids=[item_id], scope=scope)
+        if item_id in counters:
+            return schemas.CommentsCount.from_orm(counters[item_id])
+        return schemas.CommentsCount()
+    else:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='incorrect signature')
+
+# получение комментариев (схема ответа зависит от вида отображения)
+@router.get("/{service_id}/{data_type}/{item_id}/",
+            response_model=Union[schemas.CommentsPage, schemas.NestedCommentsPage, schemas.RootsPage],
+            tags=["comments"])
+async def get_comments(service_id: uuid.UUID,
+                       data_type: schemas.DataType,
+                       item_id: str,
+                       signature: str,
+                       presentation: Optional[schemas.PresentationList] = schemas.PresentationList.tree,
+                       scope: Optional[schemas.Scope] = schemas.Scope.all,
+                       parent_id: Optional[int] = None,
+                       limit: int = Query(COMMENTS_PAGE_LIMIT, ge=1, le=COMMENTS_PAGE_MAX_LIMIT),
+                       cursor: Optional[str] = None,
+                       stream: bool = False,
+                       since: Optional[str] = None,
+                       preview: int = Query(COMMENTS_ROOTS_PREVIEW, ge=0, le=COMMENTS_ROOTS_MAX_PREVIEW),
+                       max_depth: Optional[int] = Query(None, ge=1),
+                       branch_limit: Optional[int] = Query(None, ge=1),
+                       if_none_match: Optional[str] = Header(None),
+                       db: AsyncSession = Depends(get_read_db)):
     """
     Запрос комментариев
     ====================
@@ -115,49 +320,376 @@ def get_comments(service_id: uuid.UUID,
     Опции запроса:
 
     - **signature**: Подпись данных на основе токена сервиса
-    - **presentation**: Определяет вид отображения комментариев (древовидный или плоский), влияет на сортировку
-                      отдаваемых комментариев, если не указан, по умолчанию древовидный.
+    - **presentation**: Определяет вид отображения комментариев (древовидный, плоский или вложенный), влияет на
+                      сортировку отдаваемых комментариев, если не указан, по умолчанию древовидный. Во вложенном виде
+                      ответы к комментарию отдаются в его поле children, комментарии, родитель которых остался на
+                      предыдущей странице, отдаются на верхнем уровне. В виде roots отдаются только комментарии
+                      первого уровня (или прямые ответы на parent_id) с количеством прямых ответов (replies_count)
+                      и первыми из них (replies), остальные ответы запрашиваются по мере раскрытия веток
+                      с parent_id, стоимость запроса не зависит от размера обсуждения.
     - **scope**: Область видимости комментариев, если не указана, по умолчанию все.
     - **parent_id**: идентификатор родительского комментария (необязательный, если указан, выведутся дочерние
                    комментарии)
+    - **limit**: Количество комментариев на странице
+    - **cursor**: Курсор страницы (значение next_cursor из предыдущего ответа), если не указан, отдается первая
+                страница
+    - **stream**: Потоковая отдача всех комментариев, начиная с курсора (limit не применяется, next_cursor всегда
+                пустой), подходит для больших обсуждений
+    - **since**: Токен изменений (значение changes_token из предыдущего ответа) или дата в формате ISO 8601.
+               Отдаются только комментарии, созданные, измененные или удаленные после него, в порядке изменения
+               (presentation, cursor и stream не учитываются), и новый changes_token. Если изменений больше limit,
+               ответ содержит next_cursor, и запрос нужно повторить с since=changes_token. Последние изменения
+               могут прийти повторно, клиент должен заменять комментарии по id.
+    - **preview**: Количество первых прямых ответов, отдаваемых с каждым комментарием в виде roots
+    - **max_depth**: Отдавать комментарии не глубже указанного числа уровней от parent_id (или от начала обсуждения)
+    - **branch_limit**: Для древовидного и вложенного вида: отдавать у каждого комментария не больше указанного
+                      числа первых ответов, limit в этом случае задает количество комментариев первого уровня,
+                      отдаваемых вместе с их ответами, а глубина ограничивается max_depth (по умолчанию
+                      COMMENTS_BRANCH_DEPTH уровней). Потоковая отдача в этом режиме и в виде roots не применяется.
+
+    Ответ содержит заголовок ETag с версией комментариев страницы. Если передать ее в заголовке If-None-Match,
+    а комментарии с тех пор не менялись, будет получен ответ 304 без тела.
     """
 
-    if signer.check_signs(db=db,
-                          received_signature=signature,
-                          service_id=service_id,
-                          data_type=data_type,
-                          item_id=item_id):
-        comments_list = []
+    if await signer.check_signs(db=db,
+                                received_signature=signature,
+                                service_id=service_id,
+                                data_type=data_type,
+                                item_id=item_id):
+        if branch_limit and presentation == schemas.PresentationList.flat:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail='branch_limit is not supported for flat presentation')
         try:
-            comments = crud.get_comments(db=db,
-                                 service_id=service_id,
-                                 data_type=data_type,
-                                 item_id=item_id,
-                                 presentation=presentation,
-                                 parent_id=parent_id,
-                                 scope=scope)
-        except NoResultFound:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="no data found with these parameters")
-        except SQLAlchemyError as err:
-            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(err.__dict__['orig']))
-        for comment in comments:
-            # в ответе от crud.get_comments объект, где в каждом элементе два объекта,
-            # первый это models.Comments, а второй models.User
-            comment_out = convertors.comment_db_2_out(comment[0], comment[1])
-            comments_list.append(comment_out)
-        return comments_list
+            after = convertors.decode_cursor(presentation, cursor) if cursor and not since else None
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='invalid cursor')
+        try:
+            since_key = convertors.decode_changes_token(since) if since else None
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='invalid changes token')
+        # версия комментариев страницы увеличивается при каждом их изменении, если у клиента
+        # актуальная версия, отвечаем 304 не читая и не сериализуя комментарии
+        item_version = await crud.get_item_version(db=db, service_id=service_id, data_type=data_type, item_id=item_id)
+        version = item_version.version if item_version else 0
+        # комментарии страниц без активности перенесены в архив (см. crud.archive_items)
+        archived = item_version is not None and item_version.is_archived
+        etag = convertors.version_2_etag(version)
+        if convertors.etag_matches(if_none_match, etag):
+            await db.close()
+            return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+        if since_key:
+            # ответы на запрос изменений не кэшируются: токены у клиентов разные, а ответы малы и читаются по индексу
+            body = await read_comments_changes(db=db,
+                                               service_id=service_id,
+                                               data_type=data_type,
+                                               item_id=item_id,
+                                               scope=scope,
+                                               parent_id=parent_id,
+                                               limit=limit,
+                                               since=since_key,
+                                               archived=archived)
+            return Response(content=body, media_type='application/json', headers={'ETag': etag})
+        # токен, с которым клиент запросит изменения после этого ответа (дата изменения страницы
+        # с тем же отступом, что и у токенов запроса изменений)
+        changes_token = None
+        if item_version is not None:
+            changes_token = convertors.encode_changes_token(
+                item_version.date_modified - timedelta(seconds=COMMENTS_CHANGES_OVERLAP), 0)
+        # ответы в виде roots и с ограничением веток собираются из нескольких запросов и не отдаются потоком
+        if stream and not branch_limit and presentation != schemas.PresentationList.roots:
+            try:
+                query = await crud.comments_query(db=db,
+                                                  service_id=service_id,
+                                                  data_type=data_type,
+                                                  item_id=item_id,
+                                                  presentation=presentation,
+                                                  parent_id=parent_id,
+                                                  scope=scope,
+                                                  after=after,
+                                                  archived=archived,
+                                                  max_depth=max_depth)
+            except NoResultFound:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="no data found with these parameters")
+            if presentation == schemas.PresentationList.nested:
+                encoder = convertors.NestedCommentsJsonEncoder()
+            else:
+                encoder = convertors.CommentsJsonEncoder()
+            return StreamingResponse(stream_comments_page(db=db, query=query, encoder=encoder,
+                                                          changes_token=changes_token),
+                                     media_type='application/json',
+                                     headers={'ETag': etag})
+        # в кэше хранится уже сериализованный ответ, ключ зависит от версии страницы
+        cache_key = comments_cache.page_key(service_id, data_type, item_id, version,
+                                            scope=scope.value,
+                                            presentation=presentation.value,
+                                            parent_id=parent_id,
+                                            limit=limit,
+                                            cursor=cursor,
+                                            preview=preview,
+                                            max_depth=max_depth,
+                                            branch_limit=branch_limit)
+
+        # страница читается в отдельной сессии: выполнение общее для всех ожидающих запросов и продолжается,
+        # даже если запрос, который его начал, отменен и его сессия закрыта. Сессия открывается в той же БД,
+        # из которой прочитана версия страницы (в основной для клиентов, закрепленных за ней), чтобы ответ
+        # под ключом с версией не был прочитан из отстающей реплики
+        page_engine = db.bind
+
+        async def read_and_cache():
+            async with SessionLocal(bind=page_engine) as page_db:
+                body = await read_comments_page(db=page_db,
+                                                service_id=service_id,
+                                                data_type=data_type,
+                                                item_id=item_id,
+                                                presentation=presentation,
+                                                scope=scope,
+                                                parent_id=parent_id,
+                                                limit=limit,
+                                                after=after,
+                                                archived=archived,
+                                                changes_token=changes_token,
+                                                preview=preview,
+                                                max_depth=max_depth,
+                                                branch_limit=branch_limit)
+                await comments_cache.set(cache_key, body)
+                return body
+
+        body = await comments_cache.get(cache_key)
+        # соединение запроса для чтения страницы больше не нужно
+        await db.close()
+        if body is None:
+            # страницу читает из БД первый из одновременных запросов, остальные ждут его ответ
+            body = await comments_flight.do(cache_key, read_and_cache)
+        return Response(content=body, media_type='application/json', headers={'ETag': etag})
+    else:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='incorrect signature')
+
+
+# чтение страницы комментариев из БД, возвращает сериализованный ответ
+async def read_comments_page(db: AsyncSession,
+                             service_id: uuid.UUID,
+                             data_type: schemas.DataType,
+                             item_id: str,
+                             presentation: schemas.PresentationList,
+                             scope: schemas.Scope,
+                             parent_id: Optional[int],
+                             limit: int,
+                             after: Optional[tuple],
+                             archived: bool = False,
+                             changes_token: Optional[str] = None,
+                             preview: int = 0,
+                             max_depth: Optional[int] = None,
+                             branch_limit: Optional[int] = None):
+    if presentation == schemas.PresentationList.roots:
+        return await read_roots_page(db=db, service_id=service_id, data_type=data_type, item_id=item_id,
+                                     scope=scope, parent_id=parent_id, limit=limit, after=after, preview=preview,
+                                     archived=archived, changes_token=changes_token)
+    try:
+        # запрашиваем на одну строку (на один комментарий первого уровня) больше,
+        # чтобы понять, есть ли следующая страница
+        if branch_limit:
+            comments = await crud.get_branches(db=db,
+                                               service_id=service_id,
+                                               data_type=data_type,
+                                               item_id=item_id,
+                                               scope=scope,
+                                               branch_limit=branch_limit,
+                                               max_depth=max_depth or COMMENTS_BRANCH_DEPTH,
+                                               parent_id=parent_id,
+                                               limit=limit + 1,
+                                               after=after,
+                                               archived=archived)
+        else:
+            comments = await crud.get_comments(db=db,
+                                               service_id=service_id,
+                                               data_type=data_type,
+                                               item_id=item_id,
+                                               presentation=presentation,
+                                               parent_id=parent_id,
+                                               scope=scope,
+                                               limit=limit + 1,
+                                               after=after,
+                                               archived=archived,
+                                               max_depth=max_depth)
+    except NoResultFound:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="no data found with these parameters")
+    except SQLAlchemyError as err:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(err.__dict__['orig']))
+    # соединение возвращается в пул до сериализации и отправки ответа,
+    # чтобы медленные клиенты не удерживали соединения с БД
+    await db.close()
+    next_cursor = None
+    if branch_limit:
+        # страница заканчивается перед limit + 1-м комментарием первого уровня, курсор - путь последнего
+        # отданного ответа: следующий комментарий первого уровня идет после всех ответов предыдущего
+        first_level = comments[0].level if comments else 0
+        roots = 0
+        for index, comment in enumerate(comments):
+            if comment.level == first_level:
+                roots += 1
+                if roots > limit:
+                    comments = comments[:index]
+                    next_cursor = convertors.encode_cursor(presentation, comments[-1])
+                    break
+    elif len(comments) > limit:
+        comments = comments[:limit]
+        next_cursor = convertors.encode_cursor(presentation, comments[-1])
+    # строки сразу сериализуются в json, без промежуточных pydantic-моделей и повторной валидации ответа
+    if presentation == schemas.PresentationList.nested:
+        return convertors.nested_comments_page_2_json(comments, next_cursor, changes_token)
+    return convertors.comments_page_2_json(comments, next_cursor, changes_token)
+
+
+# чтение страницы комментариев в виде roots из БД, возвращает сериализованный ответ
+async def read_roots_page(db: AsyncSession,
+                          service_id: uuid.UUID,
+                          data_type: schemas.DataType,
+                          item_id: str,
+                          scope: schemas.Scope,
+                          parent_id: Optional[int],
+                          limit: int,
+                          after: Optional[tuple],
+                          preview: int,
+                          archived: bool = False,
+                          changes_token: Optional[str] = None):
+    try:
+        roots, replies = await crud.get_roots(db=db,
+                                              service_id=service_id,
+                                              data_type=data_type,
+                                              item_id=item_id,
+                                              scope=scope,
+                                              parent_id=parent_id,
+                                              limit=limit + 1,
+                                              after=after,
+                                              preview=preview,
+                                              archived=archived)
+    except NoResultFound:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="no data found with these parameters")
+    except SQLAlchemyError as err:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(err.__dict__['orig']))
+    await db.close()
+    next_cursor = None
+    if len(roots) > limit:
+        roots = roots[:limit]
+        next_cursor = convertors.encode_cursor(schemas.PresentationList.roots, roots[-1])
+    return convertors.roots_page_2_json(roots, replies, next_cursor, changes_token)
+
+
+# чтение изменений комментариев страницы из БД, возвращает сериализованный ответ
+async def read_comments_changes(db: AsyncSession,
+                                service_id: uuid.UUID,
+                                data_type: schemas.DataType,
+                                item_id: str,
+                                scope: schemas.Scope,
+                                parent_id: Optional[int],
+                                limit: int,
+                                since: tuple,
+                                archived: bool = False):
+    try:
+        comments = await crud.get_comments(db=db,
+                                           service_id=service_id,
+                                           data_type=data_type,
+                                           item_id=item_id,
+                                           parent_id=parent_id,
+                                           scope=scope,
+                                           limit=limit + 1,
+                                           archived=archived,
+                                           since=since)
+    except NoResultFound:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="no data found with these parameters")
+    except SQLAlchemyError as err:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(err.__dict__['orig']))
+    await db.close()
+    next_cursor = None
+    if len(comments) > limit:
+        # изменения не поместились в ответ: следующий запрос продолжит точно с последнего отданного
+        comments = comments[:limit]
+        changes_token = next_cursor = convertors.encode_changes_token(comments[-1].date_modified, comments[-1].id)
+    elif comments:
+        # транзакция, начатая раньше последнего изменения, может зафиксироваться позже него,
+        # поэтому следующий запрос повторно просматривает последние COMMENTS_CHANGES_OVERLAP секунд
+        rewound = comments[-1].date_modified - timedelta(seconds=COMMENTS_CHANGES_OVERLAP)
+        changes_token = convertors.encode_changes_token(*max(since, (rewound, 0)))
+    else:
+        changes_token = convertors.encode_changes_token(*since)
+    return convertors.comments_page_2_json(comments, next_cursor, changes_token)
+
+
+# потоковая отдача комментариев: строки читаются из БД через серверный курсор пачками
+# и сразу отправляются клиенту, поэтому память на запрос не зависит от числа комментариев
+async def stream_comments_page(db: AsyncSession, query, encoder: convertors.CommentsJsonEncoder,
+                               changes_token: Optional[str] = None):
+    yield encoder.start()
+    async for rows in crud.stream_comments(db=db, query=query, batch_size=COMMENTS_STREAM_BATCH_SIZE):
+        yield encoder.feed(rows)
+    yield encoder.finish(changes_token=changes_token)
+
+
+# подписка на изменения комментариев страницы
+@router.get("/{service_id}/{data_type}/{item_id}/events/", tags=["comments"])
+async def subscribe_comments(service_id: uuid.UUID,
+                             data_type: schemas.DataType,
+                             signature: str,
+                             item_id: str = Query(..., regex="^.*$"),
+                             scope: Optional[schemas.Scope] = schemas.Scope.all,
+                             db: AsyncSession = Depends(get_read_db)):
+    """
+    Подписка на изменения комментариев
+    ==================================
+
+    Поток Server-Sent Events (text/event-stream) с изменениями комментариев страницы вместо периодического
+    перечитывания комментариев.
+
+    Параметры строки запроса:
+
+    - **service_id**: Идентификатор сервиса, который запрашивает комментарии.
+    - **data_type**: Определяет тип запрашиваемых данных
+    - **item_id**: Идентификатор страницы, на комментарии которой оформляется подписка
+
+    Опции запроса:
+
+    - **signature**: Подпись данных на основе токена сервиса (как при получении комментариев страницы)
+    - **scope**: Область видимости комментариев, если не указана, по умолчанию все.
+
+    События:
+
+    - **ready**: подписка оформлена, изменения после этого события будут доставлены
+    - **create**, **update**: новый или измененный комментарий в поле comment (схема CommentOut)
+    - **delete**: комментарий с идентификатором id удален (или перенесен в другую область видимости)
+    - **reload**: часть событий могла быть пропущена, комментарии страницы нужно перечитать
+
+    При простое отправляются keep-alive комментарии SSE.
+    """
+    if await signer.check_signs(db=db,
+                                received_signature=signature,
+                                service_id=service_id,
+                                data_type=data_type,
+                                item_id=item_id):
+        # соединение с БД на время подписки не удерживается
+        await db.close()
+        if not await event_hub.ready():
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail='events are unavailable')
+        return StreamingResponse(events.sse_stream(hub=event_hub,
+                                                   service_id=service_id,
+                                                   data_type=data_type.value,
+                                                   item_id=item_id,
+                                                   scope=scope.value),
+                                 media_type='text/event-stream',
+                                 # X-Accel-Buffering отключает буферизацию ответа в nginx
+                                 headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
     else:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='incorrect signature')
 
 
 # изменение комментария
 @router.put("/{service_id}/{data_type}/{item_id}/{comment_id}/", status_code=status.HTTP_200_OK, tags=["comments"])
-def update_comment(updated_comment: schemas.CommentUpdate,
-                    service_id: uuid.UUID,
-                    data_type: schemas.DataType,
-                    comment_id: int,
-                    item_id: str = Query(..., regex="^.*$"),
-                    db: Session = Depends(get_db)):
+async def update_comment(updated_comment: schemas.CommentUpdate,
+                         service_id: uuid.UUID,
+                         data_type: schemas.DataType,
+                         comment_id: int,
+                         response: Response,
+                         item_id: str = Query(..., regex="^.*$"),
+                         db: AsyncSession = Depends(get_db)):
     """
         Изменение комментария
         ====================
@@ -179,11 +711,11 @@ def update_comment(updated_comment: schemas.CommentUpdate,
         - **signature**: Подпись данных на основе токена сервиса
         """
 
-    if signer.check_signs(db=db,
-                          received_signature=updated_comment.signature,
-                          service_id=service_id,
-                          data_type=data_type,
-                          item_id=item_id):
+    if await signer.check_signs(db=db,
+                                received_signature=updated_comment.signature,
+                                service_id=service_id,
+                                data_type=data_type,
+                                item_id=item_id):
 
         updated_comment_dict = updated_comment.dict()
         if not updated_comment_dict['comment_text']:
@@ -191,12 +723,13 @@ def update_comment(updated_comment: schemas.CommentUpdate,
         elif not updated_comment_dict['scope']:
             updated_comment_dict.pop('scope')
         try:
-            crud.update_comment(db=db,
-                                service_id=service_id,
-                                data_type=data_type,
-                                item_id=item_id,
-                                id=comment_id,
-                                updated_comment=updated_comment_dict)
+            await crud.update_comment(db=db,
+                                      service_id=service_id,
+                                      data_type=data_type,
+                                      item_id=item_id,
+                                      id=comment_id,
+                                      updated_comment=updated_comment_dict)
+            pin_reads_to_primary(response)
 
         except SQLAlchemyError as err:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(err.__dict__['orig']))
@@ -205,12 +738,12 @@ def update_comment(updated_comment: schemas.CommentUpdate,
 
 # удаление комментария
 @router.delete("/{service_id}/{data_type}/{item_id}/{comment_id}/", status_code=status.HTTP_204_NO_CONTENT, tags=["comments"])
-def delete_comment(service_id: uuid.UUID,
-                   data_type: schemas.DataType,
-                   comment_id: int,
-                   signature: schemas.SignatureDelete,
-                   item_id: str = Query(..., regex="^.*$"),
-                   db: Session = Depends(get_db)):
+async def delete_comment(service_id: uuid.UUID,
+                         data_type: schemas.DataType,
+                         comment_id: int,
+                         signature: schemas.SignatureDelete,
+                         item_id: str = Query(..., regex="^.*$"),
+                         db: AsyncSession = Depends(get_db)):
     """
             Удаление комментария
             ====================
@@ -227,18 +760,20 @@ def delete_comment(service_id: uuid.UUID,
 
             - **signature**: Подпись данных на основе токена сервиса
             """
-    if signer.check_signs(db=db,
-                          received_signature=signature.signature,
-                          service_id=service_id,
-                          data_type=data_type,
-                          item_id=item_id):
-        try:
-            crud.delete_comment(db=db,
+    if await signer.check_signs(db=db,
+                                received_signature=signature.signature,
                                 service_id=service_id,
                                 data_type=data_type,
-                                item_id=item_id,
-                                id=comment_id)
-            return Response(status_code=status.HTTP_204_NO_CONTENT)
+                                item_id=item_id):
+        try:
+            await crud.delete_comment(db=db,
+                                      service_id=service_id,
+                                      data_type=data_type,
+                                      item_id=item_id,
+                                      id=comment_id)
+            response = Response(status_code=status.HTTP_204_NO_CONTENT)
+            pin_reads_to_primary(response)
+            return response
 
         except NoResultFound as err:
             raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='no data found with these parameters')
@@ -246,24 +781,224 @@ def delete_comment(service_id: uuid.UUID,
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='incorrect signature')
 
 
+# импорт комментариев с другой платформы
+@router.post("/import/{service_id}/", response_model=schemas.ImportResult, tags=["import"])
+async def import_comments(request: Request,
+                          response: Response,
+                          service_id: uuid.UUID,
+                          signature: str,
+                          db: AsyncSession = Depends(get_db)):
+    """
+    Импорт комментариев
+    ===================
+
+    Массовая загрузка комментариев с другой платформы с сохранением иерархии ответов.
+    Тело запроса - NDJSON, по одному комментарию в строке (формат описан в app/comment/importer.py),
+    читается потоково и загружается пачками, каждая пачка в своей транзакции.
+    Уже загруженные комментарии пропускаются, поэтому после ошибки запрос можно повторить с теми же данными.
+
+    Параметры строки запроса:
+
+    - **service_id**: Идентификатор сервиса, для которого импортируются комментарии.
+
+    Опции запроса:
+
+    - **signature**: Подпись данных на основе токена сервиса, подписывается service_id + 'import'
+    """
+    if await signer.check_signs(db=db,
+                                received_signature=signature,
+                                service_id=service_id,
+                                data_type='import',
+                                item_id=''):
+        try:
+            result = await importer.import_comments(db=db,
+                                                    service_id=service_id,
+                                                    lines=importer.iter_lines(request.stream()),
+                                                    chunk_size=COMMENTS_IMPORT_CHUNK_SIZE)
+            pin_reads_to_primary(response)
+            return result
+        except importer.ImportLineError as err:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(err))
+        except SQLAlchemyError as err:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(err.__dict__['orig']))
+    else:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='incorrect signature')
+
+# выгрузка комментариев сервиса
+@router.get("/export/{service_id}/", tags=["import"])
+async def export_comments(service_id: uuid.UUID,
+                          signature: str,
+                          format: schemas.ExportFormat = schemas.ExportFormat.ndjson,
+                          data_type: Optional[schemas.DataType] = None,
+                          created_from: Optional[datetime] = None,
+                          created_to: Optional[datetime] = None,
+                          modified_since: Optional[datetime] = None,
+                          db: AsyncSession = Depends(get_read_db)):
+    """
+    Выгрузка комментариев
+    =====================
+
+    Потоковая выгрузка всех комментариев сервиса (например, для аналитики) в формате NDJSON или CSV.
+    Текст удаленных комментариев не выгружается.
+
+    Параметры строки запроса:
+
+    - **service_id**: Идентификатор сервиса, комментарии которого выгружаются.
+
+    Опции запроса:
+
+    - **signature**: Подпись данных на основе токена сервиса, подписывается service_id + 'export'
+    - **format**: Формат выгрузки: ndjson (по умолчанию) или csv
+    - **data_type**: Выгружать только комментарии указанного типа данных
+    - **created_from**, **created_to**: Выгружать только комментарии, созданные в периоде [created_from, created_to)
+    - **modified_since**: Выгружать только комментарии, измененные начиная с указанной даты (инкрементальная выгрузка)
+    """
+    if await signer.check_signs(db=db,
+                                received_signature=signature,
+                                service_id=service_id,
+                                data_type='export',
+                                item_id=''):
+        return StreamingResponse(exporter.export_comments(db=db,
+                                                          service_id=service_id,
+                                                          export_format=format,
+                                                          batch_size=COMMENTS_STREAM_BATCH_SIZE,
+                                                          data_type=data_type,
+                                                          created_from=created_from,
+                                                          created_to=created_to,
+                                                          modified_since=modified_since),
+                                 media_type=exporter.MEDIA_TYPES[format])
+    else:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='incorrect signature')
+
+# поиск комментариев сервиса по тексту
+@router.get("/search/{service_id}/", response_model=schemas.SearchPage, tags=["search"])
+async def search_comments(service_id: uuid.UUID,
+                          signature: str,
+                          q: str = Query(..., min_length=1, max_length=500),
+                          order: schemas.SearchOrder = schemas.SearchOrder.rank,
+                          data_type: Optional[schemas.DataType] = None,
+                          item_id: Optional[str] = None,
+                          user: Optional[str] = None,
+                          created_from: Optional[datetime] = None,
+                          created_to: Optional[datetime] = None,
+                          include_deleted: bool = False,
+                          limit: int = Query(COMMENTS_PAGE_LIMIT, ge=1, le=COMMENTS_PAGE_MAX_LIMIT),
+                          cursor: Optional[str] = None,
+                          db: AsyncSession = Depends(get_read_db)):
+    """
+    Поиск комментариев
+    ==================
+
+    Полнотекстовый поиск по тексту комментариев сервиса, включая архивные, например для модерации.
+
+    Параметры строки запроса:
+
+    - **service_id**: Идентификатор сервиса, комментарии которого ищутся.
+
+    Опции запроса:
+
+    - **signature**: Подпись данных на основе токена сервиса, подписывается service_id + 'search'
+    - **q**: Строка поиска: слова, "точная фраза", or между вариантами, -исключаемое слово
+    - **order**: Сортировка: rank - по релевантности (по умолчанию), date - сначала новые
+    - **data_type**, **item_id**: Искать только в комментариях указанного типа данных и страницы
+    - **user**: Искать только в комментариях пользователя с указанным внешним идентификатором
+    - **created_from**, **created_to**: Искать только в комментариях, созданных в периоде [created_from, created_to)
+    - **include_deleted**: Искать и в удаленных комментариях (их текст в ответе не отдается)
+    - **limit**: Количество комментариев на странице
+    - **cursor**: Курсор следующей страницы из поля next_cursor предыдущего ответа
+    """
+    if await signer.check_signs(db=db,
+                                received_signature=signature,
+                                service_id=service_id,
+                                data_type='search',
+                                item_id=''):
+        try:
+            after = convertors.decode_search_cursor(order, cursor) if cursor else None
+        except ValueError:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='invalid cursor')
+        try:
+            # запрашиваем на одну строку больше, чтобы понять, есть ли следующая страница
+            comments = await crud.search_comments(db=db,
+                                                  service_id=service_id,
+                                                  query=q,
+                                                  order=order,
+                                                  data_type=data_type,
+                                                  item_id=item_id,
+                                                  user_external_id=user,
+                                                  created_from=convertors.naive_utc(created_from),
+                                                  created_to=convertors.naive_utc(created_to),
+                                                  include_deleted=include_deleted,
+                                                  limit=limit + 1,
+                                                  after=after)
+        except SQLAlchemyError as err:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(err.__dict__['orig']))
+        await db.close()
+        next_cursor = None
+        if len(comments) > limit:
+            comments = comments[:limit]
+            next_cursor = convertors.encode_search_cursor(order, comments[-1])
+        return Response(content=convertors.search_page_2_json(comments, next_cursor), media_type='application/json')
+    else:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='incorrect signature')
+
 # временно для отладки для регистрации сервиса и для получения данных по названию сервиса
 # =======================================================================================
 # регистрация сервиса
 @router.post("/service/", response_model=schemas.Service, tags=["service"])
-def create_service(service_name: str, db: Session = Depends(get_db)):
+async def create_service(service_name: str, db: AsyncSession = Depends(get_db)):
     if service_name.strip() == '':
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='invalid service name')
     try:
-        service_row =  crud.create_service(service_name=service_name, db=db)
+        service_row = await crud.create_service(service_name=service_name, db=db)
     except SQLAlchemyError as err:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(err.__dict__['orig']))
+    signer.token_cache.invalidate(service_row.id)
+    return service_row
+
+# замена токена сервиса
+@router.put("/service/{service_id}/token/", response_model=schemas.Service, tags=["service"])
+async def update_service_token(service_id: uuid.UUID, signature: str, db: AsyncSession = Depends(get_db)):
+    """
+    Замена токена сервиса
+    =====================
+
+    Запрос подписывается текущим токеном сервиса, подписывается service_id + 'token'.
+    После замены процесс, выполнивший запрос, сразу отклоняет подписи старым токеном, остальные процессы
+    принимают старый токен, пока он не устареет в их кэше (до SERVICE_TOKEN_CACHE_TTL секунд).
+    """
+    try:
+        signed = await signer.check_signs(db=db,
+                                          received_signature=signature,
+                                          service_id=service_id,
+                                          data_type='token',
+                                          item_id='')
+    except NoResultFound:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='service not found')
+    if not signed:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail='incorrect signature')
+    try:
+        service_row = await crud.update_service_token(service_id=service_id, db=db)
+    except NoResultFound:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail='service not found')
+    signer.token_cache.invalidate(service_id)
     return service_row
 
 # получение данных сервиса по названию
 @router.get("/service/", response_model=schemas.Service, tags=["service"])
-def get_service_by_name(service_name: str, db: Session = Depends(get_db)):
+async def get_service_by_name(service_name: str, db: AsyncSession = Depends(get_read_db)):
     try:
-        service_row = crud.get_service_by_name(service_name=service_name, db=db)
+        service_row = await crud.get_service_by_name(service_name=service_name, db=db)
     except NoResultFound:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'service with name {service_name} not found')
     return service_row
+
+# статистика кэшей и пула соединений процесса
+@router.get("/service/stats/", tags=["service"])
+async def get_stats():
+    return {'token_cache': signer.token_cache.stats(),
+            'users_cache': crud.user_cache.stats(),
+            'comments_cache': comments_cache.stats(),
+            'comments_singleflight': comments_flight.stats(),
+            'db_pool': pool_stats(engine.sync_engine.pool),
+            'db_replica_pools': [pool_stats(replica.sync_engine.pool) for replica in replica_engines],
+            'events': event_hub.stats()}
@@ -1,180 +1,1186 @@
+import asyncio
+import secrets
 import uuid
+from datetime import datetime
+from typing import List
 
-from sqlalchemy import func
-from sqlalchemy.orm import Session
+import orjson
+from sqlalchemy import (Integer, String, any_, bindparam, case, cast, func, literal_column, select, text, true, tuple_,
+                        union_all, update)
+from sqlalchemy.dialects.postgresql import ARRAY, UUID, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+from sqlalchemy_utils import Ltree
 
 from app.comment import models
 from app.comment import schemas
+from app.core.config import COMMENTS_EVENTS_CHANNEL, COMMENTS_SEARCH_LANGUAGE, USERS_CACHE_SIZE, USERS_CACHE_TTL
+from app.utils.cache import TTLCache
+
+
+# Вставка комментария одним запросом: в одной транзакции и за одно обращение к БД
+# сохраняется (или обновляется) пользователь, находится путь родителя, из последовательности
+# берется id, по нему вычисляются path и level, увеличиваются версия и счетчики страницы, отправляется событие
+# подписчикам страницы (см. notify_event). Если родитель указан, но не найден
+# (или относится к другой странице), запрос не вернет ни одной строки. Родитель ищется и в архиве: если страница
+# в архиве, запрос вернет item_archived и комментарии страницы возвращаются из архива в той же транзакции.
+# Параметры явно приводятся к типам, т.к. asyncpg выводит тип каждого параметра из контекста
+# и одинаковый параметр в разных местах запроса не должен получить разные типы.
+CREATE_COMMENT_SQL_TEMPLATE = """
+    WITH comment_user AS ({comment_user}
+    ), parent AS (
+        SELECT path
+          FROM comments
+         WHERE id = CAST(:parent_id AS integer)
+           AND service_id = CAST(:service_id AS uuid)
+           AND data_type = CAST(:data_type AS varchar)
+           AND item_id = CAST(:item_id AS varchar)
+         UNION ALL
+        SELECT path
+          FROM comments_archive
+         WHERE id = CAST(:parent_id AS integer)
+           AND service_id = CAST(:service_id AS uuid)
+           AND data_type = CAST(:data_type AS varchar)
+           AND item_id = CAST(:item_id AS varchar)
+    ), new_id AS (
+        SELECT nextval('comments_id_seq') AS id
+    ), new_path AS (
+        SELECT new_id.id,
+               CASE WHEN parent.path IS NULL THEN text2ltree(lpad(new_id.id::text, 9, '0'))
+                    ELSE parent.path || text2ltree(lpad(new_id.id::text, 9, '0'))
+               END AS path
+          FROM new_id
+          LEFT JOIN parent ON true
+         WHERE CAST(:parent_id AS integer) IS NULL OR parent.path IS NOT NULL
+    ), new_comment AS (
+        INSERT INTO comments (id, path, level, item_id, data_type, comment_text, is_deleted,
+                              date_created, date_modified, user_id, service_id, scope)
+        SELECT new_path.id, new_path.path, nlevel(new_path.path), CAST(:item_id AS varchar),
+               CAST(:data_type AS varchar), CAST(:comment_text AS varchar), false,
+               timezone('utc', now()), timezone('utc', now()), comment_user.id, CAST(:service_id AS uuid),
+               CAST(:scope AS varchar)
+          FROM new_path, comment_user
+        RETURNING id, path, level, item_id, data_type, comment_text, is_deleted,
+                  date_created, date_modified, user_id, service_id, scope
+    ), item_version AS (
+        INSERT INTO item_versions (service_id, data_type, item_id, version, comments_count, date_modified)
+        SELECT service_id, data_type, item_id, 1, 1, date_modified
+          FROM new_comment
+        ON CONFLICT (service_id, data_type, item_id) DO UPDATE
+           SET version = item_versions.version + 1,
+               comments_count = item_versions.comments_count + 1,
+               date_modified = EXCLUDED.date_modified
+        RETURNING is_archived
+    ), counters AS (
+        INSERT INTO comment_counters (service_id, data_type, item_id, scope, total, active, top_level)
+        SELECT service_id, data_type, item_id, scope, 1, 1, CASE WHEN level = 1 THEN 1 ELSE 0 END
+          FROM new_comment
+        ON CONFLICT (service_id, data_type, item_id, scope) DO UPDATE
+           SET total = comment_counters.total + EXCLUDED.total,
+               active = comment_counters.active + EXCLUDED.active,
+               top_level = comment_counters.top_level + EXCLUDED.top_level
+    ), event AS (
+        SELECT pg_notify(CAST(:channel AS text),
+                         json_build_object('event', 'create', 'service_id', service_id, 'data_type', data_type,
+                                           'item_id', item_id, 'scope', scope, 'id', id)::text)
+          FROM new_comment
+    )
+    SELECT new_comment.*,
+           comment_user.external_id, comment_user.first_name, comment_user.last_name, comment_user.user_group,
+           comment_user.user_changed, item_version.is_archived AS item_archived
+      FROM new_comment
+      JOIN comment_user ON comment_user.id = new_comment.user_id
+      CROSS JOIN item_version
+      CROSS JOIN event
+"""
+
+# пользователь сохраняется по уникальному индексу (service_id, external_id) без гонки при одновременных
+# первых комментариях, DO UPDATE (а не DO NOTHING) нужен, чтобы RETURNING вернул id существующего пользователя.
+# Подзапрос в RETURNING видит строку users до изменения, поэтому user_changed - изменились ли данные
+# существующего пользователя (тогда версии страниц с его комментариями увеличиваются, см. bump_user_items)
+UPSERT_USER_SQL = """
+        INSERT INTO users (external_id, service_id, first_name, last_name, user_group)
+        VALUES (CAST(:external_id AS varchar), CAST(:service_id AS uuid), CAST(:first_name AS varchar),
+                CAST(:last_name AS varchar), CAST(:user_group AS varchar))
+        ON CONFLICT (service_id, external_id) DO UPDATE
+           SET first_name = EXCLUDED.first_name,
+               last_name = EXCLUDED.last_name,
+               user_group = EXCLUDED.user_group
+        RETURNING id, external_id, first_name, last_name, user_group,
+                  EXISTS (SELECT 1
+                            FROM users AS old_user
+                           WHERE old_user.id = users.id
+                             AND (old_user.first_name, old_user.last_name, old_user.user_group)
+                                 IS DISTINCT FROM (users.first_name, users.last_name, users.user_group))
+                  AS user_changed"""
+
+# пользователь уже известен (см. user_cache) и его данные не изменились, поэтому строка users не изменяется
+KNOWN_USER_SQL = """
+        SELECT CAST(:user_id AS integer) AS id, CAST(:external_id AS varchar) AS external_id,
+               CAST(:first_name AS varchar) AS first_name, CAST(:last_name AS varchar) AS last_name,
+               CAST(:user_group AS varchar) AS user_group, false AS user_changed"""
+
+CREATE_COMMENT_SQL = text(CREATE_COMMENT_SQL_TEMPLATE.format(comment_user=UPSERT_USER_SQL))\
+    .bindparams(bindparam('service_id', type_=UUID(as_uuid=True)))
+CREATE_COMMENT_KNOWN_USER_SQL = text(CREATE_COMMENT_SQL_TEMPLATE.format(comment_user=KNOWN_USER_SQL))\
+    .bindparams(bindparam('service_id', type_=UUID(as_uuid=True)))
+
+# пользователи, публикующие комментарии, кэшируются: (service_id, external_id) -> (id, first_name, last_name,
+# user_group). Если присланные данные пользователя совпадают с кэшем, комментарий вставляется без обращения
+# к таблице пользователей. Кэш не разделяется между процессами, поэтому если данные пользователя изменил
+# другой процесс, присланные сюда прежние данные попадут в БД не позже чем через USERS_CACHE_TTL.
+user_cache = TTLCache(maxsize=USERS_CACHE_SIZE, ttl=USERS_CACHE_TTL)
 
 
 # создание комментария в БД
-def create_comment(db: Session,
-                   service_id: uuid.UUID,
-                   data_type: str,
-                   item_id: str,
-                   parent_path,
-                   user: schemas.User,
-                   comment_text: str,
-                   scope: schemas.Scope):
-    """
-    Функция сохранения комментария в БД
-    """
-    comment_row = models.Comment(item_id=item_id,
-                                 comment_text=comment_text,
-                                 user_id=user.id,
+async def create_comment(db: AsyncSession,
+                         service_id: uuid.UUID,
+                         data_type: str,
+                         item_id: str,
+                         parent_id: int,
+                         user: schemas.User,
+                         comment_text: str,
+                         scope: schemas.Scope):
+    """
+    Функция сохранения комментария в БД.
+    Возвращает строку с полями комментария и данными пользователя (external_id, first_name, last_name, user_group),
+    если родительский комментарий не найден, выбрасывает NoResultFound
+    """
+    params = {'channel': COMMENTS_EVENTS_CHANNEL,
+              'service_id': service_id,
+              'data_type': data_type,
+              'item_id': item_id,
+              'parent_id': parent_id,
+              'comment_text': comment_text,
+              'scope': scope,
+              'external_id': user.external_id,
+              'first_name': user.first_name,
+              'last_name': user.last_name,
+              'user_group': user.user_group}
+    user_key = (service_id, user.external_id)
+    cached_user = user_cache.get(user_key)
+    if cached_user is not None and cached_user[1:] == (user.first_name, user.last_name, user.user_group):
+        comment_row = (await db.execute(CREATE_COMMENT_KNOWN_USER_SQL, {**params, 'user_id': cached_user[0]})).one()
+    else:
+        comment_row = (await db.execute(CREATE_COMMENT_SQL, params)).one()
+    if comment_row.item_archived:
+        # новый комментарий в архивной странице: остальные ее комментарии возвращаются в основную таблицу
+        await restore_items(db=db, service_id=service_id, data_type=data_type, item_ids=[item_id])
+    if comment_row.user_changed:
+        # имя или группа автора отдаются в комментариях других страниц, их кэши и ETag должны устареть
+        await bump_user_items(db=db, service_id=service_id, user_id=comment_row.user_id,
+                              exclude=(data_type, item_id))
+    await db.commit()
+    user_cache.set(user_key, (comment_row.user_id, user.first_name, user.last_name, user.user_group))
+    return comment_row
+
+# колонки, из которых собирается отдаваемый комментарий (см. convertors.comment_row_2_dict),
+# выбираются кортежами, без создания ORM-объектов
+def comment_out_columns(source):
+    """Функция получения колонок отдаваемого комментария из таблицы source (Comment или ArchivedComment)"""
+    return (source.id,
+            source.path,
+            source.level,
+            source.comment_text,
+            source.date_created,
+            source.date_modified,
+            source.is_deleted,
+            source.scope,
+            source.user_id,
+            models.User.external_id,
+            models.User.first_name,
+            models.User.last_name,
+            models.User.user_group)
+
+
+COMMENT_OUT_COLUMNS = comment_out_columns(models.Comment)
+
+
+# таблица, из которой читаются комментарии страницы
+def comments_source(archived: bool):
+    """Функция выбора таблицы комментариев: архивные страницы читаются из comments_archive"""
+    return models.ArchivedComment if archived else models.Comment
+
+
+# получение комментариев из БД
+async def get_comments(db: AsyncSession,
+                       service_id: uuid.UUID,
+                       data_type: schemas.DataType,
+                       item_id: str,
+                       scope: schemas.Scope,
+                       presentation: schemas.PresentationList = schemas.PresentationList.tree,
+                       parent_id: int = None,
+                       limit: int = None,
+                       after: tuple = None,
+                       archived: bool = False,
+                       since: tuple = None,
+                       max_depth: int = None):
+    """
+    Функция получения из БД комментариев для конкретной страницы.
+    Выдача постраничная (keyset-пагинация): after - ключ сортировки последнего комментария
+    предыдущей страницы, для древовидного и вложенного вида это (path,), для плоского (date_created, id).
+    archived - страница в архиве (ItemVersion.is_archived), комментарии читаются из comments_archive.
+    since - (date_modified, id): отдаются только комментарии, измененные после этого ключа,
+    упорядоченные по (date_modified, id) независимо от вида отображения, after при этом не используется.
+    max_depth - отдавать комментарии не глубже max_depth уровней от родителя (или от начала обсуждения).
+    Возвращает строки с колонками COMMENT_OUT_COLUMNS.
+    """
+    query = await comments_query(db=db,
                                  service_id=service_id,
-                                 parent_path=parent_path,
                                  data_type=data_type,
-                                 scope=scope)
+                                 item_id=item_id,
+                                 scope=scope,
+                                 presentation=presentation,
+                                 parent_id=parent_id,
+                                 after=after,
+                                 archived=archived,
+                                 since=since,
+                                 max_depth=max_depth)
+    if limit:
+        query = query.limit(limit)
+    return (await db.execute(query)).all()
 
-    db.add(comment_row)
-    db.commit()
-    return comment_row
+# потоковое чтение комментариев из БД
+async def stream_comments(db: AsyncSession, query, batch_size: int):
+    """
+    Асинхронный генератор, отдающий строки запроса (например, comments_query) пачками по batch_size.
+    Строки читаются через серверный курсор, поэтому в памяти одновременно находится не больше одной пачки.
+    """
+    result = await db.stream(query)
+    async for rows in result.partitions(batch_size):
+        yield rows
 
-# получение комментариев из БД
-def get_comments(db: Session,
-                 service_id: uuid.UUID,
-                 data_type: schemas.DataType,
-                 item_id: str,
-                 scope: schemas.Scope,
-                 presentation: schemas.PresentationList = schemas.PresentationList.tree,
-                 parent_id: int = None):
-    """Функция получения из БД комментариев для конкретной страницы"""
-    comments = None
+# построение запроса комментариев страницы
+async def comments_query(db: AsyncSession,
+                         service_id: uuid.UUID,
+                         data_type: schemas.DataType,
+                         item_id: str,
+                         scope: schemas.Scope,
+                         presentation: schemas.PresentationList = schemas.PresentationList.tree,
+                         parent_id: int = None,
+                         after: tuple = None,
+                         archived: bool = False,
+                         since: tuple = None,
+                         max_depth: int = None):
+    """
+    Функция построения запроса комментариев страницы с сортировкой по виду отображения, параметры как у
+    get_comments. Если указан parent_id, путь родителя читается из БД, при его отсутствии выбрасывается
+    NoResultFound.
+    """
+    source = comments_source(archived)
+    query = select(*comment_out_columns(source))\
+        .join(models.User, models.User.id == source.user_id)\
+        .where(source.service_id == service_id,
+               source.data_type == data_type,
+               source.item_id == item_id,
+               source.scope == scope)
+    base_level = 0
     if parent_id:
-        parent_path = db.query(models.Comment.path).filter(models.Comment.service_id == service_id,
-                                                           models.Comment.data_type == data_type,
-                                                           models.Comment.item_id == item_id,
-                                                           models.Comment.id == parent_id).one()
-        # приходится ltree конвертировать в строку, т.к. библиотека psycopg2 не умеет работать с ltree
-        parent_path = str(parent_path.path)
-
-        if presentation == schemas.PresentationList.tree:
-            # в запросе используем встроенные функции для ltree.subpath(models.Comment.path, 0, 1) возвращает
-            # самого верхнего родителя, ltree2text конвертирует путь ltree в текст, т.к. у самого родителя может быть
-            # путь самого верхнего уровня, делаем отбор всех с level больше 1.
-            comments = db.query(models.Comment, models.User)\
-                .join(models.User,models.User.id == models.Comment.user_id)\
-                .filter(models.Comment.service_id == service_id,
-                        models.Comment.data_type == data_type,
-                        models.Comment.item_id == item_id,
-                        models.Comment.scope == scope,
-                        func.ltree2text(func.subpath(models.Comment.path, 0, 1)) == parent_path,
-                        models.Comment.level > 1)\
-                .order_by(models.Comment.path).all()
-        elif presentation == schemas.PresentationList.flat:
-            comments = db.query(models.Comment, models.User)\
-                .join(models.User, models.User.id == models.Comment.user_id)\
-                .filter(models.Comment.service_id == service_id,
-                        models.Comment.data_type == data_type,
-                        models.Comment.item_id == item_id,
-                        models.Comment.scope == scope,
-                        func.ltree2text(func.subpath(models.Comment.path, 0, 1)) == parent_path,
-                        models.Comment.level > 1)\
-                .order_by(models.Comment.date_created).all()
+        parent = await get_parent(db=db, source=source, service_id=service_id, data_type=data_type,
+                                  item_id=item_id, parent_id=parent_id)
+        # отбираем всех потомков родителя оператором ltree <@ (path <@ parent_path),
+        # в отличие от сравнения вычисленного subpath он обслуживается индексом ix_comments_path,
+        # сам родитель отсекается по уровню
+        query = query.where(source.path.descendant_of(parent.path),
+                            source.level > parent.level)
+        base_level = parent.level
+    if max_depth:
+        query = query.where(source.level <= base_level + max_depth)
+
+    # вместо OFFSET отбираем строки, идущие после ключа последней отданной строки,
+    # поэтому глубокие страницы выбираются так же быстро, как первая
+    if since:
+        # изменения страницы читаются по индексу ix_comments_item_date_modified
+        query = query.where(tuple_(source.date_modified, source.id) > tuple_(*since))\
+            .order_by(source.date_modified, source.id)
+    elif presentation == schemas.PresentationList.flat:
+        if after:
+            query = query.where(tuple_(source.date_created, source.id) > tuple_(*after))
+        query = query.order_by(source.date_created, source.id)
     else:
-        if presentation == schemas.PresentationList.tree:
-            comments = db.query(models.Comment, models.User)\
-                .join(models.User, models.User.id == models.Comment.user_id)\
-                .filter(models.Comment.service_id == service_id,
-                        models.Comment.data_type == data_type,
-                        models.Comment.item_id == item_id,
-                        models.Comment.scope == scope)\
-                .order_by(models.Comment.path).all()
-        elif presentation == schemas.PresentationList.flat:
-            comments = db.query(models.Comment, models.User)\
-                .join(models.User, models.User.id == models.Comment.user_id)\
-                .filter( models.Comment.service_id == service_id,
-                         models.Comment.data_type == data_type,
-                         models.Comment.item_id == item_id,
-                         models.Comment.scope == scope)\
-                .order_by(models.Comment.date_created).all()
-    return comments
+        # древовидный и вложенный вид упорядочены по пути
+        if after:
+            query = query.where(source.path > Ltree(after[0]))
+        query = query.order_by(source.path)
+    return query
+
+# получение пути и уровня родительского комментария
+async def get_parent(db: AsyncSession, source, service_id: uuid.UUID, data_type: str, item_id: str, parent_id: int):
+    """Функция получения строки (path, level) комментария страницы, при его отсутствии выбрасывает NoResultFound"""
+    return (await db.execute(select(source.path, source.level)
+                             .where(source.service_id == service_id,
+                                    source.data_type == data_type,
+                                    source.item_id == item_id,
+                                    source.id == parent_id))).one()
+
+# получение комментариев верхнего уровня с количеством ответов и их превью
+async def get_roots(db: AsyncSession,
+                    service_id: uuid.UUID,
+                    data_type: schemas.DataType,
+                    item_id: str,
+                    scope: schemas.Scope,
+                    parent_id: int = None,
+                    limit: int = None,
+                    after: tuple = None,
+                    preview: int = 0,
+                    archived: bool = False):
+    """
+    Функция получения страницы комментариев первого уровня (или прямых ответов на parent_id) в порядке path
+    для ленивой загрузки больших обсуждений. Количество прямых ответов каждого комментария считается в том же
+    запросе, первые preview прямых ответов читаются вторым запросом сразу для всей страницы (LATERAL с LIMIT),
+    поэтому стоимость зависит от размера страницы, а не от размера обсуждения.
+    Возвращает строки с колонками COMMENT_OUT_COLUMNS и replies_count и словарь path комментария -> строки
+    его ответов. Если parent_id не найден, выбрасывает NoResultFound
+    """
+    source = comments_source(archived)
+    reply = aliased(source)
+    replies_count = select(func.count())\
+        .where(reply.service_id == service_id,
+               reply.data_type == data_type,
+               reply.item_id == item_id,
+               reply.scope == scope,
+               reply.path.descendant_of(source.path),
+               reply.level == source.level + 1)\
+        .scalar_subquery()
+    query = select(*comment_out_columns(source), replies_count.label('replies_count'))\
+        .join(models.User, models.User.id == source.user_id)\
+        .where(source.service_id == service_id,
+               source.data_type == data_type,
+               source.item_id == item_id,
+               source.scope == scope)\
+        .order_by(source.path)
+    if parent_id:
+        parent = await get_parent(db=db, source=source, service_id=service_id, data_type=data_type,
+                                  item_id=item_id, parent_id=parent_id)
+        query = query.where(source.path.descendant_of(parent.path), source.level == parent.level + 1)
+    else:
+        query = query.where(source.level == 1)
+    if after:
+        query = query.where(source.path > Ltree(after[0]))
+    if limit:
+        query = query.limit(limit)
+    roots = (await db.execute(query)).all()
+
+    replies = {}
+    if preview and roots:
+        parents = func.unnest(bindparam('paths', [str(root.path) for root in roots], type_=ARRAY(String)))\
+            .table_valued('path').render_derived(name='parents')
+        parent_path = func.text2ltree(parents.c.path)
+        first_replies = select(*comment_out_columns(source))\
+            .join(models.User, models.User.id == source.user_id)\
+            .where(source.service_id == service_id,
+                   source.data_type == data_type,
+                   source.item_id == item_id,
+                   source.scope == scope,
+                   source.path.descendant_of(parent_path),
+                   source.level == func.nlevel(parent_path) + 1)\
+            .order_by(source.path)\
+            .limit(preview)\
+            .lateral('replies')
+        rows = (await db.execute(select(parents.c.path.label('parent_path'), first_replies)
+                                 .select_from(parents)
+                                 .join(first_replies, true())
+                                 .order_by(first_replies.c.path))).all()
+        for row in rows:
+            replies.setdefault(row.parent_path, []).append(row)
+    return roots, replies
+
+# получение поддерева с ограничением количества ответов в каждой ветке
+async def get_branches(db: AsyncSession,
+                       service_id: uuid.UUID,
+                       data_type: schemas.DataType,
+                       item_id: str,
+                       scope: schemas.Scope,
+                       branch_limit: int,
+                       max_depth: int,
+                       parent_id: int = None,
+                       limit: int = None,
+                       after: tuple = None,
+                       archived: bool = False):
+    """
+    Функция получения комментариев обсуждения (или поддерева parent_id) в порядке path, в которой на первом
+    уровне отдается limit комментариев (keyset-пагинация по path, как у древовидного вида), а у каждого
+    комментария не больше branch_limit первых прямых ответов, и так не глубже max_depth уровней.
+    Дерево обходится рекурсивным запросом, в котором ответы каждого комментария отбираются LATERAL-подзапросом
+    с LIMIT, поэтому глубокие и широкие ветки не читаются целиком.
+    Возвращает строки с колонками COMMENT_OUT_COLUMNS. Если parent_id не найден, выбрасывает NoResultFound
+    """
+    source = comments_source(archived)
+    comments = source.__table__
+    base_level = 0
+    first = select(comments.c.id, comments.c.path, comments.c.level)\
+        .where(comments.c.service_id == service_id,
+               comments.c.data_type == data_type,
+               comments.c.item_id == item_id,
+               comments.c.scope == scope)\
+        .order_by(comments.c.path)
+    if parent_id:
+        parent = await get_parent(db=db, source=source, service_id=service_id, data_type=data_type,
+                                  item_id=item_id, parent_id=parent_id)
+        base_level = parent.level
+        first = first.where(comments.c.path.descendant_of(parent.path))
+    first = first.where(comments.c.level == base_level + 1)
+    if after:
+        first = first.where(comments.c.path > Ltree(after[0]))
+    if limit:
+        first = first.limit(limit)
+    branch = first.cte('branch', recursive=True)
+
+    child = comments.alias('child')
+    children = select(child.c.id, child.c.path, child.c.level)\
+        .where(child.c.service_id == service_id,
+               child.c.data_type == data_type,
+               child.c.item_id == item_id,
+               child.c.scope == scope,
+               child.c.path.descendant_of(branch.c.path),
+               child.c.level == branch.c.level + 1)\
+        .order_by(child.c.path)\
+        .limit(branch_limit)\
+        .lateral('children')
+    branch = branch.union_all(select(children.c.id, children.c.path, children.c.level)
+                              .select_from(branch)
+                              .join(children, true())
+                              .where(branch.c.level < base_level + max_depth))
+
+    query = select(*comment_out_columns(source))\
+        .join(branch, (source.service_id == service_id) & (source.id == branch.c.id))\
+        .join(models.User, models.User.id == source.user_id)\
+        .order_by(source.path)
+    return (await db.execute(query)).all()
+
+# получение последних комментариев сразу для нескольких страниц
+async def get_latest_comments_for_items(db: AsyncSession,
+                                        service_id: uuid.UUID,
+                                        data_type: schemas.DataType,
+                                        item_ids: List[str],
+                                        scope: schemas.Scope,
+                                        presentation: schemas.PresentationList = schemas.PresentationList.tree,
+                                        limit: int = None,
+                                        archived: bool = False):
+    """
+    Функция получения из БД последних (по дате создания) limit комментариев для каждой страницы из item_ids
+    одним запросом. Для каждой страницы выполняется LATERAL-подзапрос с LIMIT по индексу
+    ix_comments_item_date_created, поэтому стоимость зависит от числа страниц и limit, а не от размера обсуждений.
+    archived - страницы в архиве, комментарии читаются из comments_archive (см. get_archived_items).
+    Возвращает строки с колонками COMMENT_OUT_COLUMNS и item_id, упорядоченные по item_id, а внутри страницы
+    по виду отображения.
+    """
+    source = comments_source(archived)
+    items = func.unnest(bindparam('item_ids', item_ids, type_=ARRAY(String))).table_valued('item_id').render_derived(name='items')
+    latest = select(*comment_out_columns(source), source.item_id)\
+        .join(models.User, models.User.id == source.user_id)\
+        .where(source.service_id == service_id,
+               source.data_type == data_type,
+               source.item_id == items.c.item_id,
+               source.scope == scope)\
+        .order_by(source.date_created.desc(), source.id.desc())
+    if limit:
+        latest = latest.limit(limit)
+    latest = latest.lateral('latest')
+    query = select(latest).select_from(items).join(latest, true())
+    if presentation == schemas.PresentationList.flat:
+        query = query.order_by(latest.c.item_id, latest.c.date_created, latest.c.id)
+    else:
+        query = query.order_by(latest.c.item_id, latest.c.path)
+    return (await db.execute(query)).all()
+
+# поисковый запрос в конфигурации поиска колонки search_vector
+def search_tsquery(query: str):
+    """Функция построения tsquery из строки поиска в синтаксисе веб-поиска (слова, "фраза", or, -исключение)"""
+    return func.websearch_to_tsquery(literal_column(f"'{COMMENTS_SEARCH_LANGUAGE}'::regconfig"), query)
+
+# полнотекстовый поиск комментариев сервиса
+async def search_comments(db: AsyncSession,
+                          service_id: uuid.UUID,
+                          query: str,
+                          order: schemas.SearchOrder = schemas.SearchOrder.rank,
+                          data_type: str = None,
+                          item_id: str = None,
+                          user_external_id: str = None,
+                          created_from: datetime = None,
+                          created_to: datetime = None,
+                          include_deleted: bool = False,
+                          limit: int = None,
+                          after: tuple = None):
+    """
+    Функция поиска комментариев сервиса (включая архивные) по тексту с фильтрами по типу данных, странице,
+    пользователю и периоду создания [created_from, created_to).
+    Совпадения отбираются по GIN-индексу колонки search_vector. Сортировка по релевантности (rank, id)
+    или по дате создания (date_created, id), от большего к меньшему; after - ключ сортировки последнего
+    комментария предыдущей страницы (keyset-пагинация, как в get_comments).
+    Возвращает строки с колонками COMMENT_OUT_COLUMNS, data_type, item_id и rank
+    """
+    tsquery = search_tsquery(query)
+    parts = []
+    for source in (models.Comment, models.ArchivedComment):
+        part = select(*comment_out_columns(source),
+                      source.data_type,
+                      source.item_id,
+                      func.ts_rank_cd(source.search_vector, tsquery).label('rank'))\
+            .join(models.User, models.User.id == source.user_id)\
+            .where(source.service_id == service_id,
+                   source.search_vector.op('@@')(tsquery))
+        if data_type:
+            part = part.where(source.data_type == data_type)
+        if item_id:
+            part = part.where(source.item_id == item_id)
+        if user_external_id:
+            part = part.where(models.User.external_id == user_external_id)
+        if created_from:
+            part = part.where(source.date_created >= created_from)
+        if created_to:
+            part = part.where(source.date_created < created_to)
+        if not include_deleted:
+            part = part.where(source.is_deleted.isnot(True))
+        parts.append(part)
+    found = union_all(*parts).subquery('found')
+    if order == schemas.SearchOrder.date:
+        key = (found.c.date_created, found.c.id)
+    else:
+        key = (found.c.rank, found.c.id)
+    search = select(found).order_by(*(column.desc() for column in key))
+    if after:
+        search = search.where(tuple_(*key) < tuple_(*after))
+    if limit:
+        search = search.limit(limit)
+    return (await db.execute(search)).all()
 
 # изменение комменатрия
-def update_comment(db: Session,
-                   id: int,
-                   service_id: uuid.UUID,
-                   item_id: str,
-                   data_type: str,
-                   updated_comment: dict):
+async def update_comment(db: AsyncSession,
+                         id: int,
+                         service_id: uuid.UUID,
+                         item_id: str,
+                         data_type: str,
+                         updated_comment: dict):
     """Функция сохранения в БД измененного комментария"""
-    db.query(models.Comment).filter(models.Comment.id == id,
-                                    models.Comment.service_id == service_id,
-                                    models.Comment.item_id == item_id,
-                                    models.Comment.data_type == data_type
-                                    ).update(updated_comment, synchronize_session="fetch")
-    db.commit()
-    return db.query(models.Comment).filter(models.Comment.id == id).one()
+    # комментарии архивной страницы сначала возвращаются в основную таблицу
+    await restore_items(db=db, service_id=service_id, data_type=data_type, item_ids=[item_id])
+    old = None
+    if 'scope' in updated_comment:
+        # при смене области видимости комментарий переносится между счетчиками,
+        # поэтому прежнюю область читаем с блокировкой строки до конца транзакции
+        old = (await db.execute(select(models.Comment.scope, models.Comment.level, models.Comment.is_deleted)
+                                .where(models.Comment.id == id,
+                                       models.Comment.service_id == service_id,
+                                       models.Comment.item_id == item_id,
+                                       models.Comment.data_type == data_type)
+                                .with_for_update())).one_or_none()
+    result = await db.execute(update(models.Comment)
+                              .where(models.Comment.id == id,
+                                     models.Comment.service_id == service_id,
+                                     models.Comment.item_id == item_id,
+                                     models.Comment.data_type == data_type)
+                              # дата изменения берется по часам БД, как при создании комментария,
+                              # иначе расхождение часов сервера приложения нарушит порядок изменений (since)
+                              .values(**updated_comment, date_modified=func.timezone('utc', func.now()))
+                              .execution_options(synchronize_session="fetch"))
+    if result.rowcount:
+        await bump_item_version(db=db, service_id=service_id, data_type=data_type, item_id=item_id)
+        if old is not None and old.scope != updated_comment['scope']:
+            active = 0 if old.is_deleted else 1
+            top_level = 1 if old.level == 1 else 0
+            await add_to_counters(db=db, service_id=service_id, data_type=data_type, item_id=item_id,
+                                  scope=old.scope, total=-1, active=-active, top_level=-top_level)
+            await add_to_counters(db=db, service_id=service_id, data_type=data_type, item_id=item_id,
+                                  scope=updated_comment['scope'], total=1, active=active, top_level=top_level)
+            # для подписчиков прежней области видимости комментарий пропадает
+            await notify_event(db=db, event='delete', service_id=service_id, data_type=data_type,
+                               item_id=item_id, scope=old.scope, id=id)
+    comment = (await db.execute(select(models.Comment).where(models.Comment.service_id == service_id,
+                                                             models.Comment.id == id))).scalar_one()
+    if result.rowcount:
+        await notify_event(db=db, event='update', service_id=service_id, data_type=data_type,
+                           item_id=item_id, scope=comment.scope, id=id)
+    await db.commit()
+    return comment
 
 # удаление комментария, физически не удаляет, а меняет флаг
-def delete_comment(db: Session,
-                   id: int,
-                   service_id: uuid.UUID,
-                   item_id: str,
-                   data_type: str):
-    """Функция удаления комментария из БД"""
-    db.query(models.Comment).filter(models.Comment.id == id,
-                                    models.Comment.service_id == service_id,
-                                    models.Comment.item_id == item_id,
-                                    models.Comment.data_type == data_type
-                                    ).update({'is_deleted': True}, synchronize_session="fetch")
-    db.commit()
-    return db.query(models.Comment).filter(models.Comment.id == id).one()
-
-# проверка наличия пользователя в базе
-def check_user(db: Session, service_id: uuid.UUID, user_id: str):
-    """Функция проверки наличия пользователя в базе"""
-    if db.query(models.User).filter(models.User.service_id == service_id, models.User.external_id == user_id).count():
-        return True
-    else:
-        return False
-
-# получение пользователя из базы
-def get_user(db: Session, service_id: uuid.UUID, user_id: str):
-    """Функция получения пользователя из базы"""
-    return db.query(models.User).filter(models.User.service_id == service_id, models.User.external_id == user_id).one()
-
-# создание пользователя
-def create_user(db: Session, service_id: uuid.UUID, user: schemas.User):
-    """Функция сохранения пользователя в БД"""
-    user_dict = user.dict()
-    user_group = user_dict.pop('user_group')
-    user_dict['service_id'] = service_id
-    user_dict['user_group'] = user_group
-    user_row = models.User(**user_dict)
-    db.add(user_row)
-    db.commit()
-    return user_row
-
-# получение пути по идентификатору
-def get_path(db: Session, id: int):
-    """Функция получение пути комментария по его id"""
-    if id:
-        comment = db.query(models.Comment).filter(models.Comment.id == id).one()
-        return str(comment.path)
+async def delete_comment(db: AsyncSession,
+                         id: int,
+                         service_id: uuid.UUID,
+                         item_id: str,
+                         data_type: str):
+    """
+    Функция удаления комментария из БД.
+    Изменяются только еще не удаленные комментарии, поэтому повторное удаление не уменьшает счетчик повторно
+    """
+    await restore_items(db=db, service_id=service_id, data_type=data_type, item_ids=[item_id])
+    comments = models.Comment.__table__
+    deleted = (await db.execute(update(comments)
+                                .where(comments.c.id == id,
+                                       comments.c.service_id == service_id,
+                                       comments.c.item_id == item_id,
+                                       comments.c.data_type == data_type,
+                                       comments.c.is_deleted.isnot(True))
+                                .values(is_deleted=True, date_modified=func.timezone('utc', func.now()))
+                                .returning(comments.c.scope))).one_or_none()
+    if deleted is not None:
+        await bump_item_version(db=db, service_id=service_id, data_type=data_type, item_id=item_id)
+        await add_to_counters(db=db, service_id=service_id, data_type=data_type, item_id=item_id,
+                              scope=deleted.scope, active=-1)
+        await notify_event(db=db, event='delete', service_id=service_id, data_type=data_type,
+                           item_id=item_id, scope=deleted.scope, id=id)
+    await db.commit()
+    return (await db.execute(select(models.Comment).where(models.Comment.service_id == service_id,
+                                                          models.Comment.id == id))).scalar_one()
+
+# отправка события изменения комментария подписчикам страницы, выполняется в транзакции изменения комментариев
+async def notify_event(db: AsyncSession,
+                       event: str,
+                       service_id: uuid.UUID,
+                       data_type: str,
+                       item_id: str,
+                       scope: str,
+                       id: int):
+    """
+    Функция отправки события (create, update или delete) в канал COMMENTS_EVENTS_CHANNEL командой pg_notify.
+    Postgres доставляет уведомление слушателям (см. events.EventHub) только после фиксации транзакции,
+    поэтому подписчики не увидят изменения, которое будет отменено.
+    В уведомлении передаются только ключи: текст комментария может не поместиться в ограничение pg_notify
+    """
+    payload = orjson.dumps({'event': event,
+                            'service_id': str(service_id),
+                            'data_type': data_type,
+                            'item_id': item_id,
+                            'scope': scope,
+                            'id': id}).decode()
+    await db.execute(select(func.pg_notify(COMMENTS_EVENTS_CHANNEL, payload)))
+
+# получение комментариев сервиса по id в виде строк с колонками COMMENT_OUT_COLUMNS
+async def get_comment_rows(db: AsyncSession, service_id: uuid.UUID, ids: List[int]):
+    """Функция получения комментариев для отправки подписчикам, отсутствующие комментарии пропускаются"""
+    return (await db.execute(select(*COMMENT_OUT_COLUMNS)
+                             .join(models.User, models.User.id == models.Comment.user_id)
+                             .where(models.Comment.service_id == service_id,
+                                    models.Comment.id == any_(bindparam('ids', ids, type_=ARRAY(Integer)))))).all()
+
+# увеличение версии комментариев страницы, выполняется в транзакции изменения комментариев
+async def bump_item_version(db: AsyncSession,
+                            service_id: uuid.UUID,
+                            data_type: str,
+                            item_id: str,
+                            added: int = 0):
+    """Функция увеличения версии страницы, added - количество добавленных комментариев"""
+    stmt = insert(models.ItemVersion).values(service_id=service_id,
+                                             data_type=data_type,
+                                             item_id=item_id,
+                                             version=1,
+                                             comments_count=added,
+                                             date_modified=func.timezone('utc', func.now()))
+    stmt = stmt.on_conflict_do_update(index_elements=[models.ItemVersion.service_id,
+                                                      models.ItemVersion.data_type,
+                                                      models.ItemVersion.item_id],
+                                      set_={'version': models.ItemVersion.version + 1,
+                                            'comments_count': models.ItemVersion.comments_count
+                                                              + stmt.excluded.comments_count,
+                                            'date_modified': stmt.excluded.date_modified})
+    await db.execute(stmt)
+
+# увеличение версий страниц с комментариями пользователя, выполняется в транзакции изменения его данных
+BUMP_USER_ITEMS_SQL = text("""
+    UPDATE item_versions
+       SET version = item_versions.version + 1,
+           date_modified = timezone('utc', now())
+      FROM (SELECT data_type, item_id
+              FROM comments
+             WHERE service_id = CAST(:service_id AS uuid) AND user_id = CAST(:user_id AS integer)
+             UNION
+            SELECT data_type, item_id
+              FROM comments_archive
+             WHERE service_id = CAST(:service_id AS uuid) AND user_id = CAST(:user_id AS integer)) AS user_items
+     WHERE item_versions.service_id = CAST(:service_id AS uuid)
+       AND item_versions.data_type = user_items.data_type
+       AND item_versions.item_id = user_items.item_id
+       AND (user_items.data_type, user_items.item_id)
+           IS DISTINCT FROM (CAST(:exclude_data_type AS varchar), CAST(:exclude_item_id AS varchar))
+""").bindparams(bindparam('service_id', type_=UUID(as_uuid=True)))
+
+
+async def bump_user_items(db: AsyncSession, service_id: uuid.UUID, user_id: int, exclude: tuple = (None, None)):
+    """
+    Функция увеличения версий страниц, на которых есть комментарии пользователя, кроме страницы exclude
+    (data_type, item_id), версия которой уже увеличена в этой транзакции. Индекса по user_id нет, поэтому
+    просматриваются комментарии сервиса, это допустимо, т.к. данные пользователей меняются редко
+    """
+    await db.execute(BUMP_USER_ITEMS_SQL, {'service_id': service_id, 'user_id': user_id,
+                                           'exclude_data_type': exclude[0], 'exclude_item_id': exclude[1]})
+
+# изменение счетчиков комментариев страницы, выполняется в транзакции изменения комментариев
+async def add_to_counters(db: AsyncSession,
+                          service_id: uuid.UUID,
+                          data_type: str,
+                          item_id: str,
+                          scope: str,
+                          total: int = 0,
+                          active: int = 0,
+                          top_level: int = 0):
+    """Функция прибавления к счетчикам комментариев страницы в области видимости scope (значения могут быть отрицательными)"""
+    stmt = insert(models.CommentCounter).values(service_id=service_id,
+                                                data_type=data_type,
+                                                item_id=item_id,
+                                                scope=scope,
+                                                total=total,
+                                                active=active,
+                                                top_level=top_level)
+    stmt = stmt.on_conflict_do_update(index_elements=[models.CommentCounter.service_id,
+                                                      models.CommentCounter.data_type,
+                                                      models.CommentCounter.item_id,
+                                                      models.CommentCounter.scope],
+                                      set_={'total': models.CommentCounter.total + stmt.excluded.total,
+                                            'active': models.CommentCounter.active + stmt.excluded.active,
+                                            'top_level': models.CommentCounter.top_level
+                                                         + stmt.excluded.top_level})
+    await db.execute(stmt)
+
+# получение счетчиков комментариев для нескольких страниц
+async def get_counters(db: AsyncSession,
+                       service_id: uuid.UUID,
+                       data_type: str,
+                       item_ids: List[str],
+                       scope: str):
+    """
+    Функция получения счетчиков комментариев страниц одним запросом по первичному ключу.
+    Возвращает словарь item_id -> строка (total, active, top_level), страниц без комментариев в нем нет
+    """
+    rows = (await db.execute(select(models.CommentCounter.item_id,
+                                    models.CommentCounter.total,
+                                    models.CommentCounter.active,
+                                    models.CommentCounter.top_level)
+                             .where(models.CommentCounter.service_id == service_id,
+                                    models.CommentCounter.data_type == data_type,
+                                    models.CommentCounter.item_id.in_(item_ids),
+                                    models.CommentCounter.scope == scope))).all()
+    return {row.item_id: row for row in rows}
+
+# пересчет счетчиков комментариев по таблицам комментариев и архива
+async def rebuild_counters(db: AsyncSession, service_id: uuid.UUID = None):
+    """
+    Функция пересчета счетчиков комментариев всех страниц (или страниц одного сервиса) с нуля.
+    На время пересчета таблица счетчиков блокируется от изменений: создание и удаление комментариев ждут
+    окончания пересчета и применяют свои изменения уже к пересчитанным значениям.
+    Возвращает количество пересчитанных счетчиков
+    """
+    await db.execute(text("LOCK TABLE comment_counters IN EXCLUSIVE MODE"))
+    counters = models.CommentCounter.__table__
+    # счетчики архивных страниц сохраняются, поэтому считаются и архивные комментарии
+    comments = all_comments().subquery('comments')
+    delete_stmt = counters.delete()
+    totals = select(comments.c.service_id,
+                    comments.c.data_type,
+                    comments.c.item_id,
+                    comments.c.scope,
+                    func.count(),
+                    func.count().filter(comments.c.is_deleted.isnot(True)),
+                    func.count().filter(comments.c.level == 1))\
+        .group_by(comments.c.service_id, comments.c.data_type, comments.c.item_id, comments.c.scope)
+    if service_id:
+        delete_stmt = delete_stmt.where(counters.c.service_id == service_id)
+        totals = totals.where(comments.c.service_id == service_id)
+    await db.execute(delete_stmt)
+    result = await db.execute(counters.insert().from_select(['service_id', 'data_type', 'item_id', 'scope',
+                                                             'total', 'active', 'top_level'], totals))
+    await db.commit()
+    return result.rowcount
+
+# получение версии комментариев страницы, None если комментариев у страницы нет
+async def get_item_version(db: AsyncSession, service_id: uuid.UUID, data_type: str, item_id: str):
+    return (await db.execute(select(models.ItemVersion)
+                             .where(models.ItemVersion.service_id == service_id,
+                                    models.ItemVersion.data_type == data_type,
+                                    models.ItemVersion.item_id == item_id))).scalar_one_or_none()
+
+# Загрузка пачки импортируемых комментариев одним запросом: строки передаются массивами и разворачиваются unnest,
+# вместе с комментариями сохраняется сопоставление идентификаторов и агрегированно изменяются счетчики и версии
+# затронутых страниц. id и path вычисляются заранее (см. importer.import_comments).
+IMPORT_COMMENTS_SQL = text("""
+    WITH rows AS (
+        SELECT *
+          FROM unnest(CAST(:ids AS integer[]), CAST(:paths AS text[]), CAST(:data_types AS varchar[]),
+                      CAST(:item_ids AS varchar[]), CAST(:comment_texts AS varchar[]), CAST(:is_deleted AS boolean[]),
+                      CAST(:dates_created AS timestamp[]), CAST(:dates_modified AS timestamp[]),
+                      CAST(:user_ids AS integer[]), CAST(:scopes AS varchar[]), CAST(:source_ids AS varchar[]))
+            AS t(id, path, data_type, item_id, comment_text, is_deleted, date_created, date_modified,
+                 user_id, scope, source_id)
+    ), new_comments AS (
+        INSERT INTO comments (id, path, level, item_id, data_type, comment_text, is_deleted,
+                              date_created, date_modified, user_id, service_id, scope)
+        SELECT id, text2ltree(path), nlevel(text2ltree(path)), item_id, data_type, comment_text, is_deleted,
+               date_created, date_modified, user_id, CAST(:service_id AS uuid), scope
+          FROM rows
+        RETURNING service_id, data_type, item_id, scope, level, is_deleted
+    ), mapped AS (
+        INSERT INTO import_map (service_id, source_id, comment_id)
+        SELECT CAST(:service_id AS uuid), source_id, id
+          FROM rows
+    ), counters AS (
+        INSERT INTO comment_counters (service_id, data_type, item_id, scope, total, active, top_level)
+        SELECT service_id, data_type, item_id, scope,
+               count(*), count(*) FILTER (WHERE NOT is_deleted), count(*) FILTER (WHERE level = 1)
+          FROM new_comments
+         GROUP BY service_id, data_type, item_id, scope
+        ON CONFLICT (service_id, data_type, item_id, scope) DO UPDATE
+           SET total = comment_counters.total + EXCLUDED.total,
+               active = comment_counters.active + EXCLUDED.active,
+               top_level = comment_counters.top_level + EXCLUDED.top_level
+    )
+    INSERT INTO item_versions (service_id, data_type, item_id, version, comments_count, date_modified)
+    SELECT service_id, data_type, item_id, 1, count(*), timezone('utc', now())
+      FROM new_comments
+     GROUP BY service_id, data_type, item_id
+    ON CONFLICT (service_id, data_type, item_id) DO UPDATE
+       SET version = item_versions.version + 1,
+           comments_count = item_versions.comments_count + EXCLUDED.comments_count,
+           date_modified = EXCLUDED.date_modified
+""").bindparams(bindparam('service_id', type_=UUID(as_uuid=True)))
+
+# создание пользователей импортируемых комментариев, данные передаются массивами.
+# Пользователи, созданные одновременно другим запросом, пропускаются и не возвращаются
+IMPORT_USERS_SQL = text("""
+    INSERT INTO users (service_id, external_id, first_name, last_name, user_group)
+    SELECT CAST(:service_id AS uuid), *
+      FROM unnest(CAST(:external_ids AS varchar[]), CAST(:first_names AS varchar[]),
+                  CAST(:last_names AS varchar[]), CAST(:user_groups AS varchar[]))
+    ON CONFLICT (service_id, external_id) DO NOTHING
+    RETURNING external_id, id
+""").bindparams(bindparam('service_id', type_=UUID(as_uuid=True)))
+
+
+# получение уже импортированных комментариев по их идентификаторам на исходной платформе
+async def get_imported_comments(db: AsyncSession, service_id: uuid.UUID, source_ids: List[str]):
+    """
+    Функция получения сопоставления идентификаторов импортированных комментариев.
+    Возвращает словарь source_id -> строка (comment_id, path, data_type, item_id)
+    """
+    # родитель импортируемого комментария может находиться в архиве
+    comments = all_comments().subquery('comments')
+    rows = (await db.execute(select(models.ImportMap.source_id,
+                                    models.ImportMap.comment_id,
+                                    comments.c.path,
+                                    comments.c.data_type,
+                                    comments.c.item_id)
+                             .join(comments, (comments.c.service_id == models.ImportMap.service_id)
+                                   & (comments.c.id == models.ImportMap.comment_id))
+                             .where(models.ImportMap.service_id == service_id,
+                                    models.ImportMap.source_id == any_(bindparam('source_ids', source_ids,
+                                                                                 type_=ARRAY(String)))))).all()
+    return {row.source_id: row for row in rows}
+
+# получение id пользователей с созданием отсутствующих
+async def get_or_create_users(db: AsyncSession, service_id: uuid.UUID, users: dict):
+    """
+    Функция получения id пользователей сервиса для импорта, users - словарь external_id -> schemas.User.
+    Отсутствующие пользователи создаются одним запросом, данные существующих не изменяются.
+    Возвращает словарь external_id -> id
+    """
+    user_ids = await get_user_ids(db=db, service_id=service_id, external_ids=list(users))
+    missing = [user for external_id, user in users.items() if external_id not in user_ids]
+    if missing:
+        rows = (await db.execute(IMPORT_USERS_SQL, {'service_id': service_id,
+                                                    'external_ids': [user.external_id for user in missing],
+                                                    'first_names': [user.first_name for user in missing],
+                                                    'last_names': [user.last_name for user in missing],
+                                                    'user_groups': [user.user_group for user in missing]})).all()
+        user_ids.update((row.external_id, row.id) for row in rows)
+        if len(rows) < len(missing):
+            # часть пользователей успел создать другой запрос
+            user_ids.update(await get_user_ids(db=db, service_id=service_id,
+                                               external_ids=[user.external_id for user in missing
+                                                             if user.external_id not in user_ids]))
+    return user_ids
+
+# получение id пользователей сервиса по внешним идентификаторам
+async def get_user_ids(db: AsyncSession, service_id: uuid.UUID, external_ids: List[str]):
+    """Функция получения словаря external_id -> id для существующих пользователей сервиса"""
+    rows = (await db.execute(select(models.User.external_id, models.User.id)
+                             .where(models.User.service_id == service_id,
+                                    models.User.external_id == any_(bindparam('external_ids', external_ids,
+                                                                              type_=ARRAY(String)))))).all()
+    return {row.external_id: row.id for row in rows}
+
+# выделение id для новых комментариев
+async def next_comment_ids(db: AsyncSession, count: int):
+    """Функция получения count значений из последовательности id комментариев одним запросом"""
+    return (await db.execute(select(models.comments_id_seq.next_value())
+                             .select_from(func.generate_series(1, count)))).scalars().all()
+
+# загрузка пачки импортируемых комментариев
+async def insert_imported_comments(db: AsyncSession, service_id: uuid.UUID, rows: List[dict]):
+    """
+    Функция сохранения пачки импортируемых комментариев, rows - словари с ключами id, path, data_type, item_id,
+    comment_text, is_deleted, date_created, date_modified, user_id, scope, source_id.
+    Транзакцию не завершает
+    """
+    params = {'service_id': service_id}
+    for key, param in (('id', 'ids'), ('path', 'paths'), ('data_type', 'data_types'), ('item_id', 'item_ids'),
+                       ('comment_text', 'comment_texts'), ('is_deleted', 'is_deleted'),
+                       ('date_created', 'dates_created'), ('date_modified', 'dates_modified'),
+                       ('user_id', 'user_ids'), ('scope', 'scopes'), ('source_id', 'source_ids')):
+        params[param] = [row[key] for row in rows]
+    await db.execute(IMPORT_COMMENTS_SQL, params)
+
+# колонки выгрузки комментариев: родитель вычисляется по предпоследней метке пути,
+# текст удаленных комментариев не выгружается
+def export_columns(comments):
+    """Функция получения колонок выгрузки из таблицы (или подзапроса) комментариев comments"""
+    return (comments.c.id,
+            case((comments.c.level > 1,
+                  cast(func.ltree2text(func.subpath(comments.c.path, -2, 1)), Integer))).label('parent_id'),
+            comments.c.path,
+            comments.c.level,
+            comments.c.data_type,
+            comments.c.item_id,
+            comments.c.scope,
+            case((comments.c.is_deleted.is_(True), None),
+                 else_=comments.c.comment_text).label('comment_text'),
+            comments.c.is_deleted,
+            comments.c.date_created,
+            comments.c.date_modified,
+            models.User.external_id.label('user_external_id'),
+            models.User.first_name.label('user_first_name'),
+            models.User.last_name.label('user_last_name'),
+            models.User.user_group)
+
+
+EXPORT_COLUMNS = export_columns(models.Comment.__table__)
+
+
+# построение запроса выгрузки комментариев сервиса
+def export_query(service_id: uuid.UUID,
+                 data_type: str = None,
+                 created_from: datetime = None,
+                 created_to: datetime = None,
+                 modified_since: datetime = None):
+    """
+    Функция построения запроса всех комментариев сервиса (включая архивные) для выгрузки, упорядоченных по id.
+    Необязательные фильтры: тип данных, период создания [created_from, created_to)
+    и дата изменения не раньше modified_since (для инкрементальных выгрузок)
+    """
+    comments = all_comments().subquery('comments')
+    query = select(*export_columns(comments))\
+        .join(models.User, models.User.id == comments.c.user_id)\
+        .where(comments.c.service_id == service_id)\
+        .order_by(comments.c.id)
+    if data_type:
+        query = query.where(comments.c.data_type == data_type)
+    if created_from:
+        query = query.where(comments.c.date_created >= created_from)
+    if created_to:
+        query = query.where(comments.c.date_created < created_to)
+    if modified_since:
+        query = query.where(comments.c.date_modified >= modified_since)
+    return query
+
+# выгрузка результата запроса командой COPY
+async def copy_query(db: AsyncSession, query, queue_size: int = 16, **options):
+    """
+    Асинхронный генератор, отдающий результат запроса в виде частей вывода COPY (query) TO STDOUT.
+    Данные формирует сервер БД, options - параметры формата для asyncpg copy_from_query (format, header и т.д.).
+    Части передаются через очередь ограниченного размера: пока клиент не забрал данные, чтение из БД
+    приостанавливается, поэтому память не зависит от объема выгрузки.
+    """
+    connection = await db.connection()
+    compiled = query.compile(dialect=connection.dialect)
+    # запрос компилируется с плейсхолдерами %s, asyncpg ожидает позиционные $1, $2, ...
+    sql = compiled.string % tuple(f'${i}' for i in range(1, len(compiled.positiontup) + 1))
+    args = [compiled.params[name] for name in compiled.positiontup]
+    driver_connection = (await connection.get_raw_connection()).driver_connection
+
+    queue = asyncio.Queue(maxsize=queue_size)
+
+    async def copy():
+        try:
+            await driver_connection.copy_from_query(sql, *args, output=queue.put, **options)
+        finally:
+            await queue.put(None)
+
+    task = asyncio.create_task(copy())
+    try:
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            yield chunk
+        # ошибки COPY выбрасываются здесь
+        await task
+    finally:
+        if not task.done():
+            task.cancel()
+
+# хранимые колонки комментария (без вычисляемой search_vector), по ним комментарии
+# переносятся между таблицей комментариев, архивом и секциями
+COMMENT_COLUMNS = ('id', 'path', 'level', 'item_id', 'data_type', 'comment_text', 'is_deleted',
+                   'date_created', 'date_modified', 'user_id', 'service_id', 'scope')
+
+# Перенос в архив пачки страниц, комментарии которых не менялись с даты cutoff: страницы отмечаются в item_versions,
+# их комментарии удаляются из основной таблицы и вставляются в comments_archive одним запросом. Страницы, версию
+# которых в этот момент изменяет другая транзакция, пропускаются (SKIP LOCKED) и попадут в следующий запуск.
+# Версия страницы увеличивается, чтобы ответы, закэшированные во время переноса, не отдавались дальше.
+ARCHIVE_ITEMS_SQL = text("""
+    WITH items AS (
+        UPDATE item_versions
+           SET is_archived = true,
+               version = version + 1
+         WHERE (service_id, data_type, item_id) IN (
+                SELECT service_id, data_type, item_id
+                  FROM item_versions
+                 WHERE NOT is_archived
+                   AND date_modified < :cutoff
+                 ORDER BY date_modified
+                 LIMIT :batch_size
+                   FOR UPDATE SKIP LOCKED)
+        RETURNING service_id, data_type, item_id
+    ), moved AS (
+        DELETE FROM comments
+         USING items
+         WHERE comments.service_id = items.service_id
+           AND comments.data_type = items.data_type
+           AND comments.item_id = items.item_id
+        RETURNING {comments_columns}
+    ), archived AS (
+        INSERT INTO comments_archive ({columns})
+        SELECT {columns} FROM moved
+    )
+    SELECT (SELECT count(*) FROM items) AS items, (SELECT count(*) FROM moved) AS comments
+""".format(columns=', '.join(COMMENT_COLUMNS),
+           comments_columns=', '.join(f'comments.{column}' for column in COMMENT_COLUMNS)))
+
+# Возврат комментариев архивных страниц в основную таблицу. Для неархивных страниц запрос сводится к поиску
+# по первичному ключу item_versions, поэтому выполняется перед каждым изменением комментариев без проверок.
+# Версию не увеличивает: это делает изменение, ради которого страница возвращается.
+RESTORE_ITEMS_SQL = text("""
+    WITH items AS (
+        UPDATE item_versions
+           SET is_archived = false
+         WHERE service_id = CAST(:service_id AS uuid)
+           AND data_type = CAST(:data_type AS varchar)
+           AND item_id = ANY(CAST(:item_ids AS varchar[]))
+           AND is_archived
+        RETURNING service_id, data_type, item_id
+    ), moved AS (
+        DELETE FROM comments_archive
+         USING items
+         WHERE comments_archive.service_id = items.service_id
+           AND comments_archive.data_type = items.data_type
+           AND comments_archive.item_id = items.item_id
+        RETURNING {archive_columns}
+    )
+    INSERT INTO comments ({columns})
+    SELECT {columns} FROM moved
+""".format(columns=', '.join(COMMENT_COLUMNS),
+           archive_columns=', '.join(f'comments_archive.{column}' for column in COMMENT_COLUMNS)))\
+    .bindparams(bindparam('service_id', type_=UUID(as_uuid=True)))
+
+
+# комментарии основной таблицы и архива одним запросом
+def all_comments():
+    """Функция построения запроса UNION ALL комментариев основной таблицы и архива (колонки COMMENT_COLUMNS)"""
+    comments = models.Comment.__table__
+    archive = models.ArchivedComment.__table__
+    return union_all(select(*(comments.c[column] for column in COMMENT_COLUMNS)),
+                     select(*(archive.c[column] for column in COMMENT_COLUMNS)))
+
+# перенос пачки неактивных страниц в архив
+async def archive_items(db: AsyncSession, cutoff: datetime, batch_size: int):
+    """
+    Функция переноса в архив комментариев не более batch_size страниц, не изменявшихся с даты cutoff (UTC),
+    в отдельной транзакции. Возвращает строку (items, comments) с количеством перенесенных страниц и комментариев
+    """
+    result = (await db.execute(ARCHIVE_ITEMS_SQL, {'cutoff': cutoff, 'batch_size': batch_size})).one()
+    await db.commit()
+    return result
+
+# возврат комментариев страниц из архива
+async def restore_items(db: AsyncSession, service_id: uuid.UUID, data_type: str, item_ids: List[str]):
+    """
+    Функция возврата комментариев архивных страниц из item_ids в основную таблицу, выполняется в транзакции
+    изменения комментариев. Возвращает количество возвращенных комментариев
+    """
+    result = await db.execute(RESTORE_ITEMS_SQL, {'service_id': service_id,
+                                                  'data_type': data_type,
+                                                  'item_ids': item_ids})
+    return result.rowcount
+
+# получение архивных страниц из списка
+async def get_archived_items(db: AsyncSession, service_id: uuid.UUID, data_type: str, item_ids: List[str]):
+    """Функция получения множества страниц из item_ids, комментарии которых находятся в архиве"""
+    rows = (await db.execute(select(models.ItemVersion.item_id)
+                             .where(models.ItemVersion.service_id == service_id,
+                                    models.ItemVersion.data_type == data_type,
+                                    models.ItemVersion.item_id == any_(bindparam('item_ids', item_ids,
+                                                                               type_=ARRAY(String))),
+                                    models.ItemVersion.is_archived.is_(True)))).scalars().all()
+    return set(rows)
+
+# Перенос комментариев сервиса из секции по умолчанию в отдельную секцию. Пока комментарии переносятся,
+# запись в секцию по умолчанию (т.е. комментарии всех сервисов без своей секции) заблокирована, а при
+# присоединении секции секция по умолчанию проверяется сканированием и блокируется и для чтения.
+# Поэтому выносить сервис лучше, пока его комментариев немного, или в период низкой нагрузки.
+ATTACH_PARTITION_SQL = (
+    # внешний ключ import_map на комментарии (до миграции архива) проверяется при фиксации транзакции,
+    # когда перенесенные строки уже в новой секции; ограничение создано DEFERRABLE, поэтому команда
+    # действует и в БД, где оно создано без INITIALLY DEFERRED
+    "SET CONSTRAINTS ALL DEFERRED",
+    "LOCK TABLE comments_default IN SHARE ROW EXCLUSIVE MODE",
+    # вычисляемые колонки копируются с выражением, иначе секцию нельзя присоединить
+    "CREATE TABLE {partition} (LIKE comments INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING GENERATED)",
+    "WITH moved AS (DELETE FROM comments_default WHERE service_id = '{service_id}' RETURNING {columns}) "
+    "INSERT INTO {partition} ({columns}) SELECT {columns} FROM moved",
+    # ограничение позволяет присоединить секцию без повторной проверки всех строк
+    "ALTER TABLE {partition} ADD CONSTRAINT {partition}_service_id_check CHECK (service_id = '{service_id}')",
+    "ALTER TABLE comments ATTACH PARTITION {partition} FOR VALUES IN ('{service_id}')",
+    "ALTER TABLE {partition} DROP CONSTRAINT {partition}_service_id_check",
+)
+
+
+# имя секции комментариев сервиса
+def service_partition_name(service_id: uuid.UUID):
+    return f'comments_{service_id.hex}'
+
+# выделение комментариев сервиса в отдельную секцию
+async def attach_service_partition(db: AsyncSession, service_id: uuid.UUID):
+    """
+    Функция создания отдельной секции таблицы комментариев для сервиса и переноса в нее его комментариев
+    из секции по умолчанию в одной транзакции. Индексы секции создаются при присоединении по индексам
+    таблицы комментариев. Возвращает имя секции
+    """
+    partition = service_partition_name(service_id)
+    for statement in ATTACH_PARTITION_SQL:
+        # service_id - UUID, а имя секции составлено из его шестнадцатеричного представления,
+        # поэтому подстановка в текст DDL безопасна
+        await db.execute(text(statement.format(partition=partition, service_id=service_id,
+                                               columns=', '.join(COMMENT_COLUMNS))))
+    await db.commit()
+    return partition
 
 # создание сервиса
-def create_service(db: Session, service_name: str):
+async def create_service(db: AsyncSession, service_name: str):
     service_row = models.Service(service_name=service_name)
     db.add(service_row)
-    db.commit()
+    await db.commit()
     return service_row
 
 # получение данных сервиса по его названию
-def get_service_by_name(db: Session, service_name: str):
-    return db.query(models.Service).filter(models.Service.service_name == service_name).one()
+async def get_service_by_name(db: AsyncSession, service_name: str):
+    return (await db.execute(select(models.Service).where(models.Service.service_name == service_name))).scalar_one()
+
+# замена токена сервиса
+async def update_service_token(db: AsyncSession, service_id: uuid.UUID):
+    service_row = (await db.execute(select(models.Service).where(models.Service.id == service_id))).scalar_one()
+    service_row.token = secrets.token_hex(16)
+    await db.commit()
+    return service_row
 
 # получения токена сервиса по его id
-def get_token_by_service_id(db: Session, service_id: uuid.UUID):
-    return db.query(models.Service.token).filter(models.Service.id == service_id).one()[0]
+async def get_token_by_service_id(db: AsyncSession, service_id: uuid.UUID):
+    return (await db.execute(select(models.Service.token).where(models.Service.id == service_id))).scalar_one()
 #
 # if __name__ == '__main__':
+#     import asyncio
 #     from app.db.session import SessionLocal
 #
 #     db = SessionLocal()
-#     comments = get_comments(db=db, presentation=schemas.PresentationList.tree, service_id=uuid.UUID('15597d03-2868-4224-a219-e524bf259080'),
-#                  item_id='page123')
+#     comments = asyncio.run(get_comments(db=db, presentation=schemas.PresentationList.tree, service_id=uuid.UUID('15597d03-2868-4224-a219-e524bf259080'),
+#                  item_id='page123'))
 #     for comment in comments:
 #         # comment = schemas.CommentOut(**comment)
 #         print(comment)
@@ -0,0 +1,243 @@
+"""
+Рассылка событий изменения комментариев подписчикам страниц.
+
+Изменения комментариев публикуются в канал COMMENTS_EVENTS_CHANNEL командой pg_notify (см. crud.notify_event),
+каждый процесс держит одно отдельное соединение с LISTEN на этот канал и раздает события своим подписчикам.
+Поэтому события доходят до подписчиков всех воркеров без внешнего брокера, а подписка в простое стоит
+одной очереди в памяти и не занимает соединение с БД.
+
+Для create и update комментарий читается из БД один раз на событие (и только если у страницы есть подписчики
+в этом процессе), а не отдельно для каждого подписчика. События обрабатываются по порядку одной задачей,
+накопившиеся за время чтения события обрабатываются пачкой с чтением комментариев одним запросом.
+
+Событие reload означает, что часть событий могла быть пропущена (переподключение к БД или переполнение
+очереди подписчика), и страницу нужно перечитать обычным запросом.
+"""
+import asyncio
+import logging
+import uuid
+from contextlib import asynccontextmanager
+from typing import Dict, Set, Tuple
+
+import asyncpg
+import orjson
+
+from app.comment import crud
+from app.db.session import SessionLocal, engine
+from app.utils import convertors
+
+logger = logging.getLogger(__name__)
+
+# пауза перед повторным подключением слушателя после ошибки, в секундах
+RECONNECT_DELAY = 1
+
+RELOAD_EVENT = {'event': 'reload'}
+
+
+class EventHub:
+    """
+    Подписки процесса на события страниц: ключ подписки (service_id, data_type, item_id, scope) -> очереди подписчиков.
+    Соединение для LISTEN открывается при первой подписке (см. ready) и переподключается при обрыве.
+    """
+
+    def __init__(self, dsn: str, channel: str, queue_size: int, keepalive: float):
+        self.dsn = dsn
+        self.channel = channel
+        self.queue_size = queue_size
+        self.keepalive = keepalive
+        self.received = 0
+        self.dropped = 0
+        self._subscribers: Dict[Tuple[str, str, str, str], Set[asyncio.Queue]] = {}
+        self._pending = []
+        self._has_pending = None
+        self._listening = None
+        self._listener = None
+        self._dispatcher = None
+
+    # запуск прослушивания и ожидание его готовности
+    async def ready(self) -> bool:
+        """
+        Функция запуска слушателя (если он еще не запущен) и ожидания LISTEN не дольше keepalive секунд.
+        События, опубликованные до LISTEN, подписчику не придут, поэтому подписка начинается после готовности.
+        Возвращает False, если соединение с БД установить не удалось
+        """
+        if self._listener is None or self._listener.done():
+            # объекты asyncio создаются в цикле событий приложения, а не при импорте модуля
+            if self._dispatcher is not None:
+                self._dispatcher.cancel()
+            self._listening = asyncio.Event()
+            self._has_pending = asyncio.Event()
+            self._listener = asyncio.create_task(self._listen())
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        try:
+            await asyncio.wait_for(self._listening.wait(), timeout=self.keepalive)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    # подписка на события страницы
+    @asynccontextmanager
+    async def subscribe(self, service_id: uuid.UUID, data_type: str, item_id: str, scope: str):
+        """Асинхронный контекстный менеджер подписки, возвращает очередь событий (словарей)"""
+        key = (str(service_id), data_type, item_id, scope)
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self._subscribers.setdefault(key, set()).add(queue)
+        try:
+            yield queue
+        finally:
+            queues = self._subscribers.get(key)
+            if queues is not None:
+                queues.discard(queue)
+                if not queues:
+                    del self._subscribers[key]
+
+    # прослушивание канала событий с переподключением
+    async def _listen(self):
+        reconnected = False
+        while True:
+            try:
+                connection = await asyncpg.connect(self.dsn)
+            except (OSError, asyncpg.PostgresError) as err:
+                logger.warning('events listener connection failed: %s', err)
+                await asyncio.sleep(RECONNECT_DELAY)
+                continue
+            try:
+                await connection.add_listener(self.channel, self._on_notify)
+                if reconnected:
+                    # пока соединения не было, события могли быть пропущены
+                    self._broadcast(RELOAD_EVENT)
+                self._listening.set()
+                # обрыв соединения без ответа сервера обнаруживается только при запросе
+                while not connection.is_closed():
+                    await asyncio.sleep(self.keepalive)
+                    await connection.execute('SELECT 1')
+            except (OSError, asyncpg.PostgresError, asyncpg.InterfaceError) as err:
+                logger.warning('events listener connection lost: %s', err)
+            finally:
+                self._listening.clear()
+                if not connection.is_closed():
+                    connection.terminate()
+            reconnected = True
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    # обработка уведомления Postgres
+    def _on_notify(self, connection, pid, channel, payload):
+        self.received += 1
+        try:
+            event = orjson.loads(payload)
+            key = (event['service_id'], event['data_type'], event['item_id'], event['scope'])
+        except (orjson.JSONDecodeError, KeyError, TypeError):
+            logger.warning('invalid event payload: %r', payload)
+            return
+        if key in self._subscribers:
+            self._pending.append((key, event))
+            self._has_pending.set()
+
+    # обработка накопленных уведомлений по порядку
+    async def _dispatch(self):
+        while True:
+            await self._has_pending.wait()
+            self._has_pending.clear()
+            pending, self._pending = self._pending, []
+            try:
+                rows = await self._read_comments(pending)
+            except Exception as err:
+                logger.warning('failed to read comments for events: %s', err)
+                for key in dict.fromkeys(key for key, event in pending):
+                    self._publish(key, RELOAD_EVENT)
+                continue
+            for key, event in pending:
+                if event['event'] == 'delete':
+                    self._publish(key, {'event': 'delete', 'id': event['id']})
+                else:
+                    row = rows.get((event['service_id'], event['id']))
+                    if row is not None:
+                        self._publish(key, {'event': event['event'], 'comment': convertors.comment_row_2_dict(row)})
+
+    # чтение созданных и измененных комментариев пачки уведомлений
+    async def _read_comments(self, pending) -> dict:
+        ids = {}
+        for key, event in pending:
+            if event['event'] != 'delete' and key in self._subscribers:
+                ids.setdefault(event['service_id'], set()).add(event['id'])
+        rows = {}
+        if ids:
+            async with SessionLocal() as db:
+                for service_id, comment_ids in ids.items():
+                    for row in await crud.get_comment_rows(db=db, service_id=uuid.UUID(service_id),
+                                                           ids=list(comment_ids)):
+                        rows[(service_id, row.id)] = row
+        return rows
+
+    # отправка события подписчикам страницы
+    def _publish(self, key, event: dict):
+        for queue in self._subscribers.get(key, ()):
+            self._put(queue, event)
+
+    # отправка события всем подписчикам процесса
+    def _broadcast(self, event: dict):
+        for queues in self._subscribers.values():
+            for queue in queues:
+                self._put(queue, event)
+
+    # постановка события в очередь подписчика
+    def _put(self, queue: asyncio.Queue, event: dict):
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # подписчик не успевает забирать события: отбрасываем накопленные и просим перечитать страницу
+            self.dropped += 1
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(RELOAD_EVENT)
+
+    # остановка прослушивания
+    async def close(self):
+        for task in (self._listener, self._dispatcher):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._listener = self._dispatcher = None
+
+    def stats(self):
+        return {'subscriptions': sum(len(queues) for queues in self._subscribers.values()),
+                'items': len(self._subscribers),
+                'listening': self._listening is not None and self._listening.is_set(),
+                'received': self.received,
+                'dropped': self.dropped}
+
+
+# формирование события Server-Sent Events
+def sse_message(event: dict) -> bytes:
+    """Функция сериализации события в формат text/event-stream"""
+    return b'event: ' + event['event'].encode() + b'\ndata: ' + orjson.dumps(event) + b'\n\n'
+
+
+# keep-alive сообщение SSE (комментарий), не дает прокси закрыть простаивающее соединение
+SSE_KEEPALIVE = b': keep-alive\n\n'
+
+
+# поток событий подписки в формате Server-Sent Events
+async def sse_stream(hub: EventHub, service_id: uuid.UUID, data_type: str, item_id: str, scope: str):
+    """
+    Асинхронный генератор сообщений SSE подписки на страницу: сначала событие ready, затем события
+    изменения комментариев и keep-alive при простое. Завершается при отключении клиента.
+    Перед началом потока нужно дождаться готовности слушателя (EventHub.ready)
+    """
+    async with hub.subscribe(service_id=service_id, data_type=data_type, item_id=item_id, scope=scope) as queue:
+        yield sse_message({'event': 'ready'})
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), timeout=hub.keepalive)
+            except asyncio.TimeoutError:
+                yield SSE_KEEPALIVE
+                continue
+            yield sse_message(event)
+
+
+# DSN основной БД для asyncpg (без указания драйвера SQLAlchemy)
+def listener_dsn():
+    return engine.url.set(drivername='postgresql').render_as_string(hide_password=False)
@@ -0,0 +1,47 @@
+"""
+Выгрузка всех комментариев сервиса для аналитики.
+
+Форматы:
+
+- ndjson - по одному комментарию в строке, строки читаются из БД через серверный курсор пачками;
+- csv - с заголовком, данные формирует сервер БД командой COPY TO.
+
+В обоих случаях память на выгрузку не зависит от числа комментариев. Колонки описаны в crud.EXPORT_COLUMNS.
+"""
+import uuid
+from datetime import datetime
+from typing import AsyncIterator
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.comment import crud, schemas
+from app.utils import convertors
+
+MEDIA_TYPES = {schemas.ExportFormat.ndjson: 'application/x-ndjson',
+               schemas.ExportFormat.csv: 'text/csv'}
+
+
+# выгрузка комментариев сервиса
+async def export_comments(db: AsyncSession,
+                          service_id: uuid.UUID,
+                          export_format: schemas.ExportFormat,
+                          batch_size: int,
+                          data_type: str = None,
+                          created_from: datetime = None,
+                          created_to: datetime = None,
+                          modified_since: datetime = None) -> AsyncIterator[bytes]:
+    """
+    Асинхронный генератор частей выгрузки комментариев сервиса в формате export_format,
+    фильтры как у crud.export_query, batch_size - размер пачки строк для ndjson
+    """
+    query = crud.export_query(service_id=service_id,
+                              data_type=data_type,
+                              created_from=convertors.naive_utc(created_from),
+                              created_to=convertors.naive_utc(created_to),
+                              modified_since=convertors.naive_utc(modified_since))
+    if export_format == schemas.ExportFormat.csv:
+        async for chunk in crud.copy_query(db=db, query=query, format='csv', header=True):
+            yield chunk
+    else:
+        async for rows in crud.stream_comments(db=db, query=query, batch_size=batch_size):
+            yield b''.join(convertors.export_row_2_ndjson(row) for row in rows)
@@ -0,0 +1,238 @@
+"""
+Импорт комментариев с других платформ.
+
+Входные данные - NDJSON, одна строка - один комментарий:
+
+    {"id": "c-2", "parent_id": "c-1", "data_type": "comments", "item_id": "page123",
+     "comment_text": "Текст", "scope": "all", "is_deleted": false,
+     "date_created": "2021-05-01T12:00:00Z",
+     "user": {"external_id": "u-1", "first_name": "Имя", "last_name": "Фамилия", "user_group": "reader"}}
+
+id и parent_id - идентификаторы комментариев на исходной платформе. Родитель должен встречаться в данных раньше
+ответа или быть импортирован ранее. Необязательные поля: parent_id, scope (по умолчанию all), is_deleted,
+date_created (по умолчанию текущее время). date_modified в данных не учитывается: дата изменения импортированных
+комментариев - время их загрузки, иначе клиенты, получающие изменения страницы по токену since, их не увидят.
+
+Комментарии загружаются пачками, каждая пачка в своей транзакции. Загруженные комментарии запоминаются
+в таблице import_map, поэтому после сбоя импорт можно запустить повторно с теми же данными: уже загруженные
+комментарии будут пропущены.
+"""
+import uuid
+from datetime import datetime, timezone
+from typing import AsyncIterable, AsyncIterator, Callable, Optional
+
+import orjson
+from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.comment import crud, schemas
+
+DATA_TYPES = {data_type.value for data_type in schemas.DataType}
+SCOPES = {scope.value for scope in schemas.Scope}
+
+
+class ImportLineError(ValueError):
+    """Ошибка в строке импортируемых данных"""
+
+    def __init__(self, line_no: int, message: str):
+        super().__init__(f'line {line_no}: {message}')
+        self.line_no = line_no
+
+
+# разбиение потока байтов на строки
+async def iter_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    """Асинхронный генератор строк из потока байтов произвольного размера (например, тела запроса)"""
+    tail = b''
+    async for chunk in chunks:
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line
+    if tail:
+        yield tail
+
+
+# разбор даты импортируемого комментария
+def parse_date(line_no: int, value) -> datetime:
+    """Функция разбора даты в формате ISO 8601, даты с часовым поясом приводятся к UTC (в БД хранятся даты UTC)"""
+    if not isinstance(value, str):
+        raise ImportLineError(line_no, 'date must be an ISO 8601 string')
+    try:
+        date = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ImportLineError(line_no, f'invalid date {value!r}')
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+# разбор строки импортируемых данных
+def parse_line(line_no: int, line: bytes) -> dict:
+    """
+    Функция разбора и проверки строки импортируемых данных.
+    Строки проверяются без создания pydantic-моделей, т.к. на миллионах комментариев это заметно замедляет импорт.
+    Возвращает словарь с полями комментария для crud.insert_imported_comments (кроме id, path, user_id
+    и date_modified)
+    """
+    try:
+        data = orjson.loads(line)
+    except orjson.JSONDecodeError as err:
+        raise ImportLineError(line_no, f'invalid json: {err}')
+    if not isinstance(data, dict):
+        raise ImportLineError(line_no, 'comment must be a json object')
+
+    source_id = data.get('id')
+    if not isinstance(source_id, (str, int)) or source_id == '':
+        raise ImportLineError(line_no, 'id is required')
+    parent_source_id = data.get('parent_id')
+    if parent_source_id is not None and not isinstance(parent_source_id, (str, int)):
+        raise ImportLineError(line_no, 'parent_id must be a string')
+    data_type = data.get('data_type')
+    if data_type not in DATA_TYPES:
+        raise ImportLineError(line_no, f'data_type must be one of {sorted(DATA_TYPES)}')
+    item_id = data.get('item_id')
+    if not isinstance(item_id, str) or not item_id:
+        raise ImportLineError(line_no, 'item_id is required')
+    scope = data.get('scope') or schemas.Scope.all.value
+    if scope not in SCOPES:
+        raise ImportLineError(line_no, f'scope must be one of {sorted(SCOPES)}')
+    comment_text = data.get('comment_text')
+    if not isinstance(comment_text, str):
+        raise ImportLineError(line_no, 'comment_text is required')
+    comment_text = comment_text.strip()
+    if not schemas.CommentTextField.min_length <= len(comment_text) <= schemas.CommentTextField.max_length:
+        raise ImportLineError(line_no, f'comment_text length must be between {schemas.CommentTextField.min_length} '
+                                       f'and {schemas.CommentTextField.max_length}')
+    user = data.get('user')
+    if not isinstance(user, dict):
+        raise ImportLineError(line_no, 'user is required')
+
+    date_created = data.get('date_created')
+    date_created = parse_date(line_no, date_created) if date_created is not None else datetime.utcnow()
+
+    return {'line_no': line_no,
+            'source_id': str(source_id),
+            'parent_source_id': str(parent_source_id) if parent_source_id is not None else None,
+            'data_type': data_type,
+            'item_id': item_id,
+            'comment_text': comment_text,
+            'is_deleted': bool(data.get('is_deleted', False)),
+            'date_created': date_created,
+            'user': user,
+            'scope': scope}
+
+
+# загрузка пачки комментариев
+async def import_chunk(db: AsyncSession, service_id: uuid.UUID, rows: list) -> int:
+    """
+    Функция загрузки пачки разобранных комментариев (см. parse_line) без завершения транзакции.
+    Уже импортированные комментарии пропускаются, пути новых комментариев строятся от путей родителей
+    из этой же пачки или из ранее импортированных, дата изменения - время загрузки пачки.
+    Возвращает количество загруженных комментариев
+    """
+    source_ids = {row['source_id'] for row in rows}
+    source_ids.update(row['parent_source_id'] for row in rows if row['parent_source_id'] is not None)
+    imported = await crud.get_imported_comments(db=db, service_id=service_id, source_ids=list(source_ids))
+
+    new_rows = []
+    seen = set()
+    for row in rows:
+        if row['source_id'] in imported:
+            continue
+        if row['source_id'] in seen:
+            raise ImportLineError(row['line_no'], f"duplicate id {row['source_id']!r}")
+        seen.add(row['source_id'])
+        new_rows.append(row)
+    if not new_rows:
+        return 0
+
+    users = {}
+    for row in new_rows:
+        external_id = row['user'].get('external_id')
+        if external_id not in users:
+            try:
+                users[external_id] = schemas.User.parse_obj(row['user'])
+            except ValidationError as err:
+                raise ImportLineError(row['line_no'], f'invalid user: {err}')
+        row['user'] = users[external_id]
+    user_ids = await crud.get_or_create_users(db=db, service_id=service_id,
+                                              users={user.external_id: user for user in users.values()})
+
+    ids = await crud.next_comment_ids(db=db, count=len(new_rows))
+    imported_at = datetime.utcnow()
+    # source_id -> (path, data_type, item_id) комментариев этой пачки
+    placed = {}
+    for row, comment_id in zip(new_rows, ids):
+        # метка пути совпадает с вычисляемой при создании комментария (lpad(id, 9, '0'))
+        label = f'{comment_id:09d}'
+        parent_source_id = row['parent_source_id']
+        if parent_source_id is None:
+            path = label
+        else:
+            if parent_source_id in placed:
+                parent_path, parent_data_type, parent_item_id = placed[parent_source_id]
+            elif parent_source_id in imported:
+                parent = imported[parent_source_id]
+                parent_path, parent_data_type, parent_item_id = str(parent.path), parent.data_type, parent.item_id
+            else:
+                raise ImportLineError(row['line_no'], f'parent comment {parent_source_id!r} not found')
+            if (parent_data_type, parent_item_id) != (row['data_type'], row['item_id']):
+                raise ImportLineError(row['line_no'], 'parent comment belongs to another item')
+            path = f'{parent_path}.{label}'
+        placed[row['source_id']] = (path, row['data_type'], row['item_id'])
+        row['id'] = comment_id
+        row['path'] = path
+        row['date_modified'] = imported_at
+        row['user_id'] = user_ids[row['user'].external_id]
+
+    # комментарии архивных страниц возвращаются в основную таблицу вместе с импортируемыми
+    items = {}
+    for row in new_rows:
+        items.setdefault(row['data_type'], set()).add(row['item_id'])
+    for data_type, item_ids in items.items():
+        await crud.restore_items(db=db, service_id=service_id, data_type=data_type, item_ids=list(item_ids))
+    await crud.insert_imported_comments(db=db, service_id=service_id, rows=new_rows)
+    return len(new_rows)
+
+
+# импорт комментариев
+async def import_comments(db: AsyncSession,
+                          service_id: uuid.UUID,
+                          lines: AsyncIterable[bytes],
+                          chunk_size: int,
+                          progress: Optional[Callable[[schemas.ImportResult], None]] = None) -> schemas.ImportResult:
+    """
+    Функция импорта комментариев из строк NDJSON. Каждая пачка из chunk_size строк загружается и фиксируется
+    в отдельной транзакции, после нее вызывается progress с текущим итогом.
+    При ошибке в данных выбрасывается ImportLineError, пачки до ошибочной остаются загруженными.
+    """
+    result = schemas.ImportResult()
+    rows = []
+    line_no = 0
+    async for line in lines:
+        line_no += 1
+        if not line.strip():
+            continue
+        rows.append(parse_line(line_no, line))
+        if len(rows) >= chunk_size:
+            await import_rows(db, service_id, rows, result, progress)
+            rows = []
+    if rows:
+        await import_rows(db, service_id, rows, result, progress)
+    return result
+
+
+# загрузка и фиксация пачки комментариев с учетом итога
+async def import_rows(db: AsyncSession, service_id: uuid.UUID, rows: list, result: schemas.ImportResult,
+                      progress: Optional[Callable[[schemas.ImportResult], None]]):
+    """Функция загрузки пачки комментариев в отдельной транзакции с обновлением итога импорта"""
+    try:
+        imported = await import_chunk(db=db, service_id=service_id, rows=rows)
+        await db.commit()
+    except BaseException:
+        await db.rollback()
+        raise
+    result.imported += imported
+    result.skipped += len(rows) - imported
+    if progress:
+        progress(result)
@@ -2,15 +2,20 @@ import secrets
 import uuid
 from datetime import datetime
 
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime, Sequence, Index, func
-from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy.orm import relationship, remote, foreign
-from sqlalchemy_utils import Ltree, LtreeType
+from sqlalchemy import (BigInteger, Boolean, Column, Computed, ForeignKey, Integer, PrimaryKeyConstraint, String,
+                        DateTime, Sequence, Index, false, func)
+from sqlalchemy.dialects.postgresql import TSVECTOR, UUID
+from sqlalchemy.orm import deferred, relationship, remote, foreign
+from sqlalchemy_utils import LtreeType
 
-from app.db.session import Base, engine
+from app.core.config import COMMENTS_SEARCH_LANGUAGE
+from app.db.session import Base
 
 comments_id_seq = Sequence('comments_id_seq')
 
+# выражение колонки полнотекстового поиска по тексту комментария
+SEARCH_VECTOR_SQL = f"to_tsvector('{COMMENTS_SEARCH_LANGUAGE}'::regconfig, comment_text)"
+
 
 class User(Base):
     """Класс таблицы БД для хранения пользователей"""
@@ -23,6 +28,11 @@ class User(Base):
     last_name = Column(String)
     user_group = Column(String)
 
+    __table_args__ = (
+        # пользователь внешнего сервиса уникален, по индексу выполняется upsert при публикации комментария
+        Index('ix_users_service_id_external_id', service_id, external_id, unique=True),
+    )
+
 
 class Service(Base):
     __tablename__ = "services"
@@ -31,7 +41,7 @@ class Service(Base):
     service_name = Column(String, nullable=False, unique=True)
     # login = Column(String)
     # pass_hash = Column(String)
-    token = Column(String, default=secrets.token_hex(16))
+    token = Column(String, default=lambda: secrets.token_hex(16))
 
 
 class Comment(Base):
@@ -42,10 +52,14 @@ class Comment(Base):
     Для того чтобы postgree его понимал, необходимо
     в базе включить расширение командой CREATE EXTENSION IF NOT EXISTS ltree;
     Сделать это необходимо один раз после создания БД.
+    Таблица секционирована списком по service_id: сервисы по умолчанию хранятся в секции comments_default,
+    крупные сервисы выносятся в отдельные секции (python -m app.cli attach-partition). Поэтому первичный ключ
+    включает service_id, и все запросы к комментариям должны фильтровать по service_id, чтобы затрагивать
+    только одну секцию.
     """
     __tablename__ = "comments"
 
-    id = Column(Integer, comments_id_seq, primary_key=True)
+    id = Column(Integer, comments_id_seq, nullable=False)
     path = Column(LtreeType, nullable=False)
     level = Column(Integer, nullable=False)
     item_id = Column(String, nullable=False)
@@ -55,8 +69,10 @@ class Comment(Base):
     date_created = Column(DateTime, default=datetime.utcnow, server_default=func.now())
     date_modified = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, server_default=func.now())
     user_id = Column(Integer, ForeignKey('users.id'))
-    service_id = Column(UUID(as_uuid=True), ForeignKey('services.id'))
+    service_id = Column(UUID(as_uuid=True), ForeignKey('services.id'), nullable=False)
     scope = Column(String, default="all")
+    # вычисляется сервером при записи, в ORM-объекты не загружается
+    search_vector = deferred(Column(TSVECTOR, Computed(SEARCH_VECTOR_SQL, persisted=True)))
 
     parent = relationship(
         'Comment',
@@ -65,20 +81,98 @@ class Comment(Base):
         viewonly=True,
     )
 
-    def __init__(self, item_id, comment_text, scope, user_id, service_id, data_type, parent_path=None):
-        _id = engine.execute(comments_id_seq)
-        self.id = _id
-        ltree_id = Ltree(str(_id).zfill(9))
-        ltree_parent = Ltree(str(parent_path).zfill(9))
-        self.path = ltree_id if parent_path is None else ltree_parent + ltree_id
-        self.level = func.nlevel(str(self.path))
-        self.item_id = item_id
-        self.comment_text = comment_text
-        self.scope = scope
-        self.user_id = user_id
-        self.service_id = service_id
-        self.data_type = data_type
-
     __table_args__ = (
+        PrimaryKeyConstraint(service_id, id, name='comments_pkey'),
         Index('ix_comments_path', path, postgresql_using="gist"),
+        # индексы под выборку комментариев страницы в древовидном и плоском виде
+        Index('ix_comments_item_path', service_id, data_type, item_id, scope, path),
+        Index('ix_comments_item_date_created', service_id, data_type, item_id, scope, date_created, id),
+        # индекс под запрос изменений страницы (since)
+        Index('ix_comments_item_date_modified', service_id, data_type, item_id, scope, date_modified, id),
+        Index('ix_comments_search_vector', 'search_vector', postgresql_using='gin'),
+        {'postgresql_partition_by': 'LIST (service_id)'},
+    )
+
+
+class ArchivedComment(Base):
+    """
+    Класс таблицы БД для хранения архивных комментариев страниц без активности (см. crud.archive_items).
+    Колонки совпадают с таблицей комментариев, поэтому запросы к комментариям строятся для любой из таблиц.
+    Таблица не секционирована и индексирована только под выдачу комментариев страницы.
+    """
+    __tablename__ = "comments_archive"
+
+    id = Column(Integer, nullable=False)
+    path = Column(LtreeType, nullable=False)
+    level = Column(Integer, nullable=False)
+    item_id = Column(String, nullable=False)
+    data_type = Column(String, nullable=False)
+    comment_text = Column(String(3000), nullable=False)
+    is_deleted = Column(Boolean, default=False)
+    date_created = Column(DateTime)
+    date_modified = Column(DateTime)
+    user_id = Column(Integer, ForeignKey('users.id'))
+    service_id = Column(UUID(as_uuid=True), ForeignKey('services.id'), nullable=False)
+    scope = Column(String, default="all")
+    search_vector = deferred(Column(TSVECTOR, Computed(SEARCH_VECTOR_SQL, persisted=True)))
+
+    __table_args__ = (
+        PrimaryKeyConstraint(service_id, id, name='comments_archive_pkey'),
+        Index('ix_comments_archive_item_path', service_id, data_type, item_id, scope, path),
+        Index('ix_comments_archive_item_date_created', service_id, data_type, item_id, scope, date_created, id),
+        Index('ix_comments_archive_search_vector', 'search_vector', postgresql_using='gin'),
+    )
+
+
+class ItemVersion(Base):
+    """
+    Класс таблицы БД для хранения версии комментариев страницы.
+    Версия увеличивается в той же транзакции, что и любое изменение комментариев страницы,
+    по ней формируется ETag и ключ кэша ответов.
+    """
+    __tablename__ = "item_versions"
+
+    service_id = Column(UUID(as_uuid=True), ForeignKey('services.id'), primary_key=True)
+    data_type = Column(String, primary_key=True)
+    item_id = Column(String, primary_key=True)
+    version = Column(BigInteger, nullable=False, default=1)
+    comments_count = Column(Integer, nullable=False, default=0)
+    date_modified = Column(DateTime, default=datetime.utcnow, server_default=func.now())
+    # комментарии страницы перенесены в архив (таблица comments_archive)
+    is_archived = Column(Boolean, nullable=False, default=False, server_default=false())
+
+    __table_args__ = (
+        # поиск страниц для архивации
+        Index('ix_item_versions_date_modified', date_modified, postgresql_where=~is_archived),
     )
+
+
+class CommentCounter(Base):
+    """
+    Класс таблицы БД для хранения счетчиков комментариев страницы в разрезе области видимости.
+    total - все комментарии, active - не удаленные, top_level - комментарии первого уровня (включая удаленные,
+    т.к. они остаются в дереве). Счетчики изменяются в тех же транзакциях, что и комментарии.
+    """
+    __tablename__ = "comment_counters"
+
+    service_id = Column(UUID(as_uuid=True), ForeignKey('services.id'), primary_key=True)
+    data_type = Column(String, primary_key=True)
+    item_id = Column(String, primary_key=True)
+    scope = Column(String, primary_key=True)
+    total = Column(Integer, nullable=False, default=0)
+    active = Column(Integer, nullable=False, default=0)
+    top_level = Column(Integer, nullable=False, default=0)
+
+
+class ImportMap(Base):
+    """
+    Класс таблицы БД для сопоставления идентификаторов комментариев, импортированных с другой платформы,
+    с идентификаторами наших комментариев. По ней находятся родители импортируемых комментариев
+    и пропускаются уже загруженные комментарии при повторном запуске импорта.
+    """
+    __tablename__ = "import_map"
+
+    service_id = Column(UUID(as_uuid=True), ForeignKey('services.id'), primary_key=True)
+    source_id = Column(String, primary_key=True)
+    # без внешнего ключа: комментарий может находиться как в comments, так и в comments_archive
+    comment_id = Column(Integer, nullable=False)
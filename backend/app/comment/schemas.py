@@ -1,7 +1,7 @@
 import uuid
 from datetime import datetime
 from enum import Enum
-from typing import Optional
+from typing import Dict, List, Optional
 
 from pydantic import BaseModel, validator, ConstrainedStr, Field
 
@@ -18,6 +18,20 @@ class PresentationList(str, Enum):
     """Список видов отображения комментариев"""
     tree = 'tree'
     flat = 'flat'
+    nested = 'nested'
+    roots = 'roots'
+
+
+class ExportFormat(str, Enum):
+    """Список форматов выгрузки комментариев"""
+    ndjson = 'ndjson'
+    csv = 'csv'
+
+
+class SearchOrder(str, Enum):
+    """Список сортировок результатов поиска"""
+    rank = 'rank'
+    date = 'date'
 
 
 class DataType(str, Enum):
@@ -74,6 +88,80 @@ class CommentOut(BaseModel):
         orm_mode = True
 
 
+class CommentsPage(BaseModel):
+    """Схема страницы отдаваемых комментариев"""
+    comments: List[CommentOut]
+    next_cursor: Optional[str] = Field(description="Курсор следующей страницы, отсутствует на последней странице")
+    changes_token: Optional[str] = Field(description="Токен для запроса изменений после этого ответа (параметр since)")
+
+
+class NestedComment(CommentOut):
+    """Схема комментария во вложенном виде: ответы к комментарию отдаются в поле children"""
+    children: List['NestedComment'] = Field(description="Ответы на комментарий, вошедшие в страницу")
+
+
+NestedComment.update_forward_refs()
+
+
+class NestedCommentsPage(BaseModel):
+    """Схема страницы комментариев во вложенном виде"""
+    comments: List[NestedComment]
+    next_cursor: Optional[str] = Field(description="Курсор следующей страницы, отсутствует на последней странице")
+    changes_token: Optional[str] = Field(description="Токен для запроса изменений после этого ответа (параметр since)")
+
+
+class RootComment(CommentOut):
+    """Схема комментария в виде roots: количество прямых ответов и первые из них"""
+    replies_count: int = Field(description="Количество прямых ответов, включая удаленные")
+    replies: List[CommentOut] = Field(description="Первые прямые ответы (не больше preview)")
+
+
+class RootsPage(BaseModel):
+    """Схема страницы комментариев в виде roots"""
+    comments: List[RootComment]
+    next_cursor: Optional[str] = Field(description="Курсор следующей страницы, отсутствует на последней странице")
+    changes_token: Optional[str] = Field(description="Токен для запроса изменений после этого ответа (параметр since)")
+
+
+class SearchResult(CommentOut):
+    """Схема найденного комментария"""
+    data_type: str
+    item_id: str
+    rank: float = Field(description="Релевантность комментария запросу")
+
+
+class SearchPage(BaseModel):
+    """Схема страницы результатов поиска комментариев"""
+    comments: List[SearchResult]
+    next_cursor: Optional[str] = Field(description="Курсор следующей страницы, отсутствует на последней странице")
+
+
+class CommentsBatch(BaseModel):
+    """Схема комментариев нескольких страниц"""
+    items: Dict[str, List[CommentOut]] = Field(description="Комментарии по идентификаторам страниц")
+
+
+class CommentsCount(BaseModel):
+    """Схема счетчиков комментариев страницы"""
+    total: int = Field(0, description="Количество всех комментариев, включая удаленные")
+    active: int = Field(0, description="Количество не удаленных комментариев")
+    top_level: int = Field(0, description="Количество комментариев первого уровня, включая удаленные")
+
+    class Config:
+        orm_mode = True
+
+
+class CommentsCountBatch(BaseModel):
+    """Схема счетчиков комментариев нескольких страниц"""
+    items: Dict[str, CommentsCount] = Field(description="Счетчики по идентификаторам страниц")
+
+
+class ImportResult(BaseModel):
+    """Схема итога импорта комментариев"""
+    imported: int = Field(0, description="Количество загруженных комментариев")
+    skipped: int = Field(0, description="Количество пропущенных комментариев, импортированных ранее")
+
+
 class CommentUpdate(BaseModel):
     """Схема для изменяемого комментария"""
     comment_text: Optional[CommentTextField]
@@ -11,4 +11,81 @@ POSTGRES_SERVER = os.getenv("POSTGRES_SERVER")
 POSTGRES_PORT = os.getenv("POSTGRES_PORT")
 POSTGRES_DB = os.getenv("POSTGRES_DB")
 
-SQLALCHEMY_DATABASE_URL = f'postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_SERVER}:{POSTGRES_PORT}/{POSTGRES_DB}'
+SQLALCHEMY_DATABASE_URL = f'postgresql+asyncpg://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{POSTGRES_SERVER}:{POSTGRES_PORT}/{POSTGRES_DB}'
+
+# реплики для чтения: полные URL через запятую (в том же формате, что SQLALCHEMY_DATABASE_URL), пусто - без реплик
+SQLALCHEMY_REPLICA_URLS = [url.strip() for url in os.getenv("SQLALCHEMY_REPLICA_URLS", "").split(",") if url.strip()]
+# сколько секунд после изменения комментариев клиент читает с основной БД (чтение своих записей при отставании реплик)
+DB_REPLICA_PIN_SECONDS = float(os.getenv("DB_REPLICA_PIN_SECONDS", 5))
+
+# пул соединений с БД: queue (пул в процессе) или null (без пула в процессе, для PgBouncer только
+# в режиме session pooling, transaction pooling не поддерживается из-за подготовленных запросов asyncpg)
+DB_POOL_MODE = os.getenv("DB_POOL_MODE", "queue")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+# время жизни соединения в секундах, -1 - без ограничения
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+# statement_timeout в миллисекундах для всех запросов, 0 - не задавать
+DB_STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT", 0))
+
+# параметры постраничной выдачи комментариев
+COMMENTS_PAGE_LIMIT = int(os.getenv("COMMENTS_PAGE_LIMIT", 100))
+COMMENTS_PAGE_MAX_LIMIT = int(os.getenv("COMMENTS_PAGE_MAX_LIMIT", 1000))
+
+# кэш токенов сервисов для проверки подписи (в каждом процессе свой, после замены токена остальные процессы
+# принимают старый токен до SERVICE_TOKEN_CACHE_TTL секунд)
+SERVICE_TOKEN_CACHE_SIZE = int(os.getenv("SERVICE_TOKEN_CACHE_SIZE", 1024))
+SERVICE_TOKEN_CACHE_TTL = float(os.getenv("SERVICE_TOKEN_CACHE_TTL", 300))
+
+# кэш пользователей для публикации комментариев без обновления неизменившихся данных пользователя
+USERS_CACHE_SIZE = int(os.getenv("USERS_CACHE_SIZE", 10000))
+USERS_CACHE_TTL = float(os.getenv("USERS_CACHE_TTL", 300))
+
+# кэш ответов со списками комментариев: memory (в памяти процесса), redis или none (отключен)
+COMMENTS_CACHE_BACKEND = os.getenv("COMMENTS_CACHE_BACKEND", "memory")
+COMMENTS_CACHE_SIZE = int(os.getenv("COMMENTS_CACHE_SIZE", 10000))
+COMMENTS_CACHE_TTL = float(os.getenv("COMMENTS_CACHE_TTL", 60))
+COMMENTS_CACHE_REDIS_URL = os.getenv("COMMENTS_CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+# объединение одновременных одинаковых чтений страниц при промахе кэша: сколько секунд прочитанный ответ
+# хранится в памяти процесса и отдается повторным запросам без чтения из БД (время жизни результата,
+# фонового обновления нет; 0 - только объединение одновременных запросов)
+COMMENTS_SINGLEFLIGHT_TTL = float(os.getenv("COMMENTS_SINGLEFLIGHT_TTL", 0))
+COMMENTS_SINGLEFLIGHT_SIZE = int(os.getenv("COMMENTS_SINGLEFLIGHT_SIZE", 1024))
+
+# ленивая загрузка обсуждений: количество ответов в превью комментария (presentation=roots) по умолчанию
+# и максимальное, глубина поддерева при ограничении числа ответов в ветке (branch_limit) по умолчанию
+COMMENTS_ROOTS_PREVIEW = int(os.getenv("COMMENTS_ROOTS_PREVIEW", 3))
+COMMENTS_ROOTS_MAX_PREVIEW = int(os.getenv("COMMENTS_ROOTS_MAX_PREVIEW", 20))
+COMMENTS_BRANCH_DEPTH = int(os.getenv("COMMENTS_BRANCH_DEPTH", 3))
+
+# размер пачки строк при потоковой отдаче комментариев
+COMMENTS_STREAM_BATCH_SIZE = int(os.getenv("COMMENTS_STREAM_BATCH_SIZE", 500))
+
+# максимальное количество страниц в одном пакетном запросе
+COMMENTS_BATCH_MAX_ITEMS = int(os.getenv("COMMENTS_BATCH_MAX_ITEMS", 100))
+
+# количество комментариев, загружаемых в одной транзакции при импорте
+COMMENTS_IMPORT_CHUNK_SIZE = int(os.getenv("COMMENTS_IMPORT_CHUNK_SIZE", 10000))
+
+# запрос изменений (since): на сколько секунд токен отступает назад от последнего отданного изменения,
+# чтобы не пропустить изменения транзакций, начатых раньше, а зафиксированных позже (должно превышать
+# длительность транзакций изменения комментариев)
+COMMENTS_CHANGES_OVERLAP = float(os.getenv("COMMENTS_CHANGES_OVERLAP", 5))
+
+# архивация: комментарии страниц без изменений дольше COMMENTS_ARCHIVE_AFTER_DAYS дней переносятся в архив,
+# пачками по COMMENTS_ARCHIVE_BATCH_SIZE страниц в транзакции
+COMMENTS_ARCHIVE_AFTER_DAYS = int(os.getenv("COMMENTS_ARCHIVE_AFTER_DAYS", 365))
+COMMENTS_ARCHIVE_BATCH_SIZE = int(os.getenv("COMMENTS_ARCHIVE_BATCH_SIZE", 100))
+
+# конфигурация полнотекстового поиска Postgres (russian, english, simple ...), должна совпадать с той,
+# с которой миграцией создана колонка comments.search_vector
+COMMENTS_SEARCH_LANGUAGE = os.getenv("COMMENTS_SEARCH_LANGUAGE", "russian")
+
+# события изменения комментариев: канал LISTEN/NOTIFY, интервал keep-alive подписки в секундах
+# и количество неотправленных событий подписчика, после которого ему отправляется reload
+COMMENTS_EVENTS_CHANNEL = os.getenv("COMMENTS_EVENTS_CHANNEL", "comments_events")
+COMMENTS_EVENTS_KEEPALIVE = float(os.getenv("COMMENTS_EVENTS_KEEPALIVE", 15))
+COMMENTS_EVENTS_QUEUE_SIZE = int(os.getenv("COMMENTS_EVENTS_QUEUE_SIZE", 100))
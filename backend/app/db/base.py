@@ -3,4 +3,7 @@
 from app.db.session import Base  # noqa
 from app.comment.models import Comment  # noqa
 from app.comment.models import Service  # noqa
-
+from app.comment.models import ItemVersion  # noqa
+from app.comment.models import CommentCounter  # noqa
+from app.comment.models import ImportMap  # noqa
+from app.comment.models import ArchivedComment  # noqa
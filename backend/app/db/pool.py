@@ -0,0 +1,100 @@
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool
+
+
+class PoolMetrics:
+    """
+    Метрики пула соединений: сколько раз и как долго запросы ждали соединение (checkout),
+    сколько раз ожидание закончилось по таймауту, как долго соединения были заняты и сколько новых
+    соединений открыто. По ним подбирается размер пула и число воркеров под max_connections Postgres.
+    """
+
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self.checkins = 0
+        self.held_total = 0.0
+        self.held_max = 0.0
+        self.connects = 0
+
+    def add_wait(self, seconds: float):
+        self.checkouts += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+    def add_held(self, seconds: float):
+        self.checkins += 1
+        self.held_total += seconds
+        self.held_max = max(self.held_max, seconds)
+
+    def stats(self):
+        return {'checkouts': self.checkouts,
+                'wait_avg_ms': round(self.wait_total / self.checkouts * 1000, 3) if self.checkouts else 0,
+                'wait_max_ms': round(self.wait_max * 1000, 3),
+                'timeouts': self.timeouts,
+                'held_avg_ms': round(self.held_total / self.checkins * 1000, 3) if self.checkins else 0,
+                'held_max_ms': round(self.held_max * 1000, 3),
+                'connects': self.connects}
+
+
+class InstrumentedPoolMixin:
+    """
+    Замер времени получения соединения из пула (включая ожидание свободного и открытие нового)
+    и времени, в течение которого соединение занято. Метрики хранятся в пуле и начинаются заново,
+    если пул пересоздается (engine.dispose()).
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def _create_connection(self):
+        self.metrics.connects += 1
+        return super()._create_connection()
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection_record = super()._do_get()
+        except exc.TimeoutError:
+            self.metrics.timeouts += 1
+            raise
+        checkout_time = time.perf_counter()
+        self.metrics.add_wait(checkout_time - started)
+        connection_record.info['checkout_time'] = checkout_time
+        return connection_record
+
+    def _do_return_conn(self, connection_record):
+        checkout_time = connection_record.info.pop('checkout_time', None)
+        if checkout_time is not None:
+            self.metrics.add_held(time.perf_counter() - checkout_time)
+        super()._do_return_conn(connection_record)
+
+
+class InstrumentedQueuePool(InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    """Пул соединений с метриками ожидания"""
+
+
+class InstrumentedNullPool(InstrumentedPoolMixin, NullPool):
+    """
+    Режим без пула (соединение открывается на каждый checkout) с метриками,
+    используется, когда соединения пулирует внешний PgBouncer
+    """
+
+
+# состояние пула соединений и метрики
+def pool_stats(pool):
+    """Функция получения текущего состояния пула и накопленных метрик"""
+    stats = {'pool': pool.__class__.__name__}
+    if isinstance(pool, AsyncAdaptedQueuePool):
+        stats.update(size=pool.size(),
+                     checked_in=pool.checkedin(),
+                     checked_out=pool.checkedout(),
+                     overflow=pool.overflow())
+    if isinstance(pool, InstrumentedPoolMixin):
+        stats.update(pool.metrics.stats())
+    return stats
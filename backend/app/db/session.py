@@ -1,9 +1,86 @@
-from sqlalchemy import create_engine
+import itertools
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-from app.core.config import SQLALCHEMY_DATABASE_URL
+from app.core.config import (DB_MAX_OVERFLOW, DB_POOL_MODE, DB_POOL_PRE_PING, DB_POOL_RECYCLE, DB_POOL_SIZE,
+                             DB_POOL_TIMEOUT, DB_STATEMENT_TIMEOUT, SQLALCHEMY_DATABASE_URL, SQLALCHEMY_REPLICA_URLS)
+from app.db.pool import InstrumentedNullPool, InstrumentedQueuePool
+
+
+# параметры движка БД по настройкам пула
+def engine_options():
+    """
+    Функция получения параметров create_async_engine по настройкам DB_POOL_*.
+    В режиме null соединения не пулируются в процессе, пулом соединений с БД управляет PgBouncer, и он должен
+    работать в режиме session pooling: диалект asyncpg SQLAlchemy 1.4 выполняет запросы через именованные
+    подготовленные запросы, и при transaction pooling их имена пересекаются или не находятся на других
+    серверных соединениях (отключение кэшей это не исправляет). Кэши подготовленных запросов asyncpg и
+    SQLAlchemy отключены, т.к. соединение живет один запрос к приложению и кэш не успевает пригодиться.
+    statement_timeout передается при подключении, для PgBouncer параметр нужно добавить
+    в ignore_startup_parameters или задать для роли в БД.
+    """
+    connect_args = {}
+    if DB_STATEMENT_TIMEOUT:
+        connect_args['server_settings'] = {'statement_timeout': str(DB_STATEMENT_TIMEOUT)}
+    if DB_POOL_MODE == 'null':
+        connect_args.update(statement_cache_size=0, prepared_statement_cache_size=0)
+        return {'poolclass': InstrumentedNullPool, 'connect_args': connect_args}
+    if DB_POOL_MODE != 'queue':
+        raise ValueError(f'unknown DB_POOL_MODE {DB_POOL_MODE!r}, expected queue or null')
+    return {'poolclass': InstrumentedQueuePool,
+            'pool_size': DB_POOL_SIZE,
+            'max_overflow': DB_MAX_OVERFLOW,
+            'pool_timeout': DB_POOL_TIMEOUT,
+            'pool_recycle': DB_POOL_RECYCLE,
+            'pool_pre_ping': DB_POOL_PRE_PING,
+            'connect_args': connect_args}
+
+
+# asyncpg не знает тип ltree, поэтому для каждого нового соединения регистрируем текстовый кодек
+def register_ltree_codec(dbapi_connection, connection_record):
+    dbapi_connection.run_async(
+        lambda connection: connection.set_type_codec('ltree', schema='public', encoder=str, decoder=str,
+                                                     format='text')
+    )
+
+
+# создание движка БД
+def create_db_engine(url: str):
+    """Функция создания асинхронного движка БД с настройками пула и кодеком ltree"""
+    new_engine = create_async_engine(url, **engine_options())
+    event.listen(new_engine.sync_engine, "connect", register_ltree_codec)
+    return new_engine
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+class EngineRouter:
+    """
+    Выбор движка БД для сессии: запись и чтение своих записей - в основную БД,
+    остальное чтение - в реплики по очереди. Без реплик все сессии открываются в основной БД.
+    """
+
+    def __init__(self, primary, replicas=()):
+        self.primary = primary
+        self.replicas = list(replicas)
+        self._next_replica = itertools.cycle(self.replicas) if self.replicas else None
+
+    def read_engine(self):
+        if self._next_replica is None:
+            return self.primary
+        return next(self._next_replica)
+
+
+engine = create_db_engine(SQLALCHEMY_DATABASE_URL)
+replica_engines = [create_db_engine(url) for url in SQLALCHEMY_REPLICA_URLS]
+engine_router = EngineRouter(engine, replica_engines)
+# expire_on_commit=False - после commit объекты не перечитываются из БД неявным (и недоступным в asyncio) запросом
+SessionLocal = sessionmaker(engine, class_=AsyncSession, autocommit=False, autoflush=False, expire_on_commit=False)
 Base = declarative_base()
+
+
+# сессия для чтения
+def ReadSessionLocal(router: EngineRouter = engine_router):
+    """Функция создания сессии только для чтения в очередной реплике (или в основной БД, если реплик нет)"""
+    return SessionLocal(bind=router.read_engine())
@@ -0,0 +1,162 @@
+import hashlib
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Ограниченный по размеру кэш в памяти процесса с временем жизни записей.
+    При переполнении вытесняются давно не использованные записи (LRU).
+    Кэш не разделяется между процессами, поэтому инвалидация действует только в текущем
+    процессе, в остальных запись устареет не позже чем через ttl секунд.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None or item[1] < time.monotonic():
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def set(self, key, value):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+    def stats(self):
+        return {'size': len(self._data),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses}
+
+
+class MemoryCacheBackend:
+    """Бэкенд кэша в памяти процесса (LRU с временем жизни записей)"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, key: str):
+        return self._cache.get(key)
+
+    async def set(self, key: str, value):
+        self._cache.set(key, value)
+
+    async def delete(self, key: str):
+        self._cache.invalidate(key)
+
+    def stats(self):
+        return self._cache.stats()
+
+
+class RedisCacheBackend:
+    """
+    Бэкенд кэша в Redis (или совместимом сервере), общий для всех процессов.
+    Принимает готовый асинхронный клиент, например redis.asyncio.Redis.
+    """
+
+    def __init__(self, client, ttl: float):
+        self.client = client
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_url(cls, url: str, ttl: float):
+        # redis - необязательная зависимость, нужна только при выборе этого бэкенда
+        try:
+            from redis import asyncio as aioredis
+        except ImportError as err:
+            raise RuntimeError('redis package is required for the redis cache backend') from err
+        return cls(aioredis.from_url(url), ttl=ttl)
+
+    async def get(self, key: str):
+        value = await self.client.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    async def set(self, key: str, value):
+        await self.client.set(key, value, ex=int(self.ttl))
+
+    async def delete(self, key: str):
+        await self.client.delete(key)
+
+    def stats(self):
+        return {'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses}
+
+
+class NullCacheBackend:
+    """Бэкенд, ничего не сохраняющий (кэш отключен)"""
+
+    async def get(self, key: str):
+        return None
+
+    async def set(self, key: str, value):
+        pass
+
+    async def delete(self, key: str):
+        pass
+
+    def stats(self):
+        return {}
+
+
+class CommentsCache:
+    """
+    Кэш сериализованных ответов со списками комментариев.
+    В ключ ответа входит версия страницы (item_versions.version), которая увеличивается в той же транзакции,
+    что и любое изменение комментариев страницы. После изменения закэшированные ответы перестают находиться
+    и вытесняются по времени жизни, поэтому отдельная инвалидация не нужна и работает одинаково
+    во всех процессах, в том числе с бэкендом в памяти.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @staticmethod
+    def page_key(service_id, data_type, item_id, version, **params):
+        params = sorted((name, str(value)) for name, value in params.items())
+        return 'comments:page:' + hashlib.sha1(repr((str(service_id), str(data_type), item_id, version, params))
+                                               .encode('utf-8')).hexdigest()
+
+    async def get(self, key: str):
+        return await self.backend.get(key)
+
+    async def set(self, key: str, value: bytes):
+        await self.backend.set(key, value)
+
+    def stats(self):
+        return self.backend.stats()
+
+
+# создание бэкенда кэша по названию из настроек
+def create_backend(name: str, maxsize: int, ttl: float, redis_url: str = None):
+    if name == 'memory':
+        return MemoryCacheBackend(maxsize=maxsize, ttl=ttl)
+    if name == 'redis':
+        return RedisCacheBackend.from_url(redis_url, ttl=ttl)
+    if name == 'none':
+        return NullCacheBackend()
+    raise ValueError(f'unknown cache backend {name}')
@@ -1,21 +1,259 @@
 import base64
+import json
+from datetime import datetime, timezone
+
+import orjson
+from sqlalchemy_utils import Ltree
 
 from app.comment import models
 from app.comment import schemas
 
+DELETED_COMMENT_TEXT = 'Комментарий удален'
+
+
 # Функция получения комментария согласно схеме CommentOut из ответов БД
 def comment_db_2_out(comment_db: models.Comment,
                      user: models.User):
     comment_out = schemas.CommentDB.from_orm(comment_db).dict()
     if comment_out['is_deleted']:
-        comment_out['comment_text'] = 'Комментарий удален'
+        comment_out['comment_text'] = DELETED_COMMENT_TEXT
     comment_out.pop('user_id')
     comment_out['user'] = schemas.User.from_orm(user)
     return schemas.CommentOut(**comment_out)
 
 
+# Функция получения комментария согласно схеме CommentOut из строки БД с колонками crud.COMMENT_OUT_COLUMNS,
+# в отличие от comment_db_2_out не создает pydantic-моделей и сразу отдает словарь для сериализации
+def comment_row_2_dict(row):
+    return {'id': row.id,
+            'level': row.level,
+            'comment_text': DELETED_COMMENT_TEXT if row.is_deleted else row.comment_text,
+            'date_created': row.date_created,
+            'date_modified': row.date_modified,
+            'is_deleted': bool(row.is_deleted),
+            'scope': row.scope,
+            'user': {'id': row.user_id,
+                     'external_id': row.external_id,
+                     'first_name': row.first_name,
+                     'last_name': row.last_name,
+                     'user_group': row.user_group}}
+
+
+# сериализация страницы комментариев (схема CommentsPage) сразу в json
+def comments_page_2_json(rows, next_cursor: str = None, changes_token: str = None):
+    return orjson.dumps({'comments': [comment_row_2_dict(row) for row in rows],
+                         'next_cursor': next_cursor,
+                         'changes_token': changes_token})
+
+
+# сериализация страницы комментариев в виде roots сразу в json: у каждого комментария количество
+# прямых ответов и первые из них (словарь path комментария -> строки ответов, см. crud.get_roots)
+def roots_page_2_json(rows, replies: dict, next_cursor: str = None, changes_token: str = None):
+    comments = []
+    for row in rows:
+        comment = comment_row_2_dict(row)
+        comment['replies_count'] = row.replies_count
+        comment['replies'] = [comment_row_2_dict(reply) for reply in replies.get(str(row.path), ())]
+        comments.append(comment)
+    return orjson.dumps({'comments': comments, 'next_cursor': next_cursor, 'changes_token': changes_token})
+
+
+# сериализация страницы результатов поиска (схема SearchPage) сразу в json
+def search_page_2_json(rows, next_cursor: str = None):
+    comments = []
+    for row in rows:
+        comment = comment_row_2_dict(row)
+        comment.update(data_type=row.data_type, item_id=row.item_id, rank=row.rank)
+        comments.append(comment)
+    return orjson.dumps({'comments': comments, 'next_cursor': next_cursor})
+
+
+# сериализация комментариев нескольких страниц (схема CommentsBatch) сразу в json,
+# строки должны быть упорядочены по item_id
+def comments_batch_2_json(item_ids, rows):
+    items = {item_id: [] for item_id in item_ids}
+    for row in rows:
+        items[row.item_id].append(comment_row_2_dict(row))
+    return orjson.dumps({'items': items})
+
+
+# сериализация строки выгрузки (колонки crud.EXPORT_COLUMNS) в строку NDJSON
+def export_row_2_ndjson(row):
+    comment = row._asdict()
+    comment['path'] = str(comment['path'])
+    return orjson.dumps(comment, option=orjson.OPT_APPEND_NEWLINE)
+
+
+class CommentsJsonEncoder:
+    """
+    Сериализация страницы комментариев (схема CommentsPage) по частям: start() открывает ответ,
+    feed(rows) сериализует очередную пачку строк, finish(next_cursor, changes_token) закрывает ответ.
+    Нужна для потоковой отдачи, когда строки читаются из БД пачками.
+    """
+
+    def __init__(self):
+        self._need_comma = False
+
+    def start(self):
+        return b'{"comments":['
+
+    def feed(self, rows):
+        if not rows:
+            return b''
+        chunk = b','.join(orjson.dumps(comment_row_2_dict(row)) for row in rows)
+        if self._need_comma:
+            chunk = b',' + chunk
+        self._need_comma = True
+        return chunk
+
+    def finish(self, next_cursor: str = None, changes_token: str = None):
+        return (b'],"next_cursor":' + orjson.dumps(next_cursor)
+                + b',"changes_token":' + orjson.dumps(changes_token) + b'}')
+
+
+class NestedCommentsJsonEncoder(CommentsJsonEncoder):
+    """
+    Сериализация страницы комментариев во вложенном виде: ответы к комментарию отдаются в его поле children.
+    Строки должны идти в порядке path (обход дерева в глубину), тогда дерево собирается за один линейный
+    проход без рекурсии: держим стек путей незакрытых комментариев и закрываем их, как только очередная
+    строка перестает быть их потомком. Комментарии, родителя которых нет в выборке (например, он остался
+    на предыдущей странице), выводятся на верхнем уровне.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._open_paths = []
+
+    def feed(self, rows):
+        parts = []
+        for row in rows:
+            path = str(row.path)
+            while self._open_paths and not path.startswith(self._open_paths[-1] + '.'):
+                self._open_paths.pop()
+                parts.append(b']}')
+                self._need_comma = True
+            # у сериализованного комментария отрезаем закрывающую скобку и открываем список children
+            node = orjson.dumps(comment_row_2_dict(row))[:-1] + b',"children":['
+            parts.append(b',' + node if self._need_comma else node)
+            self._open_paths.append(path)
+            self._need_comma = False
+        return b''.join(parts)
+
+    def finish(self, next_cursor: str = None, changes_token: str = None):
+        closing = b']}' * len(self._open_paths)
+        self._open_paths = []
+        return closing + super().finish(next_cursor, changes_token)
+
+
+# сериализация страницы комментариев во вложенном виде сразу в json
+def nested_comments_page_2_json(rows, next_cursor: str = None, changes_token: str = None):
+    encoder = NestedCommentsJsonEncoder()
+    return encoder.start() + encoder.feed(rows) + encoder.finish(next_cursor, changes_token)
+
+
 # энкодер json объекта в строку
 def json_2_str(json_obj):
     schema_bytes = str(json_obj).encode('utf-8')
     encoded = base64.b64encode(schema_bytes)
     return encoded.decode('utf-8')
+
+
+# формирование непрозрачного курсора следующей страницы по последнему отданному комментарию
+# (объекту models.Comment или строке БД с колонками path, date_created и id)
+def encode_cursor(presentation: schemas.PresentationList, comment_db):
+    if presentation == schemas.PresentationList.flat:
+        key = [comment_db.date_created.isoformat(), comment_db.id]
+    else:
+        key = [str(comment_db.path)]
+    cursor = json.dumps({'p': presentation.value, 'k': key}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(cursor.encode('utf-8')).decode('utf-8')
+
+
+# разбор курсора, возвращает ключ сортировки для crud.get_comments,
+# при некорректном курсоре или несовпадении вида отображения выбрасывает ValueError
+def decode_cursor(presentation: schemas.PresentationList, cursor: str):
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+        if cursor['p'] != presentation.value:
+            raise ValueError('cursor does not match presentation')
+        if presentation == schemas.PresentationList.flat:
+            date_created, id = cursor['k']
+            return datetime.fromisoformat(date_created), int(id)
+        path, = cursor['k']
+        # путь проверяется здесь, иначе некорректный ltree приводит к ошибке при построении запроса
+        return (str(Ltree(path)),)
+    except (TypeError, KeyError, ValueError) as err:
+        raise ValueError('invalid cursor') from err
+
+
+# курсор следующей страницы результатов поиска по последнему отданному комментарию
+def encode_search_cursor(order: schemas.SearchOrder, row):
+    if order == schemas.SearchOrder.date:
+        key = [row.date_created.isoformat(), row.id]
+    else:
+        key = [row.rank, row.id]
+    cursor = json.dumps({'o': order.value, 'k': key}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(cursor.encode('utf-8')).decode('utf-8')
+
+
+# разбор курсора результатов поиска, возвращает ключ сортировки для crud.search_comments,
+# при некорректном курсоре или несовпадении сортировки выбрасывает ValueError
+def decode_search_cursor(order: schemas.SearchOrder, cursor: str):
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(cursor.encode('utf-8')))
+        if cursor['o'] != order.value:
+            raise ValueError('cursor does not match order')
+        first, id = cursor['k']
+        if order == schemas.SearchOrder.date:
+            return datetime.fromisoformat(first), int(id)
+        return float(first), int(id)
+    except (TypeError, KeyError, ValueError) as err:
+        raise ValueError('invalid cursor') from err
+
+
+# токен запроса изменений: ключ (date_modified, id), после которого отдаются изменения
+def encode_changes_token(date_modified: datetime, id: int):
+    token = json.dumps({'c': [date_modified.isoformat(), id]}, separators=(',', ':'))
+    return base64.urlsafe_b64encode(token.encode('utf-8')).decode('utf-8')
+
+
+# приведение даты фильтра к UTC
+def naive_utc(date: datetime = None):
+    """Функция приведения даты с часовым поясом к UTC без часового пояса (в БД хранятся даты UTC)"""
+    if date is not None and date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date
+
+
+# разбор токена изменений, вместо токена принимается и дата в формате ISO 8601 (изменения после нее),
+# при некорректном значении выбрасывает ValueError
+def decode_changes_token(token: str):
+    try:
+        date_modified = datetime.fromisoformat(token.replace('Z', '+00:00'))
+    except ValueError:
+        pass
+    else:
+        return naive_utc(date_modified), 0
+    try:
+        date_modified, id = json.loads(base64.urlsafe_b64decode(token.encode('utf-8')))['c']
+        return datetime.fromisoformat(date_modified), int(id)
+    except (TypeError, KeyError, ValueError) as err:
+        raise ValueError('invalid changes token') from err
+
+
+# формирование ETag по версии комментариев страницы
+def version_2_etag(version: int):
+    return f'"{version}"'
+
+
+# проверка заголовка If-None-Match, True если у клиента актуальная версия
+def etag_matches(if_none_match: str, etag: str):
+    if not if_none_match:
+        return False
+    for value in if_none_match.split(','):
+        value = value.strip()
+        if value.startswith('W/'):
+            value = value[2:]
+        if value == '*' or value == etag:
+            return True
+    return False
@@ -2,9 +2,17 @@ import hashlib
 import hmac
 import uuid
 
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from app.comment import crud, schemas
+from app.core.config import SERVICE_TOKEN_CACHE_SIZE, SERVICE_TOKEN_CACHE_TTL
+from app.db.session import SessionLocal, engine
+from app.utils.cache import TTLCache
+
+# токены сервисов меняются редко, поэтому кэшируются, чтобы не обращаться к БД при каждой проверке подписи.
+# При создании сервиса или смене его токена запись нужно удалить из кэша (token_cache.invalidate). Кэш свой
+# в каждом процессе, поэтому остальные процессы принимают старый токен еще до SERVICE_TOKEN_CACHE_TTL секунд
+token_cache = TTLCache(maxsize=SERVICE_TOKEN_CACHE_SIZE, ttl=SERVICE_TOKEN_CACHE_TTL)
 
 
 # генерация подписи
@@ -15,10 +23,26 @@ def create_sign(key: str, message):
     return signing.hexdigest()
 
 
+# чтение токена сервиса из основной БД
+async def read_token(db: AsyncSession, service_id: uuid.UUID):
+    """
+    Функция чтения токена сервиса в сессии db, если она открыта в основной БД, иначе в отдельной сессии
+    основной БД: реплика с отставанием может вернуть уже замененный токен, и он снова попадет в кэш
+    """
+    if getattr(db, 'bind', None) is engine:
+        return await crud.get_token_by_service_id(db=db, service_id=service_id)
+    async with SessionLocal() as primary_db:
+        return await crud.get_token_by_service_id(db=primary_db, service_id=service_id)
+
+
 # проверка подписи
-def check_signs(db: Session, received_signature: str, service_id: uuid.UUID, data_type: schemas.DataType, item_id: str):
+async def check_signs(db: AsyncSession, received_signature: str, service_id: uuid.UUID, data_type: schemas.DataType,
+                      item_id: str):
     message = str(service_id) + data_type + item_id
-    token = crud.get_token_by_service_id(db=db, service_id=service_id)
+    token = token_cache.get(service_id)
+    if token is None:
+        token = await read_token(db=db, service_id=service_id)
+        token_cache.set(service_id, token)
     signature = create_sign(token, message)
     return hmac.compare_digest(received_signature, signature)
 
@@ -0,0 +1,59 @@
+import asyncio
+
+from app.utils.cache import TTLCache
+
+
+class SingleFlight:
+    """
+    Объединение одновременных одинаковых запросов в процессе: пока функция для ключа выполняется,
+    остальные вызовы с тем же ключом не запускают ее повторно, а ждут и получают тот же результат
+    (или то же исключение). Выполнение идет в отдельной задаче, поэтому отмена запроса, который
+    его начал (например, клиент отключился), не прерывает его для остальных.
+
+    Если ttl > 0, результат завершенного выполнения еще ttl секунд отдается новым вызовам с тем же ключом
+    без выполнения (короткий кэш результатов, фонового обновления нет), хранится не больше maxsize
+    результатов. Подходит только для ключей, результат по которым не меняется, например ключей ответов
+    с версией страницы (CommentsCache.page_key).
+    """
+
+    def __init__(self, ttl: float = 0, maxsize: int = 1024):
+        self.ttl = ttl
+        self.executions = 0
+        self.joined = 0
+        self._flights = {}
+        self._recent = TTLCache(maxsize=maxsize, ttl=ttl) if ttl > 0 else None
+
+    async def do(self, key, func):
+        """
+        Функция получения результата корутинной функции func без аргументов для ключа key:
+        присоединяется к выполняющемуся вызову с тем же ключом или запускает новый
+        """
+        if self._recent is not None:
+            result = self._recent.get(key, self)
+            if result is not self:
+                return result
+        flight = self._flights.get(key)
+        if flight is None:
+            self.executions += 1
+            flight = asyncio.ensure_future(self._run(key, func))
+            self._flights[key] = flight
+        else:
+            self.joined += 1
+        return await asyncio.shield(flight)
+
+    async def _run(self, key, func):
+        try:
+            result = await func()
+            if self._recent is not None:
+                self._recent.set(key, result)
+            return result
+        finally:
+            del self._flights[key]
+
+    def stats(self):
+        stats = {'in_flight': len(self._flights),
+                 'executions': self.executions,
+                 'joined': self.joined}
+        if self._recent is not None:
+            stats['recent'] = self._recent.stats()
+        return stats
@@ -0,0 +1,303 @@
+"""
+Нагрузочный тест API комментариев на данных, созданных benchmarks/seed.py.
+
+Запросы с подписью (signer.create_sign) подаются приложению FastAPI напрямую через ASGI, без HTTP-сервера,
+с заданным числом одновременных запросов. Сценарии выполняются по очереди, для каждого считаются задержки
+(p50/p95/p99), пропускная способность, коды ответов и число SQL-запросов на запрос (по событию
+before_cursor_execute движков основной БД и реплик). Результат - JSON для сравнения между версиями,
+с --baseline выводится изменение задержек относительно предыдущего прогона.
+
+Задержки не включают сеть и HTTP-сервер, поэтому сравнивать можно только прогоны на одной машине и БД.
+Запуск из каталога backend:
+
+    python -m benchmarks.load --manifest seed.json --requests 2000 --concurrency 50 --output run.json
+    python -m benchmarks.load --manifest seed.json --scenario get_tree --scenario create_comment --no-cache \\
+                              --baseline run.json
+"""
+import argparse
+import asyncio
+import math
+import random
+import sys
+import time
+import uuid
+from datetime import datetime
+from urllib.parse import urlencode
+
+import orjson
+from sqlalchemy import event, select
+
+from app.comment import api, models
+from app.db.session import SessionLocal, engine, replica_engines
+from app.main import app
+from app.utils import cache, signer
+
+SEARCH_WORDS = ('комментарий', 'обсуждение', 'статья', 'ответ', 'мнение', 'вопрос')
+
+
+class QueryCounter:
+    """Счетчик SQL-запросов всех движков приложения"""
+
+    def __init__(self):
+        self.count = 0
+
+    def install(self):
+        for db_engine in [engine, *replica_engines]:
+            event.listen(db_engine.sync_engine, 'before_cursor_execute', self.on_execute)
+
+    def on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+class Target:
+    """Данные для запросов: сервисы из манифеста и идентификаторы комментариев их страниц"""
+
+    def __init__(self, manifest: dict, rng: random.Random):
+        self.services = manifest['services']
+        self.rng = rng
+        self.comment_ids = {}
+
+    # чтение идентификаторов комментариев первого уровня для ответов и parent_id
+    async def load_comment_ids(self, per_item: int):
+        async with SessionLocal() as db:
+            for service in self.services:
+                for item_id in service['items']:
+                    rows = await db.execute(select(models.Comment.id)
+                                            .where(models.Comment.service_id == uuid.UUID(service['service_id']),
+                                                   models.Comment.data_type == service['data_type'],
+                                                   models.Comment.item_id == item_id,
+                                                   models.Comment.level == 1)
+                                            .limit(per_item))
+                    self.comment_ids[(service['service_id'], item_id)] = rows.scalars().all()
+
+    def pick(self):
+        service = self.rng.choice(self.services)
+        return service, self.rng.choice(service['items'])
+
+    def pick_comment(self):
+        service, item_id = self.pick()
+        ids = self.comment_ids.get((service['service_id'], item_id))
+        return service, item_id, self.rng.choice(ids) if ids else None
+
+    @staticmethod
+    def sign(service: dict, data_type: str, item_id: str):
+        return signer.create_sign(service['token'], service['service_id'] + data_type + item_id)
+
+
+# сценарии: функция (target, args) -> (метод, путь, параметры строки запроса, тело)
+def page_request(**params):
+    def build(target: Target, args):
+        service, item_id = target.pick()
+        query = dict(signature=target.sign(service, service['data_type'], item_id), limit=args.limit, **params)
+        return 'GET', f"/{service['service_id']}/{service['data_type']}/{item_id}/", query, None
+    return build
+
+
+def children_request(target: Target, args):
+    service, item_id, parent_id = target.pick_comment()
+    query = dict(signature=target.sign(service, service['data_type'], item_id), limit=args.limit)
+    if parent_id is not None:
+        query['parent_id'] = parent_id
+    return 'GET', f"/{service['service_id']}/{service['data_type']}/{item_id}/", query, None
+
+
+def batch_request(target: Target, args):
+    service = target.rng.choice(target.services)
+    items = target.rng.sample(service['items'], min(args.batch_items, len(service['items'])))
+    query = [('signature', target.sign(service, service['data_type'], ','.join(items))), ('limit', 3)]
+    query += [('item_id', item_id) for item_id in items]
+    return 'GET', f"/batch/{service['service_id']}/{service['data_type']}/", query, None
+
+
+def count_request(target: Target, args):
+    service, item_id = target.pick()
+    query = {'signature': target.sign(service, service['data_type'], item_id)}
+    return 'GET', f"/count/{service['service_id']}/{service['data_type']}/{item_id}/", query, None
+
+
+def search_request(target: Target, args):
+    service = target.rng.choice(target.services)
+    query = {'signature': target.sign(service, 'search', ''), 'q': target.rng.choice(SEARCH_WORDS),
+             'limit': args.limit}
+    return 'GET', f"/search/{service['service_id']}/", query, None
+
+
+def create_request(target: Target, args):
+    service, item_id, parent_id = target.pick_comment()
+    user = target.rng.randrange(1000)
+    body = {'comment_text': 'Комментарий нагрузочного теста',
+            'user': {'external_id': f'load-user-{user}', 'first_name': 'Имя', 'last_name': 'Фамилия',
+                     'user_group': 'reader'},
+            'parent_id': parent_id if target.rng.random() < 0.7 else None,
+            'signature': target.sign(service, service['data_type'], item_id)}
+    return 'POST', f"/{service['service_id']}/{service['data_type']}/{item_id}/", {}, orjson.dumps(body)
+
+
+SCENARIOS = {'get_tree': page_request(presentation='tree'),
+             'get_flat': page_request(presentation='flat'),
+             'get_nested': page_request(presentation='nested'),
+             'get_roots': page_request(presentation='roots'),
+             'get_branches': page_request(presentation='nested', branch_limit=3),
+             'get_children': children_request,
+             'get_batch': batch_request,
+             'get_count': count_request,
+             'search': search_request,
+             'create_comment': create_request}
+
+
+# выполнение одного запроса к приложению через ASGI
+async def asgi_request(method: str, path: str, query, body: bytes = None) -> int:
+    """Функция отправки запроса приложению без HTTP-сервера, возвращает код ответа (тело читается и отбрасывается)"""
+    scope = {'type': 'http',
+             'asgi': {'version': '3.0'},
+             'http_version': '1.1',
+             'method': method,
+             'scheme': 'http',
+             'path': path,
+             'raw_path': path.encode(),
+             'root_path': '',
+             'query_string': urlencode(query).encode(),
+             'headers': [(b'host', b'benchmark'), (b'content-type', b'application/json')],
+             'client': ('127.0.0.1', 0),
+             'server': ('benchmark', 80)}
+    request_body = [{'type': 'http.request', 'body': body or b'', 'more_body': False}]
+    disconnected = asyncio.Event()
+    status_code = None
+
+    async def receive():
+        if request_body:
+            return request_body.pop()
+        # клиент не отключается, пока приложение не отдаст ответ целиком
+        await disconnected.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        nonlocal status_code
+        if message['type'] == 'http.response.start':
+            status_code = message['status']
+
+    await app(scope, receive, send)
+    disconnected.set()
+    return status_code
+
+
+# процентиль по отсортированным значениям (метод ближайшего ранга)
+def percentile(values: list, p: float):
+    if not values:
+        return None
+    return values[max(0, min(len(values), math.ceil(p / 100 * len(values))) - 1)]
+
+
+# прогон сценария
+async def run_scenario(name: str, target: Target, args, counter: QueryCounter) -> dict:
+    """Функция выполнения запросов сценария с ограничением числа одновременных, возвращает его метрики"""
+    build = SCENARIOS[name]
+    for _ in range(args.warmup):
+        await asgi_request(*build(target, args))
+    requests = [build(target, args) for _ in range(args.requests)]
+    latencies = []
+    statuses = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(request):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                status_code = await asgi_request(*request)
+            except Exception as err:
+                status_code = type(err).__name__
+            latencies.append(time.perf_counter() - started)
+            statuses[str(status_code)] = statuses.get(str(status_code), 0) + 1
+
+    queries = counter.count
+    started = time.perf_counter()
+    await asyncio.gather(*[one(request) for request in requests])
+    duration = time.perf_counter() - started
+    queries = counter.count - queries
+    latencies.sort()
+    errors = sum(count for status_code, count in statuses.items() if not status_code.startswith(('2', '3')))
+    return {'requests': len(requests),
+            'errors': errors,
+            'status': statuses,
+            'concurrency': args.concurrency,
+            'duration_s': round(duration, 3),
+            'throughput_rps': round(len(requests) / duration, 1) if duration else None,
+            'latency_ms': {'mean': round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None,
+                           **{f'p{p}': round(percentile(latencies, p) * 1000, 3) if latencies else None
+                              for p in (50, 95, 99)},
+                           'max': round(latencies[-1] * 1000, 3) if latencies else None},
+            'queries_per_request': round(queries / len(requests), 2) if requests else None}
+
+
+# сравнение с предыдущим прогоном
+def compare(result: dict, baseline: dict):
+    """Функция вывода изменения p50/p95/p99 и пропускной способности относительно baseline в stderr"""
+    for name, scenario in result['scenarios'].items():
+        before = baseline.get('scenarios', {}).get(name)
+        if before is None:
+            continue
+        changes = []
+        for p in ('p50', 'p95', 'p99'):
+            old, new = before['latency_ms'].get(p), scenario['latency_ms'].get(p)
+            if old and new is not None:
+                changes.append(f'{p} {old:.2f} -> {new:.2f} ms ({(new - old) / old * 100:+.1f}%)')
+        if before.get('throughput_rps') and scenario['throughput_rps']:
+            changes.append(f"rps {before['throughput_rps']} -> {scenario['throughput_rps']}")
+        print(f'{name}: ' + ', '.join(changes), file=sys.stderr)
+
+
+async def run(args) -> dict:
+    with open(args.manifest, 'rb') as file:
+        manifest = orjson.loads(file.read())
+    if args.no_cache:
+        api.comments_cache.backend = cache.NullCacheBackend()
+    target = Target(manifest, random.Random(args.seed))
+    await target.load_comment_ids(per_item=100)
+    counter = QueryCounter()
+    counter.install()
+    result = {'started': datetime.utcnow().isoformat(),
+              'params': {name: value for name, value in vars(args).items() if name not in ('output', 'baseline')},
+              'scenarios': {}}
+    try:
+        for name in args.scenario or SCENARIOS:
+            result['scenarios'][name] = await run_scenario(name, target, args, counter)
+            print(f"{name}: {result['scenarios'][name]['throughput_rps']} rps, "
+                  f"p95 {result['scenarios'][name]['latency_ms']['p95']} ms", file=sys.stderr)
+    finally:
+        await api.event_hub.close()
+        await engine.dispose()
+        for replica in replica_engines:
+            await replica.dispose()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--manifest', default='seed.json', help='манифест, созданный benchmarks.seed')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS),
+                        help='выполнить только указанные сценарии (параметр можно повторять)')
+    parser.add_argument('--requests', type=int, default=1000, help='запросов в каждом сценарии')
+    parser.add_argument('--concurrency', type=int, default=20, help='одновременных запросов')
+    parser.add_argument('--warmup', type=int, default=20, help='запросов перед замером в каждом сценарии')
+    parser.add_argument('--limit', type=int, default=50, help='размер страницы в запросах чтения')
+    parser.add_argument('--batch-items', type=int, default=10, help='страниц в запросе batch')
+    parser.add_argument('--no-cache', action='store_true', help='отключить кэш ответов со списками комментариев')
+    parser.add_argument('--seed', type=int, default=1, help='начальное значение генератора случайных чисел')
+    parser.add_argument('--output', default='-', help="файл результата, '-' - стандартный вывод")
+    parser.add_argument('--baseline', default=None, help='результат предыдущего прогона для сравнения')
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    if args.baseline:
+        with open(args.baseline, 'rb') as file:
+            compare(result, orjson.loads(file.read()))
+    output = orjson.dumps(result, option=orjson.OPT_INDENT_2)
+    if args.output == '-':
+        sys.stdout.buffer.write(output + b'\n')
+    else:
+        with open(args.output, 'wb') as file:
+            file.write(output)
+
+
+if __name__ == '__main__':
+    main()
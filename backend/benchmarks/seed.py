@@ -0,0 +1,132 @@
+"""
+Наполнение локальной БД синтетическими данными для нагрузочного теста (benchmarks/load.py).
+
+Создаются сервисы, в каждом - страницы с обсуждениями заданной формы: roots комментариев первого уровня,
+у каждого комментария fanout ответов до глубины depth (на странице roots * (1 + fanout + ... + fanout^(depth-1))
+комментариев), авторы выбираются из users пользователей сервиса. Комментарии загружаются импортом
+(app/comment/importer.py), поэтому пути, счетчики и версии страниц заполняются как в рабочей БД.
+Описание созданных данных (сервисы, токены и страницы) записывается в манифест для нагрузочного теста.
+
+БД берется из настроек приложения (SQLALCHEMY_DATABASE_URL), схема должна быть создана миграциями.
+Запуск из каталога backend:
+
+    python -m benchmarks.seed --services 2 --items 20 --roots 50 --fanout 3 --depth 3 --output seed.json
+    # глубокие ветки
+    python -m benchmarks.seed --roots 5 --fanout 1 --depth 200
+    # широкие обсуждения
+    python -m benchmarks.seed --roots 500 --fanout 20 --depth 2
+"""
+import argparse
+import asyncio
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import orjson
+
+from app.comment import crud, importer, schemas
+from app.core.config import COMMENTS_IMPORT_CHUNK_SIZE
+from app.db.session import SessionLocal
+
+DATA_TYPE = schemas.DataType.comments.value
+WORDS = ('комментарий', 'обсуждение', 'статья', 'ответ', 'мнение', 'вопрос', 'пример', 'данные', 'сервис',
+         'страница', 'автор', 'читатель', 'новость', 'история', 'тема')
+
+
+# строки NDJSON обсуждения одной страницы
+def thread_lines(item_id: str, roots: int, fanout: int, depth: int, users: int, rng: random.Random):
+    """Генератор строк импорта комментариев страницы, родитель всегда идет раньше ответов"""
+    date = datetime(2022, 1, 1)
+    number = 0
+    for root in range(roots):
+        # обход в глубину: стек (идентификатор комментария, уровень)
+        stack = [(None, 0)]
+        while stack:
+            parent_id, level = stack.pop()
+            for _ in range(1 if parent_id is None else fanout):
+                number += 1
+                comment_id = f'{item_id}-{number}'
+                date += timedelta(seconds=rng.randint(1, 600))
+                user = rng.randrange(users)
+                comment = {'id': comment_id,
+                           'data_type': DATA_TYPE,
+                           'item_id': item_id,
+                           'comment_text': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 40))),
+                           'is_deleted': rng.random() < 0.02,
+                           'date_created': date.isoformat(),
+                           'user': {'external_id': f'user-{user}',
+                                    'first_name': f'Имя {user}',
+                                    'last_name': f'Фамилия {user}',
+                                    'user_group': 'reader'}}
+                if parent_id is not None:
+                    comment['parent_id'] = parent_id
+                yield orjson.dumps(comment)
+                if level + 1 < depth:
+                    stack.append((comment_id, level + 1))
+
+
+# асинхронный поток строк для импорта
+async def lines_of(lines):
+    for line in lines:
+        yield line
+
+
+# наполнение БД
+async def seed(args):
+    """Функция создания сервисов и обсуждений, возвращает манифест созданных данных"""
+    rng = random.Random(args.seed)
+    run = uuid.uuid4().hex[:8]
+    manifest = {'created': datetime.utcnow().isoformat(),
+                'params': {name: value for name, value in vars(args).items() if name != 'output'},
+                'services': []}
+    started = time.monotonic()
+    total = 0
+    async with SessionLocal() as db:
+        for service_no in range(args.services):
+            service_row = await crud.create_service(db=db, service_name=f'bench-{run}-{service_no}')
+            items = [f'bench-item-{item_no}' for item_no in range(args.items)]
+            for item_id in items:
+                result = await importer.import_comments(db=db,
+                                                        service_id=service_row.id,
+                                                        lines=lines_of(thread_lines(item_id=item_id,
+                                                                                    roots=args.roots,
+                                                                                    fanout=args.fanout,
+                                                                                    depth=args.depth,
+                                                                                    users=args.users,
+                                                                                    rng=rng)),
+                                                        chunk_size=args.chunk_size)
+                total += result.imported
+                print(f'{total} comments, {total / (time.monotonic() - started):.0f} comments/s', file=sys.stderr)
+            manifest['services'].append({'service_id': str(service_row.id),
+                                         'token': service_row.token,
+                                         'data_type': DATA_TYPE,
+                                         'items': items})
+    manifest['comments'] = total
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--services', type=int, default=1)
+    parser.add_argument('--items', type=int, default=10, help='страниц в каждом сервисе')
+    parser.add_argument('--roots', type=int, default=20, help='комментариев первого уровня на странице')
+    parser.add_argument('--fanout', type=int, default=3, help='ответов у каждого комментария')
+    parser.add_argument('--depth', type=int, default=3, help='глубина обсуждения в уровнях')
+    parser.add_argument('--users', type=int, default=100, help='пользователей в каждом сервисе')
+    parser.add_argument('--chunk-size', type=int, default=COMMENTS_IMPORT_CHUNK_SIZE)
+    parser.add_argument('--seed', type=int, default=1, help='начальное значение генератора случайных чисел')
+    parser.add_argument('--output', default='seed.json', help="файл манифеста, '-' - стандартный вывод")
+    args = parser.parse_args()
+
+    manifest = orjson.dumps(asyncio.run(seed(args)), option=orjson.OPT_INDENT_2)
+    if args.output == '-':
+        sys.stdout.buffer.write(manifest + b'\n')
+    else:
+        with open(args.output, 'wb') as file:
+            file.write(manifest)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Сравнение стоимости сериализации одной строки списка комментариев:
+прежний путь через pydantic-модели (comment_db_2_out и валидация CommentsPage)
+и прямой путь из строк БД в json (comments_page_2_json).
+
+Запуск из каталога backend:
+    python -m benchmarks.serialization --rows 5000
+"""
+import argparse
+import collections
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from app.comment import crud, models, schemas
+from app.utils import convertors
+
+
+def make_rows(count: int):
+    """Синтетические комментарии: ORM-объекты для прежнего пути и кортежи строк для нового"""
+    row_class = collections.namedtuple('Row', [column.key for column in crud.COMMENT_OUT_COLUMNS])
+    orm_rows, tuple_rows = [], []
+    date_created = datetime(2022, 2, 12, 14, 32, 31)
+    service_id = uuid.uuid4()
+    for i in range(1, count + 1):
+        values = dict(id=i,
+                      path=str(i).zfill(9),
+                      level=1,
+                      comment_text='Текст комментария номер %d' % i,
+                      date_created=date_created + timedelta(seconds=i),
+                      date_modified=date_created + timedelta(seconds=i),
+                      is_deleted=i % 50 == 0,
+                      scope='all',
+                      user_id=i % 100)
+        user = dict(external_id='user-%d' % (i % 100),
+                    first_name='Имя',
+                    last_name='Фамилия',
+                    user_group='registered')
+        orm_rows.append((models.Comment(service_id=service_id, data_type='comments', item_id='page', **values),
+                         models.User(id=values['user_id'], **user)))
+        tuple_rows.append(row_class(**values, **user))
+    return orm_rows, tuple_rows
+
+
+def serialize_pydantic(orm_rows):
+    comments = [convertors.comment_db_2_out(comment, user) for comment, user in orm_rows]
+    return schemas.CommentsPage(comments=comments, next_cursor=None).json().encode('utf-8')
+
+
+def serialize_rows(tuple_rows):
+    return convertors.comments_page_2_json(tuple_rows, None)
+
+
+def measure(func, rows, repeat: int):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(rows)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    orm_rows, tuple_rows = make_rows(args.rows)
+    before = measure(serialize_pydantic, orm_rows, args.repeat)
+    after = measure(serialize_rows, tuple_rows, args.repeat)
+    print(f'rows: {args.rows}')
+    print(f'pydantic: {before * 1000:.1f} ms total, {before / args.rows * 1e6:.2f} us/row')
+    print(f'direct:   {after * 1000:.1f} ms total, {after / args.rows * 1e6:.2f} us/row')
+    print(f'speedup:  {before / after:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
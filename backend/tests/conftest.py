@@ -0,0 +1,31 @@
+"""
+Общие настройки тестов. Запуск из каталога backend:
+
+    python -m pytest tests
+
+Модули приложения читают настройки БД при импорте, поэтому для тестов без БД задаются значения по умолчанию.
+Тесты с маркером postgres выполняются в БД из настроек (схема создается миграциями) и пропускаются,
+если переменная окружения COMMENTS_TEST_POSTGRES не задана.
+"""
+import os
+
+import pytest
+
+os.environ.setdefault("POSTGRES_USER", "comments")
+os.environ.setdefault("POSTGRES_PASSWORD", "comments")
+os.environ.setdefault("POSTGRES_SERVER", "localhost")
+os.environ.setdefault("POSTGRES_PORT", "5432")
+os.environ.setdefault("POSTGRES_DB", "comments_test")
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "postgres: тест выполняется в Postgres (нужна переменная COMMENTS_TEST_POSTGRES)")
+
+
+def pytest_collection_modifyitems(config, items):
+    if os.getenv("COMMENTS_TEST_POSTGRES"):
+        return
+    skip = pytest.mark.skip(reason="COMMENTS_TEST_POSTGRES не задана")
+    for item in items:
+        if "postgres" in item.keywords:
+            item.add_marker(skip)
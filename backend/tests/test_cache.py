@@ -0,0 +1,105 @@
+import asyncio
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+from app.utils import cache
+
+SERVICE_ID = uuid.uuid4()
+
+
+def key(version=1, **params):
+    params = {'scope': 'all', 'presentation': 'tree', 'parent_id': None, 'limit': 50, 'cursor': None, **params}
+    return cache.CommentsCache.page_key(SERVICE_ID, 'comments', 'page', version, **params)
+
+
+def test_page_key_is_stable_and_ignores_parameter_order():
+    assert key() == key()
+    assert cache.CommentsCache.page_key(SERVICE_ID, 'comments', 'page', 1, limit=50, scope='all') == \
+        cache.CommentsCache.page_key(SERVICE_ID, 'comments', 'page', 1, scope='all', limit=50)
+
+
+@pytest.mark.parametrize('changed', [
+    {'version': 2},
+    {'presentation': 'flat'},
+    {'cursor': 'abc'},
+    {'limit': 51},
+    {'scope': 'private'},
+    {'parent_id': 5},
+])
+def test_page_key_depends_on_every_parameter(changed):
+    assert key(**changed) != key()
+
+
+def test_page_key_depends_on_item():
+    assert cache.CommentsCache.page_key(SERVICE_ID, 'comments', 'other', 1) != \
+        cache.CommentsCache.page_key(SERVICE_ID, 'comments', 'page', 1)
+    assert cache.CommentsCache.page_key(uuid.uuid4(), 'comments', 'page', 1) != \
+        cache.CommentsCache.page_key(SERVICE_ID, 'comments', 'page', 1)
+
+
+def test_version_bump_misses_cached_page():
+    comments_cache = cache.CommentsCache(cache.MemoryCacheBackend(maxsize=10, ttl=60))
+
+    async def main():
+        await comments_cache.set(key(version=1), b'old')
+        return await comments_cache.get(key(version=1)), await comments_cache.get(key(version=2))
+
+    assert asyncio.run(main()) == (b'old', None)
+
+
+def test_memory_backend_expires_entries(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache, 'time', SimpleNamespace(monotonic=lambda: now[0]))
+    backend = cache.MemoryCacheBackend(maxsize=10, ttl=5)
+
+    async def main():
+        await backend.set('key', b'value')
+        fresh = await backend.get('key')
+        now[0] += 6
+        return fresh, await backend.get('key')
+
+    assert asyncio.run(main()) == (b'value', None)
+    assert backend.stats()['hits'] == 1 and backend.stats()['misses'] == 1
+
+
+def test_memory_backend_evicts_least_recently_used():
+    backend = cache.MemoryCacheBackend(maxsize=2, ttl=60)
+
+    async def main():
+        await backend.set('a', 1)
+        await backend.set('b', 2)
+        await backend.get('a')
+        await backend.set('c', 3)
+        return [await backend.get(name) for name in ('a', 'b', 'c')]
+
+    assert asyncio.run(main()) == [1, None, 3]
+
+
+def test_memory_backend_delete():
+    backend = cache.MemoryCacheBackend(maxsize=2, ttl=60)
+
+    async def main():
+        await backend.set('a', 1)
+        await backend.delete('a')
+        return await backend.get('a')
+
+    assert asyncio.run(main()) is None
+
+
+def test_null_backend_stores_nothing():
+    backend = cache.NullCacheBackend()
+
+    async def main():
+        await backend.set('a', 1)
+        return await backend.get('a')
+
+    assert asyncio.run(main()) is None
+
+
+def test_create_backend():
+    assert isinstance(cache.create_backend('memory', maxsize=1, ttl=1), cache.MemoryCacheBackend)
+    assert isinstance(cache.create_backend('none', maxsize=1, ttl=1), cache.NullCacheBackend)
+    with pytest.raises(ValueError):
+        cache.create_backend('unknown', maxsize=1, ttl=1)
@@ -0,0 +1,77 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+
+import orjson
+import pytest
+
+from app.comment import api, crud, schemas
+from app.utils import convertors
+
+OVERLAP = timedelta(seconds=5)
+SINCE = (datetime(2022, 1, 1, 12, 0), 0)
+
+
+def row(id: int, date_modified: datetime):
+    values = dict(id=id, path=str(id), level=1, comment_text='text', date_created=datetime(2022, 1, 1),
+                  date_modified=date_modified, is_deleted=False, scope='all', user_id=1, external_id='user',
+                  first_name=None, last_name=None, user_group=None)
+    return type('Row', (), values)()
+
+
+class FakeSession:
+    async def close(self):
+        pass
+
+
+@pytest.fixture
+def changes(monkeypatch):
+    """Чтение изменений с подмененным crud.get_comments, возвращает (ответ, аргументы запроса к БД)"""
+    monkeypatch.setattr(api, 'COMMENTS_CHANGES_OVERLAP', OVERLAP.total_seconds())
+
+    def read(rows, limit=3, since=SINCE):
+        calls = []
+
+        async def get_comments(**kwargs):
+            calls.append(kwargs)
+            return rows[:kwargs['limit']]
+
+        monkeypatch.setattr(crud, 'get_comments', get_comments)
+        page = asyncio.run(api.read_comments_changes(db=FakeSession(), service_id=uuid.uuid4(),
+                                                     data_type=schemas.DataType.comments, item_id='page',
+                                                     scope=schemas.Scope.all, parent_id=None, limit=limit,
+                                                     since=since))
+        page = orjson.loads(page)
+        return page, convertors.decode_changes_token(page['changes_token']), calls[0]
+
+    return read
+
+
+def test_full_page_continues_exactly_after_last_change(changes):
+    rows = [row(id, SINCE[0] + timedelta(seconds=id)) for id in range(1, 6)]
+    page, token, query = changes(rows, limit=3)
+    assert query['limit'] == 4 and query['since'] == SINCE
+    assert [comment['id'] for comment in page['comments']] == [1, 2, 3]
+    assert page['next_cursor'] == page['changes_token']
+    assert token == (rows[2].date_modified, 3)
+
+
+def test_last_page_rewinds_by_overlap(changes):
+    rows = [row(1, SINCE[0] + timedelta(seconds=30)), row(2, SINCE[0] + timedelta(seconds=60))]
+    page, token, query = changes(rows, limit=3)
+    assert [comment['id'] for comment in page['comments']] == [1, 2]
+    assert page['next_cursor'] is None
+    assert token == (rows[-1].date_modified - OVERLAP, 0)
+
+
+def test_rewound_token_does_not_go_before_since(changes):
+    since = (SINCE[0], 7)
+    page, token, query = changes([row(8, SINCE[0] + timedelta(seconds=1))], limit=3, since=since)
+    assert page['next_cursor'] is None
+    assert token == since
+
+
+def test_no_changes_keeps_since(changes):
+    page, token, query = changes([], limit=3)
+    assert page['comments'] == [] and page['next_cursor'] is None
+    assert token == SINCE
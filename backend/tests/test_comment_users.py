@@ -0,0 +1,67 @@
+import asyncio
+import uuid
+from types import SimpleNamespace
+
+import pytest
+
+from app.comment import crud, schemas
+
+SERVICE_ID = uuid.uuid4()
+
+
+class FakeSession:
+    """Сессия без БД: запрос создания комментария возвращает row, остальные запросы только запоминаются"""
+
+    def __init__(self, row):
+        self.row = row
+        self.executed = []
+        self.committed = False
+
+    async def execute(self, statement, params=None):
+        self.executed.append((statement, params))
+        return SimpleNamespace(one=lambda: self.row)
+
+    async def commit(self):
+        self.committed = True
+
+
+def create(db, first_name='Имя'):
+    user = schemas.User(external_id='u-1', first_name=first_name, last_name='Фамилия', user_group='reader')
+    return asyncio.run(crud.create_comment(db=db, service_id=SERVICE_ID, data_type='comments', item_id='page',
+                                           parent_id=None, user=user, comment_text='text', scope='all'))
+
+
+@pytest.fixture(autouse=True)
+def clear_user_cache():
+    crud.user_cache.clear()
+    yield
+    crud.user_cache.clear()
+
+
+def comment_row(user_changed: bool):
+    return SimpleNamespace(user_id=7, item_archived=False, user_changed=user_changed)
+
+
+def test_changed_user_bumps_versions_of_other_items():
+    db = FakeSession(comment_row(user_changed=True))
+    create(db)
+    assert [statement for statement, params in db.executed] == [crud.CREATE_COMMENT_SQL, crud.BUMP_USER_ITEMS_SQL]
+    assert db.executed[1][1] == {'service_id': SERVICE_ID, 'user_id': 7,
+                                 'exclude_data_type': 'comments', 'exclude_item_id': 'page'}
+    assert db.committed
+
+
+def test_unchanged_user_does_not_bump_other_items():
+    db = FakeSession(comment_row(user_changed=False))
+    create(db)
+    assert [statement for statement, params in db.executed] == [crud.CREATE_COMMENT_SQL]
+
+
+def test_known_user_skips_upsert_until_name_changes():
+    create(FakeSession(comment_row(user_changed=False)))
+    db = FakeSession(comment_row(user_changed=False))
+    create(db)
+    assert db.executed[0][0] is crud.CREATE_COMMENT_KNOWN_USER_SQL
+    db = FakeSession(comment_row(user_changed=True))
+    create(db, first_name='Новое имя')
+    assert [statement for statement, params in db.executed] == [crud.CREATE_COMMENT_SQL, crud.BUMP_USER_ITEMS_SQL]
@@ -0,0 +1,122 @@
+import base64
+import itertools
+import json
+from datetime import datetime
+
+import pytest
+
+from app.comment import schemas
+from app.utils import convertors
+
+
+def encode(data: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(data).encode('utf-8')).decode('utf-8')
+
+
+def test_cursor_round_trip():
+    row = type('Row', (), {'path': '000000001.000000002', 'date_created': datetime(2022, 1, 1), 'id': 7})()
+    tree = convertors.encode_cursor(schemas.PresentationList.tree, row)
+    flat = convertors.encode_cursor(schemas.PresentationList.flat, row)
+    assert convertors.decode_cursor(schemas.PresentationList.tree, tree) == ('000000001.000000002',)
+    assert convertors.decode_cursor(schemas.PresentationList.flat, flat) == (datetime(2022, 1, 1), 7)
+
+
+@pytest.mark.parametrize('presentation, cursor', [
+    (schemas.PresentationList.tree, encode({'p': 'tree', 'k': ['not a path!']})),
+    (schemas.PresentationList.roots, encode({'p': 'roots', 'k': ['1..2']})),
+    (schemas.PresentationList.tree, encode({'p': 'tree', 'k': [1, 2]})),
+    (schemas.PresentationList.tree, encode({'p': 'flat', 'k': ['1']})),
+    (schemas.PresentationList.flat, encode({'p': 'flat', 'k': ['yesterday', 1]})),
+    (schemas.PresentationList.flat, encode({'p': 'flat', 'k': ['2022-01-01T00:00:00', 'x']})),
+    (schemas.PresentationList.tree, 'not base64 at all'),
+])
+def test_invalid_cursor_raises_value_error(presentation, cursor):
+    with pytest.raises(ValueError, match='invalid cursor'):
+        convertors.decode_cursor(presentation, cursor)
+
+
+@pytest.mark.parametrize('cursor', [
+    encode({'o': 'rank', 'k': ['high', 1]}),
+    encode({'o': 'rank', 'k': [0.5]}),
+    encode({'o': 'date', 'k': [0.5, 1]}),
+])
+def test_invalid_search_cursor_raises_value_error(cursor):
+    order = schemas.SearchOrder(json.loads(base64.urlsafe_b64decode(cursor))['o'])
+    with pytest.raises(ValueError):
+        convertors.decode_search_cursor(order, cursor)
+
+
+@pytest.mark.parametrize('token', [encode({'c': ['yesterday', 1]}), encode({'c': ['2022-01-01', 'x']}), 'garbage'])
+def test_invalid_changes_token_raises_value_error(token):
+    with pytest.raises(ValueError):
+        convertors.decode_changes_token(token)
+
+
+@pytest.mark.parametrize('if_none_match', ['"5"', 'W/"5"', ' "5" ', '"4", "5"', '"4",W/"5"', '*'])
+def test_etag_matches(if_none_match):
+    assert convertors.etag_matches(if_none_match, convertors.version_2_etag(5))
+
+
+@pytest.mark.parametrize('if_none_match', [None, '', '"4"', '"4", W/"6"', '5', 'W/5', '"50"', '"5', 'w/"5"'])
+def test_etag_does_not_match(if_none_match):
+    assert not convertors.etag_matches(if_none_match, convertors.version_2_etag(5))
+
+
+def comment_row(path: str):
+    values = dict(id=int(path.split('.')[-1]), path=path, level=path.count('.') + 1, comment_text=f'text {path}',
+                  date_created=datetime(2022, 1, 1), date_modified=datetime(2022, 1, 1), is_deleted=False,
+                  scope='all', user_id=1, external_id='user', first_name=None, last_name=None, user_group=None)
+    return type('Row', (), values)()
+
+
+# строки в порядке ltree: метки сравниваются как текст, поэтому 1.10 идет после 1.1.5, а 10 - раньше 3.
+# У 3.7 родителя в выборке нет, он выводится на верхнем уровне
+NESTED_PATHS = ['1', '1.1', '1.1.5', '1.10', '10', '10.2', '3.7']
+
+
+def expected_nested(rows, next_cursor=None, changes_token=None):
+    """Вложенная страница, собранная из плоской (comments_page_2_json) по путям комментариев"""
+    page = json.loads(convertors.comments_page_2_json(rows, next_cursor, changes_token))
+    comments = {}
+    top = []
+    for row, comment in zip(rows, page['comments']):
+        comment['children'] = []
+        parent = str(row.path).rpartition('.')[0]
+        (comments[parent]['children'] if parent in comments else top).append(comment)
+        comments[str(row.path)] = comment
+    page['comments'] = top
+    return page
+
+
+def batch_splits(rows):
+    """Все разбиения строк на последовательные пачки, в том числе с пустыми пачками по краям"""
+    for cuts in itertools.product((False, True), repeat=len(rows) - 1):
+        batches, batch = [[]], []
+        for row, cut in zip(rows, cuts + (False,)):
+            batch.append(row)
+            if cut:
+                batches.append(batch)
+                batch = []
+        yield batches + [batch, []]
+
+
+def test_nested_encoder_matches_flat_page_for_any_batch_split():
+    rows = [comment_row(path) for path in NESTED_PATHS]
+    expected = expected_nested(rows, 'cursor', 'token')
+    assert [comment['id'] for comment in expected['comments']] == [1, 10, 7]
+    for batches in batch_splits(rows):
+        encoder = convertors.NestedCommentsJsonEncoder()
+        chunks = [encoder.start()] + [encoder.feed(batch) for batch in batches] + [encoder.finish('cursor', 'token')]
+        assert json.loads(b''.join(chunks)) == expected
+
+
+def test_nested_encoder_closes_deep_branch_in_finish():
+    rows = [comment_row(path) for path in ('1', '1.2', '1.2.3', '1.2.3.4')]
+    encoder = convertors.NestedCommentsJsonEncoder()
+    body = encoder.start() + encoder.feed(rows[:2]) + encoder.feed(rows[2:])
+    assert json.loads(body + encoder.finish()) == expected_nested(rows)
+
+
+def test_nested_page_2_json_of_empty_page():
+    assert json.loads(convertors.nested_comments_page_2_json([])) == {'comments': [], 'next_cursor': None,
+                                                                     'changes_token': None}
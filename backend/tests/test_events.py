@@ -0,0 +1,208 @@
+import asyncio
+import collections
+from datetime import datetime
+
+import asyncpg
+import orjson
+
+from app.comment import crud, events
+
+SERVICE_ID = '6f1c4a52-8f0e-4c3e-9d55-3c2a1f0b7e11'
+KEY = (SERVICE_ID, 'comments', 'page', 'all')
+Row = collections.namedtuple('Row', [column.key for column in crud.COMMENT_OUT_COLUMNS])
+
+
+def comment_row(id: int):
+    return Row(id=id, path=str(id), level=1, comment_text='text', date_created=datetime(2022, 1, 1),
+               date_modified=datetime(2022, 1, 1), is_deleted=False, scope='all', user_id=1, external_id='user',
+               first_name=None, last_name=None, user_group=None)
+
+
+def payload(event: str, id: int, item_id: str = 'page'):
+    return orjson.dumps({'event': event, 'service_id': SERVICE_ID, 'data_type': 'comments', 'item_id': item_id,
+                         'scope': 'all', 'id': id}).decode()
+
+
+def make_hub(queue_size: int = 100):
+    hub = events.EventHub(dsn='postgresql://localhost/test', channel='comments_events', queue_size=queue_size,
+                          keepalive=0.01)
+    hub._has_pending = asyncio.Event()
+    hub._listening = asyncio.Event()
+    reads = []
+
+    async def read_comments(pending):
+        reads.append(list(pending))
+        return {(SERVICE_ID, event['id']): comment_row(event['id'])
+                for key, event in pending if event['event'] != 'delete'}
+
+    hub._read_comments = read_comments
+    return hub, reads
+
+
+def drain(queue: asyncio.Queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_events_fan_out_in_order_to_page_subscribers():
+    async def main():
+        hub, reads = make_hub()
+        dispatcher = asyncio.create_task(hub._dispatch())
+        async with hub.subscribe(SERVICE_ID, 'comments', 'page', 'all') as first, \
+                hub.subscribe(SERVICE_ID, 'comments', 'page', 'all') as second, \
+                hub.subscribe(SERVICE_ID, 'comments', 'other', 'all') as other:
+            for event, id in (('create', 1), ('update', 1), ('delete', 1)):
+                hub._on_notify(None, 0, 'comments_events', payload(event, id))
+            await settle()
+            result = drain(first), drain(second), drain(other)
+        dispatcher.cancel()
+        return result, reads, hub
+
+    (first, second, other), reads, hub = asyncio.run(main())
+    assert [event['event'] for event in first] == ['create', 'update', 'delete']
+    assert first[0]['comment']['id'] == 1 and first[2] == {'event': 'delete', 'id': 1}
+    assert second == first
+    assert other == []
+    # события, накопившиеся за время чтения, читаются одной пачкой
+    assert len(reads) == 1
+    assert hub.stats()['subscriptions'] == 0 and hub.received == 3
+
+
+def test_idle_subscriptions_cost_no_reads():
+    async def main():
+        hub, reads = make_hub()
+        dispatcher = asyncio.create_task(hub._dispatch())
+        async with hub.subscribe(SERVICE_ID, 'comments', 'page', 'all') as queue:
+            subscriptions = [hub.subscribe(SERVICE_ID, 'comments', f'idle-{n}', 'all') for n in range(10000)]
+            idle = [await subscription.__aenter__() for subscription in subscriptions]
+            stats = hub.stats()
+            # события страниц без подписчиков в этом процессе не ставятся в обработку
+            hub._on_notify(None, 0, 'comments_events', payload('create', 7, item_id='unwatched'))
+            assert hub._pending == []
+            hub._on_notify(None, 0, 'comments_events', payload('create', 8))
+            await settle()
+            received = drain(queue)
+            idle_events = sum(item.qsize() for item in idle)
+            for subscription in subscriptions:
+                await subscription.__aexit__(None, None, None)
+        dispatcher.cancel()
+        return stats, received, idle_events, reads, hub
+
+    stats, received, idle_events, reads, hub = asyncio.run(main())
+    assert stats['subscriptions'] == 10001 and stats['items'] == 10001
+    assert [event['comment']['id'] for event in received] == [8]
+    assert idle_events == 0
+    assert [[event['id'] for key, event in pending] for pending in reads] == [[8]]
+    assert hub.stats()['items'] == 0
+
+
+def test_queue_overflow_replaces_events_with_reload():
+    async def main():
+        hub, reads = make_hub(queue_size=2)
+        dispatcher = asyncio.create_task(hub._dispatch())
+        async with hub.subscribe(SERVICE_ID, 'comments', 'page', 'all') as queue:
+            for id in (1, 2, 3):
+                hub._on_notify(None, 0, 'comments_events', payload('delete', id))
+            await settle()
+            overflowed = drain(queue)
+            hub._on_notify(None, 0, 'comments_events', payload('delete', 4))
+            await settle()
+            after = drain(queue)
+        dispatcher.cancel()
+        return overflowed, after, hub
+
+    overflowed, after, hub = asyncio.run(main())
+    assert overflowed == [events.RELOAD_EVENT]
+    assert after == [{'event': 'delete', 'id': 4}]
+    assert hub.dropped == 1
+
+
+def test_read_failure_sends_reload():
+    async def main():
+        hub, reads = make_hub()
+
+        async def failing_read(pending):
+            raise OSError('connection refused')
+
+        hub._read_comments = failing_read
+        dispatcher = asyncio.create_task(hub._dispatch())
+        async with hub.subscribe(SERVICE_ID, 'comments', 'page', 'all') as queue:
+            hub._on_notify(None, 0, 'comments_events', payload('create', 1))
+            hub._on_notify(None, 0, 'comments_events', payload('update', 1))
+            await settle()
+            result = drain(queue)
+        dispatcher.cancel()
+        return result
+
+    assert asyncio.run(main()) == [events.RELOAD_EVENT]
+
+
+def test_invalid_payload_is_ignored():
+    async def main():
+        hub, reads = make_hub()
+        async with hub.subscribe(SERVICE_ID, 'comments', 'page', 'all'):
+            hub._on_notify(None, 0, 'comments_events', 'not json')
+            hub._on_notify(None, 0, 'comments_events', '{"event": "create"}')
+        return hub
+
+    hub = asyncio.run(main())
+    assert hub._pending == [] and hub.received == 2
+
+
+class FakeConnection:
+    def __init__(self, fail_keepalive: bool):
+        self.fail_keepalive = fail_keepalive
+        self.closed = False
+        self.listeners = []
+
+    async def add_listener(self, channel, callback):
+        self.listeners.append(channel)
+
+    def is_closed(self):
+        return self.closed
+
+    async def execute(self, query):
+        if self.fail_keepalive:
+            self.closed = True
+            raise asyncpg.InterfaceError('connection lost')
+
+    def terminate(self):
+        self.closed = True
+
+
+def test_reconnect_broadcasts_reload(monkeypatch):
+    connections = [FakeConnection(fail_keepalive=True), FakeConnection(fail_keepalive=False)]
+
+    opened = []
+
+    async def connect(dsn):
+        opened.append(dsn)
+        return connections[len(opened) - 1]
+
+    monkeypatch.setattr(asyncpg, 'connect', connect)
+    monkeypatch.setattr(events, 'RECONNECT_DELAY', 0)
+
+    async def main():
+        hub, reads = make_hub()
+        async with hub.subscribe(SERVICE_ID, 'comments', 'page', 'all') as queue:
+            listener = asyncio.create_task(hub._listen())
+            await asyncio.wait_for(hub._listening.wait(), timeout=1)
+            first = drain(queue)
+            while len(opened) < 2 or not hub._listening.is_set():
+                await asyncio.sleep(0.001)
+            await settle()
+            second = drain(queue)
+            listener.cancel()
+        return first, second
+
+    first, second = asyncio.run(main())
+    assert first == []
+    assert second == [events.RELOAD_EVENT]
+    assert [connection.listeners for connection in connections] == [['comments_events'], ['comments_events']]
@@ -0,0 +1,174 @@
+import asyncio
+import uuid
+from datetime import datetime
+from types import SimpleNamespace
+
+import orjson
+import pytest
+
+from app.comment import crud, importer
+
+SERVICE_ID = uuid.uuid4()
+USER = {'external_id': 'u-1', 'first_name': 'Имя', 'last_name': 'Фамилия', 'user_group': 'reader'}
+
+
+def comment_line(**fields) -> bytes:
+    comment = {'id': 'c-1', 'data_type': 'comments', 'item_id': 'page', 'comment_text': 'Текст', 'user': USER}
+    comment.update(fields)
+    return orjson.dumps({name: value for name, value in comment.items() if value is not None})
+
+
+async def chunks_of(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def read_lines(*chunks):
+    async def main():
+        return [line async for line in importer.iter_lines(chunks_of(*chunks))]
+
+    return asyncio.run(main())
+
+
+class FakeDB:
+    async def commit(self):
+        pass
+
+    async def rollback(self):
+        pass
+
+
+class FakeImportDB:
+    """Хранилище импорта без БД: подменяет функции crud, которые вызывает import_chunk"""
+
+    def __init__(self, monkeypatch):
+        self.next_id = 1
+        self.imported = {}
+        self.inserted = []
+        monkeypatch.setattr(crud, 'get_imported_comments', self.get_imported_comments)
+        monkeypatch.setattr(crud, 'get_or_create_users', self.get_or_create_users)
+        monkeypatch.setattr(crud, 'next_comment_ids', self.next_comment_ids)
+        monkeypatch.setattr(crud, 'restore_items', self.restore_items)
+        monkeypatch.setattr(crud, 'insert_imported_comments', self.insert_imported_comments)
+
+    async def get_imported_comments(self, db, service_id, source_ids):
+        return {source_id: self.imported[source_id] for source_id in source_ids if source_id in self.imported}
+
+    async def get_or_create_users(self, db, service_id, users):
+        return {external_id: number for number, external_id in enumerate(users, 1)}
+
+    async def next_comment_ids(self, db, count):
+        ids = list(range(self.next_id, self.next_id + count))
+        self.next_id += count
+        return ids
+
+    async def restore_items(self, db, service_id, data_type, item_ids):
+        pass
+
+    async def insert_imported_comments(self, db, service_id, rows):
+        self.inserted.extend(rows)
+        for row in rows:
+            self.imported[row['source_id']] = SimpleNamespace(path=row['path'], data_type=row['data_type'],
+                                                              item_id=row['item_id'])
+
+    def load(self, *lines):
+        rows = [importer.parse_line(line_no, line) for line_no, line in enumerate(lines, 1)]
+        return asyncio.run(importer.import_chunk(db=None, service_id=SERVICE_ID, rows=rows))
+
+
+@pytest.fixture
+def store(monkeypatch):
+    return FakeImportDB(monkeypatch)
+
+
+def test_iter_lines_joins_lines_split_between_chunks():
+    assert read_lines(b'{"a"', b':1}\n{"b":', b'2}\n', b'{"c":3}') == [b'{"a":1}', b'{"b":2}', b'{"c":3}']
+
+
+def test_iter_lines_keeps_blank_lines_and_carriage_returns():
+    lines = read_lines(b'one\r\n\r\n', b'\n', b'two\r\n')
+    assert lines == [b'one\r', b'\r', b'', b'two\r']
+    assert [importer.parse_line(1, line)['source_id'] for line in read_lines(comment_line() + b'\r\n')] == ['c-1']
+
+
+def test_import_skips_blank_lines(store):
+    async def main():
+        lines = importer.iter_lines(chunks_of(comment_line(id='c-1') + b'\r\n\r\n  \n', comment_line(id='c-2')))
+        return await importer.import_comments(db=FakeDB(), service_id=SERVICE_ID, lines=lines, chunk_size=10)
+
+    result = asyncio.run(main())
+    assert (result.imported, result.skipped) == (2, 0)
+    assert [row['line_no'] for row in store.inserted] == [1, 4]
+
+
+def test_date_created_defaults_to_now_and_is_converted_to_utc():
+    before = datetime.utcnow()
+    assert before <= importer.parse_line(1, comment_line())['date_created'] <= datetime.utcnow()
+    row = importer.parse_line(1, comment_line(date_created='2021-05-01T15:00:00+03:00'))
+    assert row['date_created'] == datetime(2021, 5, 1, 12, 0)
+    assert importer.parse_line(1, comment_line(date_created='2021-05-01T12:00:00Z'))['date_created'] == \
+        datetime(2021, 5, 1, 12, 0)
+
+
+@pytest.mark.parametrize('value', ['yesterday', '2021-13-01', 1620000000])
+def test_invalid_date_created_is_rejected(value):
+    with pytest.raises(importer.ImportLineError) as err:
+        importer.parse_line(7, comment_line(date_created=value))
+    assert err.value.line_no == 7
+
+
+def test_date_modified_is_import_time(store):
+    before = datetime.utcnow()
+    store.load(comment_line(date_created='2021-05-01T12:00:00Z', date_modified='not a date'))
+    assert before <= store.inserted[0]['date_modified'] <= datetime.utcnow()
+    assert store.inserted[0]['date_created'] == datetime(2021, 5, 1, 12, 0)
+
+
+@pytest.mark.parametrize('line, message', [(b'{"id":', 'invalid json'),
+                                           (b'[1]', 'json object'),
+                                           (comment_line(id=''), 'id is required'),
+                                           (comment_line(data_type='unknown'), 'data_type'),
+                                           (comment_line(scope='unknown'), 'scope'),
+                                           (comment_line(comment_text=' '), 'comment_text length')])
+def test_invalid_line_is_rejected(line, message):
+    with pytest.raises(importer.ImportLineError, match=message):
+        importer.parse_line(1, line)
+
+
+def test_paths_are_built_from_parents_in_chunk(store):
+    assert store.load(comment_line(id='c-1'),
+                      comment_line(id='c-2', parent_id='c-1'),
+                      comment_line(id='c-3', parent_id='c-2'),
+                      comment_line(id='c-4')) == 4
+    assert [row['path'] for row in store.inserted] == ['000000001', '000000001.000000002',
+                                                      '000000001.000000002.000000003', '000000004']
+
+
+def test_paths_are_built_from_previously_imported_parents(store):
+    store.load(comment_line(id='c-1'))
+    assert store.load(comment_line(id='c-2', parent_id='c-1')) == 1
+    assert store.inserted[-1]['path'] == '000000001.000000002'
+
+
+def test_unknown_parent_is_rejected(store):
+    with pytest.raises(importer.ImportLineError, match="parent comment 'c-0' not found") as err:
+        store.load(comment_line(id='c-1'), comment_line(id='c-2', parent_id='c-0'))
+    assert err.value.line_no == 2
+
+
+def test_parent_on_another_item_is_rejected(store):
+    with pytest.raises(importer.ImportLineError, match='another item'):
+        store.load(comment_line(id='c-1', item_id='other'), comment_line(id='c-2', parent_id='c-1'))
+
+
+def test_duplicate_id_in_chunk_is_rejected(store):
+    with pytest.raises(importer.ImportLineError, match='duplicate id'):
+        store.load(comment_line(id='c-1'), comment_line(id='c-1'))
+
+
+def test_rerun_skips_imported_comments(store):
+    lines = [comment_line(id='c-1'), comment_line(id='c-2', parent_id='c-1')]
+    assert store.load(*lines) == 2
+    assert store.load(*lines, comment_line(id='c-3', parent_id='c-2')) == 1
+    assert [row['source_id'] for row in store.inserted] == ['c-1', 'c-2', 'c-3']
+    assert store.inserted[-1]['path'] == '000000001.000000002.000000003'
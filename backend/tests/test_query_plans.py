@@ -0,0 +1,151 @@
+"""
+Проверка по EXPLAIN, что запросы списка и счетчиков комментариев обслуживаются индексами
+(миграция 730aaa60df29 и таблица счетчиков). Данные создаются в транзакции, которая откатывается.
+Последовательное сканирование отключается, т.к. на нескольких строках планировщик всегда выбирает его:
+тест проверяет, что индекс может обслужить запрос (условия и порядок сортировки), а не оценку стоимости.
+"""
+import asyncio
+import json
+import uuid
+
+import pytest
+from sqlalchemy import insert, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+from sqlalchemy_utils import Ltree
+
+from app.comment import crud, models, schemas
+from app.core.config import SQLALCHEMY_DATABASE_URL
+from app.db.session import create_db_engine
+
+pytestmark = pytest.mark.postgres
+
+INDEX_NODES = ('Index Scan', 'Index Only Scan')
+
+
+class Explain(Executable, ClauseElement):
+    """EXPLAIN (FORMAT JSON) для запроса SQLAlchemy с теми же параметрами"""
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain, 'postgresql')
+def compile_explain(element, compiler, **kw):
+    return 'EXPLAIN (FORMAT JSON) ' + compiler.process(element.statement, **kw)
+
+
+class PlanRecorder:
+    """Сессия, которая перед выполнением каждого запроса сохраняет его план"""
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+        self.plans = []
+
+    async def execute(self, statement, *args, **kwargs):
+        plan = (await self.db.execute(Explain(statement), *args, **kwargs)).scalar_one()
+        # в зависимости от кодека json драйвера план приходит строкой или уже разобранным
+        if isinstance(plan, (str, bytes)):
+            plan = json.loads(plan)
+        self.plans.append(plan[0]['Plan'])
+        return await self.db.execute(statement, *args, **kwargs)
+
+
+def index_scans(plan: dict):
+    """Имена индексов, по которым в плане выполняется Index Scan или Index Only Scan"""
+    names = set()
+    if plan.get('Node Type') in INDEX_NODES:
+        names.add(plan['Index Name'])
+    for child in plan.get('Plans', ()):
+        names |= index_scans(child)
+    return names
+
+
+async def parent_indexes(db: AsyncSession, names: set) -> set:
+    """Имена индексов секционированной таблицы для индексов ее секций (остальные имена не меняются)"""
+    rows = (await db.execute(text("""
+        SELECT child.relname AS name, parent.relname AS parent
+          FROM pg_class child
+          JOIN pg_inherits ON pg_inherits.inhrelid = child.oid
+          JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+         WHERE child.relname = ANY(:names)
+    """), {'names': list(names)})).all()
+    parents = {row.name: row.parent for row in rows}
+    return {parents.get(name, name) for name in names}
+
+
+async def seed(db: AsyncSession):
+    service_id = (await db.execute(insert(models.Service)
+                                   .values(service_name=f'explain-{uuid.uuid4()}', token='token')
+                                   .returning(models.Service.id))).scalar_one()
+    user_id = (await db.execute(insert(models.User)
+                                .values(external_id='user', service_id=service_id)
+                                .returning(models.User.id))).scalar_one()
+    ids = []
+    for path in ('1', '1.2', '1.2.3', '4', '4.5'):
+        ids.append((await db.execute(insert(models.Comment)
+                                     .values(path=Ltree(path), level=path.count('.') + 1, item_id='page',
+                                             data_type='comments', comment_text='text', user_id=user_id,
+                                             service_id=service_id, scope='all')
+                                     .returning(models.Comment.id))).scalar_one())
+    await db.execute(insert(models.CommentCounter)
+                     .values(service_id=service_id, data_type='comments', item_id='page', scope='all',
+                             total=5, active=5, top_level=2))
+    return service_id, ids
+
+
+def used_indexes(read):
+    """Запуск read(db, service_id, ids) на тестовых данных, возвращает индексы из плана последнего запроса"""
+    async def main():
+        engine = create_db_engine(SQLALCHEMY_DATABASE_URL)
+        try:
+            async with engine.connect() as connection:
+                transaction = await connection.begin()
+                try:
+                    db = AsyncSession(bind=connection)
+                    await db.execute(text('SET LOCAL enable_seqscan = off'))
+                    await db.execute(text('SET LOCAL enable_bitmapscan = off'))
+                    service_id, ids = await seed(db)
+                    recorder = PlanRecorder(db)
+                    await read(recorder, service_id, ids)
+                    return await parent_indexes(db, index_scans(recorder.plans[-1]))
+                finally:
+                    await transaction.rollback()
+        finally:
+            await engine.dispose()
+
+    return asyncio.run(main())
+
+
+def test_tree_page_uses_item_path_index():
+    async def read(db, service_id, ids):
+        await crud.get_comments(db=db, service_id=service_id, data_type='comments', item_id='page',
+                                scope='all', presentation=schemas.PresentationList.tree, limit=10)
+
+    assert 'ix_comments_item_path' in used_indexes(read)
+
+
+def test_flat_page_uses_item_date_created_index():
+    async def read(db, service_id, ids):
+        await crud.get_comments(db=db, service_id=service_id, data_type='comments', item_id='page',
+                                scope='all', presentation=schemas.PresentationList.flat, limit=10)
+
+    assert 'ix_comments_item_date_created' in used_indexes(read)
+
+
+def test_children_page_uses_path_index():
+    async def read(db, service_id, ids):
+        await crud.get_comments(db=db, service_id=service_id, data_type='comments', item_id='page',
+                                scope='all', presentation=schemas.PresentationList.tree, parent_id=ids[0],
+                                limit=10)
+
+    assert used_indexes(read) & {'ix_comments_item_path', 'ix_comments_path'}
+
+
+def test_counters_use_primary_key():
+    async def read(db, service_id, ids):
+        await crud.get_counters(db=db, service_id=service_id, data_type='comments', item_ids=['page'], scope='all')
+
+    assert 'comment_counters_pkey' in used_indexes(read)
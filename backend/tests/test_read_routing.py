@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+from fastapi import Response
+
+from app.comment import api
+from app.db import session
+from app.db.session import EngineRouter, ReadSessionLocal
+
+PRIMARY, REPLICA_1, REPLICA_2 = object(), object(), object()
+
+
+def test_reads_go_to_primary_without_replicas():
+    router = EngineRouter(PRIMARY)
+    assert [router.read_engine() for _ in range(3)] == [PRIMARY] * 3
+
+
+def test_reads_rotate_over_replicas():
+    router = EngineRouter(PRIMARY, [REPLICA_1, REPLICA_2])
+    assert [router.read_engine() for _ in range(4)] == [REPLICA_1, REPLICA_2, REPLICA_1, REPLICA_2]
+    assert router.primary is PRIMARY
+
+
+def test_read_session_is_bound_to_replica(monkeypatch):
+    monkeypatch.setattr(session, 'SessionLocal', lambda bind: FakeSession(bind))
+    router = EngineRouter(PRIMARY, [REPLICA_1])
+    assert ReadSessionLocal(router).engine is REPLICA_1
+
+
+class FakeSession:
+    def __init__(self, engine):
+        self.engine = engine
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+def read_db_engine(monkeypatch, cookie):
+    monkeypatch.setattr(api, 'SessionLocal', lambda: FakeSession(PRIMARY))
+    monkeypatch.setattr(api, 'ReadSessionLocal', lambda: FakeSession(REPLICA_1))
+
+    async def main():
+        dependency = api.get_read_db(cookie)
+        db = await dependency.__anext__()
+        await dependency.aclose()
+        return db.engine
+
+    return asyncio.run(main())
+
+
+def test_unpinned_reads_use_replica(monkeypatch):
+    assert read_db_engine(monkeypatch, None) is REPLICA_1
+    assert read_db_engine(monkeypatch, 'not a number') is REPLICA_1
+    assert read_db_engine(monkeypatch, str(time.time() - 1)) is REPLICA_1
+
+
+def test_pinned_reads_use_primary(monkeypatch):
+    assert read_db_engine(monkeypatch, str(time.time() + 60)) is PRIMARY
+
+
+def test_writes_pin_reads_only_with_replicas(monkeypatch):
+    monkeypatch.setattr(api, 'replica_engines', [])
+    response = Response()
+    api.pin_reads_to_primary(response)
+    assert 'set-cookie' not in response.headers
+
+    monkeypatch.setattr(api, 'replica_engines', [REPLICA_1])
+    response = Response()
+    before = time.time()
+    api.pin_reads_to_primary(response)
+    cookie = response.headers['set-cookie']
+    assert cookie.startswith(api.READ_PRIMARY_COOKIE + '=')
+    pinned_until = float(cookie.split(';')[0].split('=', 1)[1])
+    assert pinned_until >= before + api.DB_REPLICA_PIN_SECONDS - 1
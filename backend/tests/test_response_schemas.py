@@ -0,0 +1,52 @@
+from datetime import datetime
+
+from fastapi import FastAPI
+
+from app.comment import api, schemas
+from app.utils import convertors
+
+
+def row(path: str, **fields):
+    values = dict(id=int(path.split('.')[-1]), path=path, level=path.count('.') + 1, comment_text='text',
+                  date_created=datetime(2022, 1, 1), date_modified=datetime(2022, 1, 1), is_deleted=False,
+                  scope='all', user_id=1, external_id='user', first_name=None, last_name=None, user_group=None)
+    values.update(fields)
+    return type('Row', (), values)()
+
+
+def page_schema():
+    app = FastAPI()
+    app.include_router(api.router)
+    openapi = app.openapi()
+    operation = openapi['paths']['/{service_id}/{data_type}/{item_id}/']['get']
+    refs = operation['responses']['200']['content']['application/json']['schema']['anyOf']
+    return openapi['components']['schemas'], {ref['$ref'].rsplit('/', 1)[1] for ref in refs}
+
+
+def test_nested_page_matches_schema():
+    body = convertors.nested_comments_page_2_json([row('1'), row('1.2'), row('1.2.3'), row('4')], 'cursor')
+    page = schemas.NestedCommentsPage.parse_raw(body)
+    assert [comment.id for comment in page.comments] == [1, 4]
+    assert page.comments[0].children[0].children[0].id == 3
+
+
+def test_nested_page_in_openapi():
+    components, responses = page_schema()
+    assert {'CommentsPage', 'NestedCommentsPage'} <= responses
+    children = components['NestedComment']['properties']['children']
+    assert children['items']['$ref'].endswith('/NestedComment')
+
+
+def test_roots_page_matches_schema():
+    root = row('1', replies_count=5)
+    body = convertors.roots_page_2_json([root, row('4', replies_count=0)], {'1': [row('1.2'), row('1.3')]}, 'cursor')
+    page = schemas.RootsPage.parse_raw(body)
+    assert [comment.replies_count for comment in page.comments] == [5, 0]
+    assert [reply.id for reply in page.comments[0].replies] == [2, 3]
+    assert page.comments[1].replies == []
+
+
+def test_roots_page_in_openapi():
+    components, responses = page_schema()
+    assert 'RootsPage' in responses
+    assert {'replies_count', 'replies'} <= set(components['RootComment']['properties'])
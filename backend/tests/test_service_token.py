@@ -0,0 +1,105 @@
+import asyncio
+import uuid
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from app.comment import api, crud
+from app.utils import cache, signer
+
+SERVICE_ID = uuid.uuid4()
+TOKEN = 'current-token'
+
+
+class FakeSession:
+    """Сессия без БД, token - токен, который вернет чтение в ней"""
+
+    def __init__(self, token=TOKEN, bind=None):
+        self.token = token
+        self.bind = bind
+
+    async def close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    rotated = []
+
+    async def get_token_by_service_id(db, service_id):
+        return db.token
+
+    async def update_service_token(db, service_id):
+        rotated.append(service_id)
+        return {'id': service_id, 'service_name': 'service', 'token': 'new-token'}
+
+    async def get_db():
+        yield FakeSession()
+
+    monkeypatch.setattr(crud, 'get_token_by_service_id', get_token_by_service_id)
+    monkeypatch.setattr(crud, 'update_service_token', update_service_token)
+    monkeypatch.setattr(signer, 'SessionLocal', FakeSession)
+    signer.token_cache.clear()
+    app = FastAPI()
+    app.include_router(api.router)
+    app.dependency_overrides[api.get_db] = get_db
+    yield TestClient(app), rotated
+    signer.token_cache.clear()
+
+
+def test_rotation_requires_signature(client):
+    client, rotated = client
+    assert client.put(f'/service/{SERVICE_ID}/token/').status_code == 422
+    assert client.put(f'/service/{SERVICE_ID}/token/?signature=wrong').status_code == 403
+    assert rotated == []
+
+
+def test_rotation_with_current_token_signature(client):
+    client, rotated = client
+    signature = signer.create_sign(TOKEN, str(SERVICE_ID) + 'token')
+    response = client.put(f'/service/{SERVICE_ID}/token/?signature={signature}')
+    assert response.status_code == 200
+    assert response.json()['token'] == 'new-token'
+    assert rotated == [SERVICE_ID]
+
+
+def test_replica_does_not_bring_back_replaced_token(client):
+    """После замены токена реплика с отставанием возвращает старый токен, но токен читается из основной БД"""
+    replica = FakeSession(token='old-token', bind=object())
+    old_signature = signer.create_sign('old-token', str(SERVICE_ID) + 'comments' + 'page')
+    new_signature = signer.create_sign(TOKEN, str(SERVICE_ID) + 'comments' + 'page')
+    signer.token_cache.invalidate(SERVICE_ID)
+
+    async def check(signature):
+        return await signer.check_signs(db=replica, received_signature=signature, service_id=SERVICE_ID,
+                                        data_type='comments', item_id='page')
+
+    assert asyncio.run(check(old_signature)) is False
+    assert asyncio.run(check(new_signature)) is True
+    assert signer.token_cache.get(SERVICE_ID) == TOKEN
+
+
+def test_other_process_cache_reads_new_token(client, monkeypatch):
+    """Кэш другого процесса после устаревания записи читает новый токен из основной БД"""
+    monkeypatch.setattr(signer, 'token_cache', cache.TTLCache(maxsize=16, ttl=300))
+    signer.token_cache.set(SERVICE_ID, 'old-token')
+    signer.token_cache.invalidate(SERVICE_ID)
+    signature = signer.create_sign(TOKEN, str(SERVICE_ID) + 'comments' + 'page')
+    assert asyncio.run(signer.check_signs(db=FakeSession(token='old-token', bind=object()),
+                                          received_signature=signature, service_id=SERVICE_ID,
+                                          data_type='comments', item_id='page'))
+
+
+def test_primary_session_is_reused(client):
+    """Сессия основной БД (запросы записи) используется для чтения токена без открытия новой"""
+    primary = FakeSession(token='primary-token', bind=signer.engine)
+    signature = signer.create_sign('primary-token', str(SERVICE_ID) + 'token')
+    assert asyncio.run(signer.check_signs(db=primary, received_signature=signature, service_id=SERVICE_ID,
+                                          data_type='token', item_id=''))
@@ -0,0 +1,109 @@
+import asyncio
+
+from app.comment import api, crud
+from app.utils.singleflight import SingleFlight
+
+
+class FakeSession:
+    async def close(self):
+        pass
+
+
+def test_concurrent_calls_share_one_execution(monkeypatch):
+    calls = []
+
+    async def get_comments(**kwargs):
+        calls.append(kwargs)
+        await asyncio.sleep(0.01)
+        return ['row']
+
+    monkeypatch.setattr(crud, 'get_comments', get_comments)
+    flight = SingleFlight()
+
+    async def read():
+        return await crud.get_comments(service_id='s', item_id='page')
+
+    async def main():
+        return await asyncio.gather(*[flight.do('key', read) for _ in range(50)])
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert results == [['row']] * 50
+    assert flight.stats() == {'in_flight': 0, 'executions': 1, 'joined': 49}
+
+
+def test_api_flight_reads_page_once(monkeypatch):
+    calls = []
+
+    async def get_comments(**kwargs):
+        calls.append(kwargs)
+        await asyncio.sleep(0.01)
+        return []
+
+    monkeypatch.setattr(crud, 'get_comments', get_comments)
+    monkeypatch.setattr(api, 'comments_flight', SingleFlight())
+
+    async def read():
+        return await api.read_comments_page(db=FakeSession(), service_id='s', data_type='comments',
+                                            item_id='page', presentation=api.schemas.PresentationList.tree,
+                                            scope=api.schemas.Scope.all, parent_id=None, limit=10, after=None)
+
+    async def main():
+        return await asyncio.gather(*[api.comments_flight.do('page-key', read) for _ in range(20)])
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert len(set(results)) == 1
+
+
+def test_errors_reach_all_callers_and_next_call_runs_again():
+    calls = []
+
+    async def fail():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise LookupError('not found')
+
+    flight = SingleFlight()
+
+    async def main():
+        return await asyncio.gather(*[flight.do('key', fail) for _ in range(5)], return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert len(calls) == 1
+    assert all(isinstance(result, LookupError) for result in results)
+    asyncio.run(main())
+    assert len(calls) == 2
+
+
+def test_leader_cancellation_does_not_cancel_flight():
+    async def slow():
+        await asyncio.sleep(0.02)
+        return 'done'
+
+    flight = SingleFlight()
+
+    async def main():
+        leader = asyncio.ensure_future(flight.do('key', slow))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.do('key', slow))
+        await asyncio.sleep(0)
+        leader.cancel()
+        return await follower
+
+    assert asyncio.run(main()) == 'done'
+
+
+def test_ttl_reuses_finished_result():
+    calls = []
+
+    async def read():
+        calls.append(1)
+        return len(calls)
+
+    flight = SingleFlight(ttl=60)
+
+    async def main():
+        return [await flight.do('key', read), await flight.do('key', read), await flight.do('other', read)]
+
+    assert asyncio.run(main()) == [1, 1, 2]